@@ -13,15 +13,15 @@ with open('HISTORY.rst') as history_file:
 
 # put package requirements here
 requirements = [
-    'jmespath',
-    'python-box'
+    'jmespath'
 ]
 
 # Optional packages
 extras = {
     'allmeta': ['piexif', 'filetype'],
     'winlnk': ['pywin32'],
-    'frontmatter': ['python-frontmatter']
+    'frontmatter': ['pyyaml'],
+    'phash': ['numpy', 'Pillow', 'piexif']
 }
 
 # put setup requirements (distutils extensions, etc.) here
@@ -36,8 +36,9 @@ test_requirements = [
     'piexif',
     'filetype',
     'jmespath',
-    'python-box',
-    'python-frontmatter'
+    'pyyaml',
+    'numpy',
+    'Pillow'
 ]
 
 setup(
@@ -2,17 +2,24 @@ import re
 import os
 import sys
 import json
+import asyncio
+import shutil
 import logging
 import textwrap
+import threading
 import argparse
+import warnings
+import functools
 import importlib
+import stat as stat_module
 
-from collections import defaultdict
+from collections import (OrderedDict, defaultdict, deque, namedtuple)
+from concurrent.futures import ThreadPoolExecutor
 
 import jmespath
-from box import Box
 
-from . import (exceptions, utils)
+from . import (dirfd, exceptions, ignore, lookups, shards, utils)
+from .journal import Journal
 
 __author__ = """Lars Solberg"""
 __email__ = 'lars.solberg@gmail.com'
@@ -31,6 +38,38 @@ TAG_PATH_HIERARCY_TOP_NAME = "root"
 # What character should we replace folder separator with to get path[hierarcy_str]
 TAG_PATH_HIERARCY_SEPARATOR = "_"
 
+# How many destinations cleanup checks at the same time
+CLEANUP_THREADS = 16
+
+# How many folders links point into cleanup remembers what exists in
+CLEANUP_CACHE_SIZE = 1024
+
+# How many folders we remember the path hierarcy for
+PATH_CACHE_SIZE = 1024
+
+# How many names with tags in them we remember the tags for
+TAG_CACHE_SIZE = 4096
+
+# How many links LinkWriter writes at the same time
+LINK_THREADS = 16
+
+# How many files arun() works on at the same time
+ARUN_CONCURRENCY = 16
+
+# Name of the files in src that can have exclude-patterns
+IGNORE_FILE_NAME = ".taggoignore"
+
+# Default name of the journal we keep in src while renaming
+RENAME_JOURNAL_NAME = ".taggo-rename-journal"
+
+# Where --link-creator manifest writes the links, in dst
+MANIFEST_NAME = ".taggo-manifest"
+
+COLLISION_RULES = ["smart", "no-overwrite", "overwrite-if-symlink", "overwrite-if-dst-same", "bail-if-different"]
+
+# Linux ioctl making a copy-on-write clone of a file (btrfs, XFS, ..)
+FICLONE = 0x40049409
+
 tag_regex = r"""
         (                    # Main tag-name group
             [^\.,\(\)\s]+    # Tags can contain anything except whitespaces, "." and "," (end of sentences problem)
@@ -60,8 +99,17 @@ if os.name == 'nt':
 else:
     invalid_fs_path_re = None
 
+@functools.lru_cache(maxsize=TAG_CACHE_SIZE)
+def _parse_hashtags(string):
+    # The same names (mostly folders) are looked at over and over again
+    return tuple(dict.fromkeys(hashtag_re.findall(string)))
+
+
 def hashtags_in(string):
-    return [i[0] for i in hashtag_re.findall(string)]
+    # Most names has no tags, and looking for the tag-character is a lot quicker than the regex
+    if TAG_CHARACTER not in string:
+        return []
+    return [name for name, _ in _parse_hashtags(string)]
 
 
 # Make a list of (num, name) of available metadata plugins.
@@ -114,46 +162,37 @@ logger.addHandler(h2)
 # Default
 logger.setLevel(logging.INFO)
 
-_json_output = False
-_dry = False
-_metadata = None
-_filters = None
+def set_output(output):
+    logger.disabled = False
+    if output == "DEBUG" or os.environ.get("DEBUG"):
+        logger.setLevel(logging.DEBUG)
+    elif output == "VERBOSE" or os.environ.get("VERBOSE"):
+        logger.setLevel(logging.VERBOSE)
+    elif output == "INFO":
+        logger.setLevel(logging.INFO)
+    elif output == "JSON":
+        # Json is picked per engine, see Taggo(json_output=...)
+        pass
+    elif output == "QUIET":
+        logger.disabled = True
+    else:
+        raise Exception('Invalid output option')
 
 
-def configure(*, output=None, dry=None, metadata=None, filters=None):
+def configure(*, output=None, **kwargs):
+    # Returns a Taggo with the options given (dry, metadata, filters, ...), and sets the log level for output
+    warnings.warn(
+        "taggo.configure() only sets the log level and returns a Taggo, the module-level run(), cleanup(), "
+        "rename(), .. don't use its options. Use the returned Taggo, or taggo.set_output() and taggo.Taggo()",
+        DeprecationWarning, stacklevel=2
+    )
     if output is not None:
-        global _json_output
-        _json_output = False
-        logger.disabled = False
-
-        if output == "DEBUG" or os.environ.get("DEBUG"):
-            logger.setLevel(logging.DEBUG)
-        elif output == "VERBOSE" or os.environ.get("VERBOSE"):
-            logger.setLevel(logging.VERBOSE)
-        elif output == "INFO":
-            logger.setLevel(logging.INFO)
-        elif output == "JSON":
-            _json_output = True
-        elif output == "QUIET":
-            logger.disabled = True
-        else:
-            raise Exception('Invalid output option')
-
-    if dry is not None:
-        global _dry
-        _dry = dry
+        set_output(output)
+    return Taggo(json_output=output == "JSON", **kwargs)
 
-    if metadata:
-        global _metadata
-        _metadata = metadata
 
-    if filters:
-        global _filters
-        _filters = filters
-
-
-def log(text, loglevel='info', category='general', data=None):
-    if _json_output:
+def log(text, loglevel='info', category='general', data=None, json_output=False):
+    if json_output:
         data = data or {}
 
         # Be smart about if we run from terminal or not..
@@ -166,28 +205,9 @@ def log(text, loglevel='info', category='general', data=None):
         getattr(logger, loglevel)(text)
 
 
-def _handle_paths(symlink_basepath, sourcepath):
-    symlink_basepath = os.path.abspath(symlink_basepath)
-    sourcepath = os.path.abspath(sourcepath)
-    log(f"Using symlink_basepath: {symlink_basepath}", loglevel='verbose')
-    log(f"Using sourcepath: {sourcepath}", loglevel='verbose')
-
-    if not os.path.exists(sourcepath):
-        raise exceptions.NotFoundException(f"Unable to find sourcepath: {sourcepath}")
-
-    return symlink_basepath, sourcepath
-
-
-def _check_filter(group, metadata_store):
-    if not _filters:
-        return None
-
-    for f in _filters.get(group, []):
-        if not jmespath.search(f, metadata_store.data):
-            raise SkipFile
-
-
-def _path_variants(dirpath):
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def _path_hierarcy(dirpath):
+    # Files in the same folder shares the same (immutable) hierarcy
     hierarcy = dirpath.split(os.path.sep)
 
     if invalid_fs_path_re:
@@ -199,13 +219,22 @@ def _path_variants(dirpath):
         # Not there on all OS'es
         pass
 
-    current_folder = hierarcy[-1]
+    return tuple(hierarcy)
 
-    return {
-        'current_folder': current_folder,
-        'hierarcy': hierarcy,
-        'hierarcy_rev': hierarcy[::-1]
-    }
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def _relative_folder(source_folder, symlink_folder):
+    # All links from one folder into the same tag-folder shares this part of the destination
+    return os.path.relpath(source_folder, symlink_folder)
+
+
+def _symlink_destination(sourcepath, symlink_folder):
+    # Same as os.path.relpath(sourcepath, symlink_folder), both paths must be absolute
+    source_folder, name = os.path.split(sourcepath)
+    relative_folder = _relative_folder(source_folder, symlink_folder)
+    if relative_folder == os.path.curdir:
+        return name
+    return relative_folder + os.path.sep + name
 
 
 def _path_hierarcy_string(path_hierarcy, is_file, separator=TAG_PATH_HIERARCY_SEPARATOR):
@@ -220,28 +249,34 @@ def _path_hierarcy_string(path_hierarcy, is_file, separator=TAG_PATH_HIERARCY_SE
     else:
         return separator.join(path_hierarcy[:-1])
 
-def _find_tags(string, regex):
-    tagdata = {}
-
-    for tag in set(regex.findall(string)):
-        tagname, tagparams = tag
-        tagdata[tagname] = tagparams.split(',')
+def _find_tags(string, regex=hashtag_re):
+    if regex is hashtag_re:
+        if TAG_CHARACTER not in string:
+            return {}
+        found = _parse_hashtags(string)
+    else:
+        found = dict.fromkeys(regex.findall(string))
 
-    return tagdata
+    return {tagname: tagparams.split(',') for tagname, tagparams in found}
 
 
-def find_tags(path, tag_lookup=None, is_file=True):
-    tag_lookup = tag_lookup or []
-    tagdata = {}
+def find_tags(path, tag_lookup=None, is_file=True, members=None):
+    # tag_lookup is a lookups.Lookups, or a list of lookup-names.
+    # If members is a dict, the archive members each tag was found in are added to it.
+    tagdata = _find_tags(path['basename'], hashtag_re)
 
-    tagdata.update(_find_tags(path['basename'], hashtag_re))
+    if tag_lookup:
+        if not isinstance(tag_lookup, lookups.Lookups):
+            tag_lookup = lookups.Lookups(tag_lookup, cache_path=False)
+        # Found once, and used for both the tags and the members
+        archive_members = tag_lookup.archive_members(path, is_file)
+        for t in tag_lookup.find(path, is_file, archive_members):
+            tagdata.update(_find_tags(t, tag_re))
 
-    if is_file and 'frontmatter' in tag_lookup:
-        if path['file-ext'] == 'md':
-            import frontmatter
-            fm = frontmatter.load(path['sourcepath'])
-            for t in fm.metadata.get('tags', []):
-                tagdata.update(_find_tags(t, tag_re))
+        if members is not None:
+            for t, member in archive_members:
+                for tagname in _find_tags(t, tag_re):
+                    members.setdefault(tagname, []).append(member)
 
     return tagdata
 
@@ -260,29 +295,158 @@ def _tag_variants(tagset):
     }
 
 
+class Record:
+    """
+    Compact holder of metadata for one scope.
+
+    Values in `views` are derived from the slots when asked for, and values that are added can have
+    a view-function, so eg. plugins can store their raw result and only expand it into a dict when a
+    filter or template needs it.
+    """
+    __slots__ = ('extra',)
+    views = {}
+
+    def __init__(self):
+        self.extra = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def __getitem__(self, key):
+        view = self.views.get(key)
+        if view:
+            return view(self)
+
+        if self.extra and key in self.extra:
+            value, expand = self.extra[key]
+            return expand(value) if expand else value
+
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.views or bool(self.extra and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.views) + list(self.extra or [])
+
+    def add(self, name, value, view=None):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[name] = (value, view)
+
+    def as_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+
+class PathRecord(Record):
+    __slots__ = ('sourcepath', 'is_file', 'hierarcy')
+    views = {
+        'sourcepath': lambda r: r.sourcepath,
+        'basename': lambda r: os.path.basename(r.sourcepath),
+        'file-ext': lambda r: r.sourcepath.split('.')[-1],
+        'current_folder': lambda r: r.hierarcy[-1],
+        'hierarcy': lambda r: list(r.hierarcy),
+        'hierarcy_rev': lambda r: list(r.hierarcy[::-1]),
+        'hierarcy_str': lambda r: _path_hierarcy_string(r.hierarcy, r.is_file),
+    }
+
+    def __init__(self, sourcepath, is_file):
+        super().__init__()
+        self.sourcepath = sourcepath
+        self.is_file = is_file
+        self.hierarcy = _path_hierarcy(os.path.dirname(sourcepath))
+
+
+def _members_string(members, separator=TAG_PATH_HIERARCY_SEPARATOR):
+    # The archive members of a tag, as a string that can be used in templates, like path.hierarcy_str
+    return ', '.join(member.replace('/', separator) for member in members)
+
+
+class TagRecord(Record):
+    __slots__ = ('name', 'param')
+    views = {
+        'name': lambda r: r.name,
+        'param': lambda r: r.param,
+        'as-folders': lambda r: _tag_variants((r.name, r.param))['as-folders'],
+    }
+
+    def __init__(self, name, param):
+        super().__init__()
+        self.name = name
+        self.param = param
+
+
+class TemplateView:
+    """
+    Read-only, lazy view of metadata used when formatting name-templates.
+
+    Works like the Box we used to make of all the metadata; both {path.basename} and {path[basename]}
+    works, and keys that doesnt exists becomes an empty string.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        try:
+            value = self._data[key]
+        except (KeyError, IndexError, TypeError):
+            return TemplateView({})
+
+        if isinstance(value, (dict, Record)):
+            return TemplateView(value)
+        return value
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return self[key]
+
+    def __format__(self, format_spec):
+        if not self._data:
+            return ''
+        data = self._data.as_dict() if isinstance(self._data, Record) else self._data
+        return format(str(data), format_spec)
+
+
 class Metadata:
     scopes = ['global', 'path', 'tag']
 
     def __init__(self):
-        self.data = {k: {} for k in self.scopes}
+        self.records = {k: Record() for k in self.scopes}
 
     def __repr__(self):
         from pprint import pformat
         return pformat(self.data, indent=2)
 
+    @property
+    def data(self):
+        # The full dict-view, needed by jmespath. Only made when asked for.
+        return {scope: record.as_dict() for scope, record in self.records.items()}
+
     def __getitem__(self, key):
-        return self.data[key]
+        return self.records[key]
 
     def find(self, key):
         for scope in self.scopes:
             try:
-                return self.data[scope][key]
+                return self.records[scope][key]
             except KeyError:
                 pass
         return None
 
-    def add(self, scope, name, value):
-        self.data[scope][name] = value
+    def set(self, scope, record):
+        self.records[scope] = record
+
+    def add(self, scope, name, value, view=None):
+        self.records[scope].add(name, value, view)
 
     def add_multiple(self, scope, data):
         if not data:
@@ -292,48 +456,7 @@ class Metadata:
             self.add(scope, name, value)
 
     def clear(self, scope):
-        self.data[scope] = {}
-
-
-def run(sourcepath, symlink_basepath, metadata=None, filters=None, nametemplate=None, auto_cleanup=False, dry=False, link_creator=None, tag_lookup=None):
-    # Will make metadata and filters available in global scope
-    configure(metadata=metadata or {}, filters=filters or {}, dry=dry)
-
-    symlink_basepath, sourcepath = _handle_paths(symlink_basepath, sourcepath)
-    metadata_store = Metadata()
-
-    if os.path.isdir(sourcepath):
-        # Start on top, and look recursive for everything below the start-directory
-        for dirpath, _, filenames in os.walk(sourcepath):
-            metadata_store.clear('path')
-
-            # FIXME, check if we can get this another way. It is populated inside make_symlink
-            if TAG_CHARACTER in os.path.dirname(dirpath):
-                make_symlink(symlink_basepath, dirpath, metadata_store=metadata_store, link_creator=link_creator)
-
-            for filename in filenames:
-                make_symlink(
-                    symlink_basepath,
-                    os.path.join(dirpath, filename),
-                    metadata_store=metadata_store,
-                    nametemplate=nametemplate,
-                    link_creator=link_creator,
-                    tag_lookup=tag_lookup
-                )
-    else:
-        # A parent folder can contain a TAG_CHARACTER, but we should ignore it,
-        # since it is not "us" (current file).
-        make_symlink(
-            symlink_basepath,
-            sourcepath,
-            metadata_store=metadata_store,
-            nametemplate=nametemplate,
-            link_creator=link_creator,
-            tag_lookup=tag_lookup
-        )
-
-    if auto_cleanup:
-        cleanup(sourcepath)
+        self.records[scope] = Record()
 
 
 def _nametemplate(nametemplate, is_file):
@@ -346,278 +469,1393 @@ def _nametemplate(nametemplate, is_file):
     return nametemplate
 
 
-def _symlink_paths(nametemplate, metadata, symlink_basepath):
+def _create_win_lnk(src, dst):
+    import win32com.client
+    shell = win32com.client.Dispatch('WScript.Shell')
+    shortcut = shell.CreateShortCut(f'{dst}.lnk')
+    shortcut.Targetpath = src
+    shortcut.save()
+
+
+def _create_hardlink(src, dst, extra):
+    if extra.get('target_is_directory'):
+        # Folders can't be hardlinked
+        return os.symlink(src, dst, target_is_directory=True)
+    os.link(extra['sourcepath'], dst)
+
+
+def _create_reflink(src, dst, extra):
+    if extra.get('target_is_directory'):
+        return os.symlink(src, dst, target_is_directory=True)
+
+    sourcepath = extra['sourcepath']
+    with open(sourcepath, 'rb') as src_fp, open(dst, 'xb') as dst_fp:
+        try:
+            import fcntl
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except (ImportError, OSError):
+            # Not supported by the os or filesystem, or src and dst are on different filesystems
+            shutil.copyfileobj(src_fp, dst_fp)
+    # Same mtime as the source, used to see that it is the same file the next time
+    shutil.copystat(sourcepath, dst)
+
+
+link_creators = {
+    'symlink': lambda src, dst, extra: os.symlink(
+        src, dst, target_is_directory=extra.get('target_is_directory', False), dir_fd=extra.get('dir_fd')
+    ),
+    'winlnk': lambda src, dst, extra: _create_win_lnk(extra['sourcepath'], dst),
+    'hardlink': _create_hardlink,
+    'reflink': _create_reflink,
+    # No links are made, they are written to a Manifest
+    'manifest': None,
+}
+
+
+def _stat_is(check, stat_func, path, dir_fd=None):
+    # Like os.path.isfile/islink, but can be relative to an open folder
     try:
-        relative_path = nametemplate.format_map(Box(metadata.data, default_box=True)).replace('{}', '').lstrip('/')
-    except KeyError as error:
-        log(
-            f'Invalid key in name-template ({nametemplate}) {error} while trying to make symlink.'
-            'Valid keys are, enable --verbose or --debug to see what keys you can use.',
-            loglevel='error', category='error-in-nametemplate',
-            data={
-                'nametemplate': nametemplate,
-                'metadata': metadata.data,
-                'error': error
+        return check(stat_func(path, dir_fd=dir_fd).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def _links_exists(links, executor, cache, size=CLEANUP_CACHE_SIZE):
+    # Check where the links points to, using a cache per folder they point into, so every destination is
+    # checked only once. Many links (one per tag) often points to the same file, and if the folder a link
+    # points into is gone, we know the link is dead without looking for the file itself.
+    # cache is an OrderedDict, only the size folders used last are kept.
+    destinations = {}
+    names = defaultdict(set)
+    for full_path, root in links:
+        symlink_destination = os.path.normpath(os.path.join(root, os.readlink(full_path)))
+        destinations[full_path] = symlink_destination
+        folder, name = os.path.split(symlink_destination)
+        names[folder].add(name)
+
+    # The folders are checked first, in the pool, so we don't need to look for the files in those that are gone
+    unknown = [folder for folder in names if folder not in cache]
+    for folder, exists in zip(unknown, executor.map(os.path.exists, unknown)):
+        cache[folder] = {} if exists else None
+
+    unknown = sorted(
+        (folder, name) for folder, folder_names in names.items() if cache[folder] is not None
+        for name in folder_names - cache[folder].keys()
+    )
+    for (folder, name), exists in zip(unknown, executor.map(lambda e: os.path.exists(os.path.join(*e)), unknown)):
+        cache[folder][name] = exists
+
+    results = []
+    for full_path, symlink_destination in destinations.items():
+        folder, name = os.path.split(symlink_destination)
+        results.append((full_path, symlink_destination, cache[folder] is not None and cache[folder][name]))
+
+    for folder in names:
+        cache.move_to_end(folder)
+    while len(cache) > size:
+        cache.popitem(last=False)
+    return results
+
+
+def _nametemplate_tag_prefixed(nametemplate):
+    # If every link starts with the tag as folders, we know where in dst the links for a tag lives,
+    # and dont have to look through all of it.
+    # Folders are always linked using the default template, which does.
+    template = _nametemplate(nametemplate, True)
+    return template.startswith(('{tag[as-folders]}/', '{tag.as-folders}/'))
+
+
+def _rename_dst_folders(dst_path, tags, nametemplate):
+    # Folders in dst that can contain links to the renamed files/folders.
+    if not _nametemplate_tag_prefixed(nametemplate):
+        return [dst_path]
+
+    folders = set()
+    for tag in tags:
+        folders.add(os.path.join(dst_path, _tag_variants((tag, ''))['as-folders']))
+
+    # No need to walk tag1/a if we are already walking tag1
+    return [
+        f for f in sorted(folders)
+        if not any(f.startswith(other + os.path.sep) for other in folders)
+    ]
+
+
+def _remove_empty_parents(path, stop):
+    # Removing links might leave tag-folders (and their parents) empty.
+    utils.remove_empty_folders(path)
+    path = os.path.dirname(path)
+    while path.startswith(stop + os.path.sep) and os.path.isdir(path) and not os.listdir(path):
+        logger.info("Removing empty folder: {}".format(path))
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
+
+def _check_renames(renames):
+    for original, new in renames.items():
+        original_tag = f"#{original}"
+        if not utils.fullmatch(hashtag_re, original_tag):
+            raise exceptions.Error(f"Invalid hashtag: '{original_tag}'")
+
+        new_tag = f"#{new}"
+        if not utils.fullmatch(hashtag_re, new_tag):
+            raise exceptions.Error(f"Invalid hashtag: '{new_tag}'")
+
+        if original_tag == new_tag:
+            raise exceptions.Error("There is no need to rename tag to the same...?")
+
+
+def _renamed_basename(basename, renames):
+    # Replace all the tags we should rename in one go, so a->b, b->c doesnt end up as a->c
+    def replace(match):
+        tag = match.group(1)
+        return f"{TAG_CHARACTER}{renames.get(tag, tag)}{match.group(0)[len(tag) + 1:]}"
+
+    return hashtag_re.sub(replace, basename)
+
+
+# A link we are about to make
+Link = namedtuple('Link', ['full_path', 'folder', 'destination', 'sourcepath', 'is_file'])
+
+# Where a run makes links, the engine with the nametemplate, filters and so on for it, and what it writes with
+Output = namedtuple('Output', ['engine', 'dst', 'dirs', 'writer', 'report'])
+
+
+class LinkWriter:
+    """
+    Writes links using a pool of threads, for dst's where every filesystem call is slow (like SMB).
+
+    Links are grouped by the folder they are in. Only one thread works on a folder at a time, making
+    the folder first and then its links in the order they came, so collisions are handled exactly as
+    when we write them one by one.
+    """
+
+    def __init__(self, engine, threads=LINK_THREADS, max_pending=None, dirs=None, on_events=None):
+        self.engine = engine
+        self.dirs = dirs
+        # Called with the events of every link written
+        self.on_events = on_events
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.error = None
+        # Dont let the walk get too far ahead of the writing
+        self.pending = threading.BoundedSemaphore(max_pending or threads * 64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, symlink_basepath, link):
+        if self.error:
+            raise self.error
+
+        self.pending.acquire()
+        with self.lock:
+            if link.folder in self.queues:
+                # Someone is already working on this folder, they will get to it
+                self.queues[link.folder].append((symlink_basepath, link))
+                return
+            self.queues[link.folder] = deque([(symlink_basepath, link)])
+
+        self.executor.submit(self._write_folder, link.folder)
+
+    def _write_folder(self, folder):
+        removed = False
+        try:
+            self.engine._make_folder(folder, self.dirs)
+
+            while True:
+                with self.lock:
+                    queue = self.queues[folder]
+                    if not queue:
+                        del self.queues[folder]
+                        removed = True
+                        return
+                    symlink_basepath, link = queue.popleft()
+
+                try:
+                    if not self.error:
+                        events = self.engine.write_link(symlink_basepath, link, self.dirs)
+                        if self.on_events:
+                            self.on_events(events)
+                finally:
+                    self.pending.release()
+        except Exception as e:
+            # Stops the run, it is raised from submit() or close()
+            self.error = self.error or e
+        finally:
+            if not removed:
+                # Drop what is left for the folder, or submit() would wait for it forever
+                with self.lock:
+                    dropped = self.queues.pop(folder)
+                for _ in dropped:
+                    self.pending.release()
+
+    def close(self):
+        # Waits for everything to be written
+        self.executor.shutdown(wait=True)
+        if self.error:
+            raise self.error
+
+
+class Manifest:
+    """
+    Writes the links to a file instead of making them, for tools that only needs to know what
+    the links would be. One json-list per line; [the link relative to dst, where it would point].
+    Nothing is checked against what is in dst, so if two links ends up with the same name, the
+    last one wins.
+    """
+
+    def __init__(self, path, dry=False, log=log):
+        self.path = path
+        self.log = log
+        self.lock = threading.Lock()
+        self.fp = None
+        if not dry:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fp = open(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, symlink_basepath, link):
+        relative_path = os.path.relpath(link.full_path, symlink_basepath)
+        if self.fp:
+            line = json.dumps([relative_path, link.destination], ensure_ascii=False, separators=(',', ':'))
+            with self.lock:
+                self.fp.write(line + '\n')
+
+        self.log(f'Listed {link.full_path} -> {link.destination}', loglevel='debug')
+        return [{
+            'category': 'made-symlink',
+            'sourcepath': link.sourcepath,
+            'symlink_full_path': link.full_path,
+            'symlink_destination': link.destination
+        }]
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+
+def _where_getter(key, plugins):
+    # Make a function that gets the value for key from Metadata.records, going directly to the
+    # attribute or plugin-value instead of making the full dict.
+    name, rest = key[0], key[1:]
+
+    if name == 'tag':
+        view = TagRecord.views.get(rest[0]) if len(rest) == 1 else None
+        if not view:
+            raise exceptions.Error(f"Invalid key in --where: {'.'.join(key)}")
+        return lambda records: view(records['tag'])
+
+    if name in plugins:
+        lookup = getattr(plugins[name], 'lookup', None)
+        expand = getattr(plugins[name], 'view', None)
+
+        def plugin_getter(records):
+            value = records['path'].extra[name][0]
+            if lookup:
+                return lookup(value, rest)
+            if expand:
+                value = expand(value)
+            for k in rest:
+                value = value[k]
+            return value
+        return plugin_getter
+
+    if any(name == metaname for _, metaname in available_metadata_addons):
+        raise exceptions.Error(f"--where on {'.'.join(key)} needs the metadata plugin {name}, add --metadata {name}")
+
+    view = PathRecord.views.get(name)
+    if view and not rest:
+        return lambda records: view(records['path'])
+
+    # Things like tags are added to the path later
+    def path_getter(records):
+        value = records['path'][name]
+        for k in rest:
+            value = value[k]
+        return value
+    return path_getter
+
+
+def _compile_where(where, plugins):
+    # Compile --where filters (key__op=value) into {when: [function(records) -> bool]}
+    compiled = defaultdict(list)
+
+    for group, entries in utils.make_filters(where, plugins).items():
+        for entry in entries:
+            getter = _where_getter(entry['key'], plugins)
+            when = group
+            if when == 'early' and (entry['key'][0] not in PathRecord.views or len(entry['key']) > 1):
+                when = 'late'
+
+            def check(records, getter=getter, func=entry['func'], value=entry['value']):
+                try:
+                    return func(getter(records), value)
+                except (KeyError, IndexError, TypeError, AttributeError, ValueError):
+                    return False
+
+            compiled[when].append(check)
+
+    return dict(compiled)
+
+
+class Taggo:
+    """
+    Holds everything a run needs; config, compiled filters and the metadata plugins.
+
+    Nothing is changed on the object while it is running, so the same Taggo can be used for many
+    src/dst jobs, also at the same time from different threads. Errors are raised as
+    exceptions.Error (with an exit_code the cli uses) instead of exiting.
+    """
+
+    def __init__(self, *, metadata=None, filters=None, nametemplate=None, collision_rule=None,
+                 link_creator=None, tag_lookup=None, dry=False, where=None, exclude=None, include=None,
+                 ignore_file=IGNORE_FILE_NAME, link_threads=1, dir_fds=True, tag_cache=None, shard=None,
+                 shard_depth=1, profiles=None, json_output=False):
+        self.metadata = metadata or {}
+        self.nametemplate = nametemplate
+        self.collision_rule = collision_rule
+        # tag_cache is where tag-lookups are cached between runs, None for the default and False for no cache
+        self.tag_lookup = lookups.Lookups(tag_lookup, cache_path=tag_cache)
+        self.dry = dry
+        self.json_output = json_output
+        self.link_threads = link_threads or 1
+
+        self.link_kind = link_creator or 'symlink'
+        try:
+            self.link_creator = link_creators[self.link_kind]
+        except KeyError:
+            raise exceptions.Error(f"Unknown link-creator: {link_creator}")
+
+        # shard is (K, N), only doing part K of N of src. The other parts are done by other runs, into the same dst.
+        self.shard = shards.Shard(*shard, depth=shard_depth) if shard else None
+        if self.shard and self.link_creator is None:
+            raise exceptions.Error("Shards can't share a manifest, use a link-creator that makes links")
+
+        # Keep dst folders open, and make links relative to them, if we can
+        self.dir_fds = dir_fds and dirfd.supported and not dry and self.link_kind == 'symlink'
+
+        self.filters = {}
+        for when, queries in (filters or {}).items():
+            try:
+                self.filters[when] = [jmespath.compile(q) for q in queries]
+            except jmespath.exceptions.ParseError as e:
+                raise exceptions.Error(f"Invalid filter: {e}")
+
+        # Plugins are imported once, in the order they should run
+        self.plugins = []
+        for num, metaname in available_metadata_addons:
+            if metaname in self.metadata:
+                module = importlib.import_module(f'.metadata.{num}_{metaname}', package='taggo')
+                self.plugins.append((metaname, module))
+
+        self.where = _compile_where(where or [], dict(self.plugins))
+        self.ignore = ignore.Rules.from_options(excludes=exclude, includes=include)
+        self.ignore_file = ignore_file
+
+        # Profiles are more views of the same files. Each has its own dst (relative to the dst of the run), and
+        # can have its own nametemplate, filters, where, collision_rule and link_creator, else ours are used.
+        # The files are walked, and their metadata and tags are found, once for all of them.
+        self.profiles = []
+        for profile in profiles or []:
+            options = {
+                'nametemplate': nametemplate, 'filters': filters, 'where': where,
+                'collision_rule': collision_rule, 'link_creator': link_creator
             }
+            profile = dict(profile)
+            dst = profile.pop('dst', None)
+            if not dst:
+                raise exceptions.Error("Every profile needs a dst")
+            unknown = profile.keys() - options.keys()
+            if unknown:
+                raise exceptions.Error(f"Unknown options in profile '{dst}': {', '.join(sorted(unknown))}")
+            options.update(profile)
+
+            engine = Taggo(
+                metadata=self.metadata, dry=dry, link_threads=link_threads, dir_fds=dir_fds, tag_cache=False,
+                shard=shard, shard_depth=shard_depth, json_output=json_output, **options
+            )
+            self.profiles.append((dst, engine))
+
+        if len({os.path.normpath(dst) for dst, _ in self.profiles}) < len(self.profiles):
+            raise exceptions.Error("Every profile needs its own dst")
+        if self.profiles:
+            # The filters are checked by the profiles
+            self.filters, self.where = {}, {}
+
+    def log(self, text, loglevel='info', category='general', data=None):
+        log(text, loglevel=loglevel, category=category, data=data, json_output=self.json_output)
+
+    def _handle_paths(self, symlink_basepath, sourcepaths):
+        # sourcepaths is one path, or a list of them. Returns dst and a list of the sources.
+        symlink_basepath = os.path.abspath(symlink_basepath)
+        self.log(f"Using symlink_basepath: {symlink_basepath}", loglevel='verbose')
+        if isinstance(sourcepaths, (str, os.PathLike)):
+            sourcepaths = [sourcepaths]
+
+        found = []
+        for sourcepath in dict.fromkeys(os.path.abspath(s) for s in sourcepaths):
+            self.log(f"Using sourcepath: {sourcepath}", loglevel='verbose')
+            if not os.path.exists(sourcepath):
+                raise exceptions.NotFoundException(f"Unable to find sourcepath: {sourcepath}")
+            found.append(sourcepath)
+
+        # A src inside another one is walked as part of it
+        return symlink_basepath, [
+            s for s in found
+            if not any(s.startswith(other + os.path.sep) for other in found if os.path.isdir(other))
+        ]
+
+    def _log_rename(self, old, new):
+        self.log(f"Renaming: {os.path.dirname(old)}{os.path.sep}{{{os.path.basename(old)} -> {os.path.basename(new)}}}")
+
+    def run(self, sourcepath, symlink_basepath, auto_cleanup=False):
+        # sourcepath can also be a list of sources. They share the plugins, the dst folders we keep open and
+        # the link writer, and dst is only cleaned up once.
+        if auto_cleanup and self.shard:
+            raise exceptions.Error("auto-cleanup can't be used with shards, the others might not be done. Use merge")
+
+        symlink_basepath, sourcepaths = self._handle_paths(symlink_basepath, sourcepath)
+        metadata_store = Metadata()
+        plugin_state, folders = self._prepare_plugins(sourcepaths, symlink_basepath)
+        outputs = self._open_outputs(symlink_basepath)
+        finished = False
+
+        try:
+            for paths in folders:
+                metadata_store.clear('path')
+                for path in paths:
+                    self._link_path(outputs, path, metadata_store=metadata_store, plugin_state=plugin_state)
+            finished = True
+        finally:
+            self._close_outputs(outputs, finished)
+
+        if auto_cleanup:
+            for output in outputs:
+                self.cleanup(output.dst)
+
+    def _open_outputs(self, symlink_basepath, threads=None):
+        # Where the links are made; dst and what we use to write there, for us or for each of the profiles
+        if self.profiles:
+            profiles = [(engine, os.path.join(symlink_basepath, dst)) for dst, engine in self.profiles]
+        else:
+            profiles = [(self, symlink_basepath)]
+
+        outputs = []
+        for engine, dst in profiles:
+            dirs = dirfd.DirFds() if engine.dir_fds else None
+            report = engine._report(dst)
+            writer = engine._writer(dst, dirs, threads=threads, report=report)
+            outputs.append(Output(engine, dst, dirs, writer, report))
+        return outputs
+
+    def _close_outputs(self, outputs, finished):
+        # Everything is closed, even if one of them fails
+        error = None
+        for output in outputs:
+            try:
+                try:
+                    if output.writer:
+                        output.writer.close()
+                    # Only a shard that got all the way through is marked as done
+                    if output.report and finished:
+                        output.report.done()
+                finally:
+                    if output.dirs:
+                        output.dirs.close()
+                    if output.report:
+                        output.report.close()
+            except Exception as e:
+                error = error or e
+        # With dry, nothing is written, not even the tag-lookup cache
+        if not self.dry:
+            self.tag_lookup.save()
+
+        if error:
+            raise error
+
+    def _link_path(self, outputs, sourcepath, metadata_store=None, plugin_state=None):
+        if not self.profiles:
+            output = outputs[0]
+            events = self.make_symlink(
+                output.dst, sourcepath,
+                metadata_store=metadata_store, plugin_state=plugin_state, writer=output.writer, dirs=output.dirs
+            )
+            if output.report:
+                output.report.add(events)
+            return events
+
+        # The metadata and tags are found once, and every profile that wants the file links it
+        metadata_store = metadata_store or Metadata()
+        is_file = os.path.isfile(sourcepath)
+        metadata_store.set('path', PathRecord(sourcepath, is_file))
+        if is_file:
+            self._handle_file_metadata(sourcepath, metadata_store, plugin_state)
+
+        members = {}
+        tags = find_tags(metadata_store['path'], tag_lookup=self.tag_lookup, is_file=is_file, members=members)
+        if not tags:
+            self.log(f'  * skipping, found no tags', loglevel='debug')
+            return [{'category': 'skipped', 'sourcepath': sourcepath, 'reason': 'no-tags'}]
+        metadata_store.add('path', 'tags', tags)
+
+        events = []
+        for output in outputs:
+            engine = output.engine
+            if sourcepath.startswith(output.dst):
+                events.append({'category': 'skipped', 'sourcepath': sourcepath, 'reason': 'in-destination'})
+                continue
+
+            if is_file:
+                try:
+                    engine._check_filter('early', metadata_store)
+                    for metaname, _ in engine.plugins:
+                        engine._check_filter(f'after-{metaname}', metadata_store)
+                except SkipFile:
+                    self.log(f'  * skipping for {output.dst}, filter didnt match', loglevel='verbose')
+                    events.append({'category': 'skipped', 'sourcepath': sourcepath, 'reason': 'filter'})
+                    continue
+
+            link_events = engine._make_links(
+                output.dst, sourcepath, is_file, tags, members, metadata_store, output.writer, output.dirs
+            )
+            if output.report:
+                output.report.add(link_events)
+            events += link_events
+        return events
+
+    def _writer(self, symlink_basepath, dirs=None, threads=None, report=None):
+        # What make_symlink gives the links to, if they are not made right away
+        if self.link_creator is None:
+            return Manifest(os.path.join(symlink_basepath, MANIFEST_NAME), self.dry, log=self.log)
+        threads = threads or self.link_threads
+        if threads > 1:
+            return LinkWriter(self, threads, dirs=dirs, on_events=report.add if report else None)
+        return None
+
+    def _report(self, symlink_basepath):
+        # Shards writes the collisions they see to dst, for merge
+        if not self.shard:
+            return None
+        return shards.Report(symlink_basepath, self.shard, self.collision_rule, self.dry)
+
+    def _prepare_plugins(self, sourcepaths, symlink_basepath):
+        # Some plugins (like duplicates) needs to know about all the files before they can say
+        # anything about one of them. They get a list of all files first, and what their
+        # prepare() returns is given to their run() for each file.
+        # Plugins with a setup() instead, only needs their options, and not the list of files.
+        # Returns the plugin state, and the paths to link, one list per folder. If a plugin needed the
+        # files, they are what was walked for it, so src is only walked once.
+        plugin_state = self._setup_plugins()
+        folders = self._walk_sources(sourcepaths, symlink_basepath)
+        if not any(hasattr(mod, 'prepare') for _, mod in self.plugins):
+            return plugin_state, folders
+
+        folders = list(folders)
+        self._prepare(plugin_state, [path for paths in folders for path in paths])
+        return plugin_state, folders
+
+    def _setup_plugins(self):
+        plugin_state = {}
+        for metaname, mod in self.plugins:
+            if hasattr(mod, 'setup'):
+                self.log(f'Setting up metadata plugin {metaname}', loglevel='verbose')
+                plugin_state[metaname] = mod.setup(self.metadata[metaname])
+        return plugin_state
+
+    def _prepare(self, plugin_state, filepaths):
+        for metaname, mod in self.plugins:
+            if not hasattr(mod, 'prepare'):
+                continue
+            self.log(f'Preparing metadata plugin {metaname} with {len(filepaths)} paths', loglevel='verbose')
+            # With dry, prepare must not write anything either (like a cache)
+            plugin_state[metaname] = mod.prepare(filepaths, self.metadata[metaname], dry=self.dry)
+
+    def _walk_sources(self, sourcepaths, symlink_basepath):
+        # The paths to link in all of the sources, one list per folder
+        for sourcepath in sourcepaths:
+            if os.path.isdir(sourcepath):
+                yield from self._walk(sourcepath, symlink_basepath)
+            else:
+                # A parent folder can contain a TAG_CHARACTER, but we should ignore it,
+                # since it is not "us" (current file).
+                yield [sourcepath]
+
+    def _walk(self, sourcepath, symlink_basepath):
+        # Start on top, and look recursive for everything below the start-directory.
+        # Yields a list of paths to link for each folder. Excluded folders, and dst if it is
+        # inside src, are removed before os.walk goes into them, so they are never listed.
+        rules = {sourcepath: self.ignore}
+
+        for dirpath, dirnames, filenames in os.walk(sourcepath):
+            dir_rules = rules.pop(dirpath, self.ignore)
+            if self.ignore_file in filenames:
+                dir_rules = dir_rules.with_file(
+                    os.path.join(dirpath, self.ignore_file), ignore.relative(dirpath, sourcepath)
+                )
+
+            if dir_rules or symlink_basepath.startswith(dirpath):
+                prefix = ignore.relative(dirpath, sourcepath)
+                prefix = '' if not prefix else prefix + '/'
+
+                keep = []
+                for d in dirnames:
+                    full_path = os.path.join(dirpath, d)
+                    if full_path == symlink_basepath:
+                        self.log(f'  * skipping {full_path}, it is the destination directory', loglevel='debug')
+                        continue
+                    if dir_rules.excluded(prefix + d, d, True):
+                        self.log(f'  * skipping {full_path}, excluded', loglevel='debug')
+                        continue
+                    keep.append(d)
+                dirnames[:] = keep
+
+                if dir_rules:
+                    filenames = [f for f in filenames if not dir_rules.excluded(prefix + f, f, False)]
+
+            folder_in_shard = True
+            if self.shard:
+                folder = ignore.relative(dirpath, sourcepath)
+                dirnames[:], filenames = self.shard.walk_filter(folder, dirnames, filenames)
+                folder_in_shard = folder in self.shard
+
+            for d in dirnames:
+                rules[os.path.join(dirpath, d)] = dir_rules
+
+            paths = [os.path.join(dirpath, f) for f in filenames]
+
+            # FIXME, check if we can get this another way. It is populated inside make_symlink
+            if TAG_CHARACTER in os.path.dirname(dirpath) and folder_in_shard:
+                paths.insert(0, dirpath)
+
+            yield paths
+
+    def _walked(self, sourcepath, symlink_basepath, path, rules):
+        # If _walk would yield path. The same checks are done on each folder on the way down to it (dst,
+        # ignore rules and shards), without listing any of them. rules has the rules of the folders seen.
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        if is_dir and TAG_CHARACTER not in os.path.dirname(path):
+            return False
+
+        dirpath = sourcepath
+        parts = ignore.relative(path, sourcepath).split('/')
+        for num, name in enumerate(parts):
+            name_is_dir = is_dir or num < len(parts) - 1
+            full_path = os.path.join(dirpath, name)
+            if name_is_dir and full_path == symlink_basepath:
+                return False
+
+            prefix = ignore.relative(dirpath, sourcepath)
+            relative_path = f'{prefix}/{name}' if prefix else name
+            if self._dir_rules(sourcepath, dirpath, rules).excluded(relative_path, name, name_is_dir):
+                return False
+
+            if self.shard:
+                dirnames, filenames = ([name], []) if name_is_dir else ([], [name])
+                dirnames, filenames = self.shard.walk_filter(prefix, dirnames, filenames)
+                if not dirnames and not filenames:
+                    return False
+            dirpath = full_path
+
+        return not is_dir or not self.shard or ignore.relative(path, sourcepath) in self.shard
+
+    def _dir_rules(self, sourcepath, dirpath, rules):
+        # The ignore rules _walk uses in dirpath; the ones of its parent, and its own ignore-file
+        if dirpath not in rules:
+            if dirpath == sourcepath:
+                dir_rules = self.ignore
+            else:
+                dir_rules = self._dir_rules(sourcepath, os.path.dirname(dirpath), rules)
+            ignore_path = os.path.join(dirpath, self.ignore_file) if self.ignore_file else None
+            if ignore_path and os.path.isfile(ignore_path):
+                dir_rules = dir_rules.with_file(ignore_path, ignore.relative(dirpath, sourcepath))
+            rules[dirpath] = dir_rules
+        return rules[dirpath]
+
+    async def arun(self, sourcepath, symlink_basepath, concurrency=ARUN_CONCURRENCY, executor=None):
+        """
+        Same as run(), but as an async generator yielding the events from every file as they are done.
+
+        The walk and all the file-work is done in executor (the loops default if None), with at most
+        concurrency files worked on at the same time.
+
+            async for event in engine.arun(src, dst):
+                print(event['category'], event['sourcepath'])
+        """
+        # get_running_loop() needs python 3.7, inside a coroutine this is the same loop
+        loop = asyncio.get_event_loop()
+        symlink_basepath, sourcepaths = await loop.run_in_executor(
+            executor, self._handle_paths, symlink_basepath, sourcepath
+        )
+
+        plugin_state, folders = await loop.run_in_executor(
+            executor, self._prepare_plugins, sourcepaths, symlink_basepath
         )
-        sys.exit(3)
+        # Links are made right away in the executor's threads, so no LinkWriter threads are started
+        outputs = await loop.run_in_executor(executor, self._open_outputs, symlink_basepath, 1)
+        finished = False
+
+        def make_symlink(path):
+            return self._link_path(outputs, path, plugin_state=plugin_state)
+
+        pending = set()
+
+        async def done():
+            nonlocal pending
+            completed, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            events = []
+            for future in completed:
+                events += future.result()
+            return events
+
+        try:
+            walker = iter(folders)
+            while True:
+                paths = await loop.run_in_executor(executor, next, walker, None)
+                if paths is None:
+                    break
+
+                for path in paths:
+                    if len(pending) >= concurrency:
+                        for event in await done():
+                            yield event
+                    pending.add(loop.run_in_executor(executor, make_symlink, path))
+
+            while pending:
+                for event in await done():
+                    yield event
+            finished = True
+        finally:
+            if pending:
+                await asyncio.wait(pending)
+            # Closing writes the manifest, shard reports and the tag-lookup cache
+            await loop.run_in_executor(executor, self._close_outputs, outputs, finished)
+
+    def _check_filter(self, group, metadata_store):
+        # The --where filters are quick, so we check them first
+        for check in self.where.get(group, []):
+            if not check(metadata_store.records):
+                raise SkipFile
+
+        filters = self.filters.get(group, [])
+        if filters:
+            # data is made on every access, so only once for all the filters
+            data = metadata_store.data
+            for f in filters:
+                if not f.search(data):
+                    raise SkipFile
+
+    def _handle_file_metadata(self, sourcepath, metadata_store, plugin_state=None):
+        if not self.plugins:
+            self.log(f'  * metadata unset', loglevel='debug')
+            return
+
+        self.log(f'  * metadata is {self.metadata}', loglevel='debug')
+
+        for metaname, mod in self.plugins:
+            self.log(f'  * metadata-check: {metaname}', loglevel='debug')
+            # A plugin can use what plugins that ran before it found (listed in its `uses`), instead of
+            # reading the file again. They are given to run() by name, if they are enabled.
+            path_record = metadata_store['path']
+            used = {name: path_record[name] for name in getattr(mod, 'uses', ()) if name in path_record}
+            if plugin_state and metaname in plugin_state:
+                value = mod.run(sourcepath, plugin_state[metaname], **used)
+            else:
+                value = mod.run(sourcepath, **used)
+            metadata_store.add('path', metaname, value, getattr(mod, 'view', None))
+            self._check_filter(f'after-{metaname}', metadata_store)
+
+    def _nametemplate(self, is_file):
+        # Folders are linked using the default template, unless a folder-template is set
+        if not is_file and not isinstance(self.nametemplate, dict):
+            return DEFAULT_NAMETEMPLATE
+        return _nametemplate(self.nametemplate, is_file)
+
+    def _symlink_paths(self, nametemplate, metadata, symlink_basepath):
+        try:
+            relative_path = nametemplate.format_map(TemplateView(metadata.records)).replace('{}', '').lstrip('/')
+        except KeyError as error:
+            self.log(
+                f'Invalid key in name-template ({nametemplate}) {error} while trying to make symlink.'
+                'Valid keys are, enable --verbose or --debug to see what keys you can use.',
+                loglevel='error', category='error-in-nametemplate',
+                data={
+                    'nametemplate': nametemplate,
+                    'metadata': metadata.data,
+                    'error': error
+                }
+            )
+            raise exceptions.NametemplateException(f"Invalid key in name-template ({nametemplate}) {error}")
+
+        full_path = os.path.join(symlink_basepath, relative_path)
+        symlink_folder = os.path.dirname(full_path)
+
+        return full_path, symlink_folder
 
-    full_path = os.path.join(symlink_basepath, relative_path)
-    symlink_folder = os.path.dirname(full_path)
+    def _make_folder(self, symlink_folder, dirs=None):
+        if self.dry:
+            return
 
-    if not _dry:
         try:
-            os.makedirs(symlink_folder, exist_ok=True)
+            if dirs:
+                dirs.get(symlink_folder, create=True)
+            else:
+                os.makedirs(symlink_folder, exist_ok=True)
         except NotADirectoryError:
-            log(
+            self.log(
                 f'dst exist but is not a folder. Cant continue',
                 loglevel='error', category='dst-folder-is-file',
                 data={
                     'symlink_folder': symlink_folder
                 }
             )
-            sys.exit(5)
+            raise exceptions.DstNotFolderException(f"dst exist but is not a folder: {symlink_folder}")
 
-    return full_path, symlink_folder
+    def _collision_handler(self, symlink_full_path, symlink_basepath, symlink_destination, dir_fd=None,
+                           sourcepath=None):
+        # With a dir_fd, the link is looked up by its name in that folder
+        path = os.path.basename(symlink_full_path) if dir_fd is not None else symlink_full_path
+        rule = self.collision_rule
+        should_overwrite = True
+        symlinkpath_exists = False
 
+        if _stat_is(stat_module.S_ISREG, os.stat, path, dir_fd):
+            symlinkpath_exists = True
 
-def _collision_handler(rule, symlink_full_path, symlink_basepath, symlink_destination):
-    should_overwrite = True
-    symlinkpath_exists = False
+        is_symlink = symlinkpath_exists and _stat_is(stat_module.S_ISLNK, os.lstat, path, dir_fd)
+        # Hardlinks and reflinks are files, so with them a file in dst is one of our links
+        is_copy = symlinkpath_exists and not is_symlink and self.link_kind in ('hardlink', 'reflink')
 
-    if os.path.isfile(symlink_full_path):
-        symlinkpath_exists = True
+        if rule in ["smart", "overwrite-if-symlink"]:
+            if symlinkpath_exists and not is_symlink and not is_copy:
+                should_overwrite = False
 
-    if rule in ["smart", "overwrite-if-symlink"]:
-        if symlinkpath_exists:
-            if not os.path.islink(symlink_full_path):
+        if rule in ["smart", "overwrite-if-dst-same"]:
+            if not symlink_full_path.startswith(symlink_basepath):
                 should_overwrite = False
 
-    if rule in ["smart", "overwrite-if-dst-same"]:
-        if not symlink_full_path.startswith(symlink_basepath):
+        if rule == "no-overwrite":
             should_overwrite = False
 
-    if rule == "no-overwrite":
-        should_overwrite = False
+        if symlinkpath_exists:
+            existing_symlink_destination = None
+            existing_mtime = None
+            if is_symlink:
+                existing_symlink_destination = os.readlink(path, dir_fd=dir_fd)
+                # Shards uses this to know if the link was made by another shard, or in an earlier run
+                existing_mtime = os.lstat(path, dir_fd=dir_fd).st_mtime_ns
+
+                if symlink_destination == existing_symlink_destination:
+                    # Don't bother
+                    raise SkipFile('A symlink like this exists')
+
+                message = (
+                    f'Link ({symlink_full_path}) points to ({existing_symlink_destination}), '
+                    f'we want ({symlink_destination})'
+                )
+            elif is_copy:
+                difference = self._copy_difference(path, sourcepath, dir_fd)
+                if difference is None:
+                    raise SkipFile('A link like this exists')
+
+                message = f'Link ({symlink_full_path}) is not a {self.link_kind} of ({sourcepath}), {difference}'
+            else:
+                message = f'Link ({symlink_full_path}) is a file, we want ({symlink_destination})'
+
+            self.log(
+                message,
+                loglevel='error', category='collision',
+                data={
+                    'symlink_full_path': symlink_full_path,
+                    'existing_symlink_destination': existing_symlink_destination,
+                    'symlink_destination': symlink_destination
+                }
+            )
+
+            if rule == "bail-if-different":
+                raise exceptions.CollisionException(f"Link ({symlink_full_path}) points to somewhere else")
 
-    if symlinkpath_exists:
-        existing_symlink_destination = os.readlink(symlink_full_path)
-        if symlink_destination == existing_symlink_destination:
-            # Don't bother
-            raise SkipFile('A symlink like this exists')
+        if symlinkpath_exists and should_overwrite:
+            if not self.dry:
+                os.unlink(path, dir_fd=dir_fd)
 
-        log(
-            f'Link ({symlink_full_path}) points to ({existing_symlink_destination}), we want ({symlink_destination})',
-            loglevel='error', category='collision',
-            data={
+        if symlinkpath_exists:
+            return {
+                'category': 'collision',
                 'symlink_full_path': symlink_full_path,
                 'existing_symlink_destination': existing_symlink_destination,
-                'symlink_destination': symlink_destination
+                'existing_mtime': existing_mtime,
+                'symlink_destination': symlink_destination,
+                'overwritten': should_overwrite
             }
-        )
-
-        if rule == "bail-if-different":
-            sys.exit(20)
-
-    if symlinkpath_exists and should_overwrite:
-        if not _dry:
-            os.remove(symlink_full_path)
-
-    return True
 
+    def _copy_difference(self, path, sourcepath, dir_fd=None):
+        # Hardlinks and reflinks can't be asked where they point. Returns None if the file is a
+        # link to sourcepath, else how it differs.
+        try:
+            existing = os.stat(path, dir_fd=dir_fd)
+            source = os.stat(sourcepath)
+        except OSError as e:
+            return str(e)
 
-def _handle_file_metadata(sourcepath, metadata_store):
-    metadata_store.add('path', 'sourcepath', sourcepath)
-    metadata_store.add('path', 'file-ext', sourcepath.split('.')[-1])
+        if self.link_kind == 'hardlink':
+            if (existing.st_dev, existing.st_ino) != (source.st_dev, source.st_ino):
+                return f'it has inode {existing.st_ino}, the source has {source.st_ino}'
+        elif (existing.st_size, existing.st_mtime_ns) != (source.st_size, source.st_mtime_ns):
+            return f'it has mtime {existing.st_mtime_ns}, the source has {source.st_mtime_ns}'
+        return None
 
-    if not _metadata:
-        log(f'  * metadata unset', loglevel='debug')
-        return
+    def make_symlink(self, symlink_basepath, sourcepath, *, metadata_store=None, plugin_state=None, writer=None,
+                     dirs=None):
+        # Returns a list of events (dicts, with a category) about what happened to sourcepath.
+        # If a LinkWriter is given, the links are written by it, and their events are not included.
+        # A Manifest gives back the events right away.
+        metadata_store = metadata_store or Metadata()
+        events = []
 
-    log(f'  * _metadata is {_metadata}', loglevel='debug')
+        def skipped(reason):
+            events.append({'category': 'skipped', 'sourcepath': sourcepath, 'reason': reason})
+            return events
 
-    for num, metaname in available_metadata_addons:
-        if metaname not in _metadata:
-            continue
+        if sourcepath.startswith(symlink_basepath):
+            self.log(f'  * skipping, symlink is already in the destination directory', loglevel='debug')
+            return skipped('in-destination')
 
-        log(f'  * metadata-check: {metaname}', loglevel='debug')
-        module = f'{num}_{metaname}'
-        mod = importlib.import_module(f'.metadata.{module}', package='taggo')
-        metadata_store.add('path', metaname, mod.run(sourcepath))
-        _check_filter(f'after-{metaname}', metadata_store)
+        is_file = os.path.isfile(sourcepath)
 
-def _create_win_lnk(src, dst):
-    import win32com.client
-    shell = win32com.client.Dispatch('WScript.Shell')
-    shortcut = shell.CreateShortCut(f'{dst}.lnk')
-    shortcut.Targetpath = src
-    shortcut.save()
+        metadata_store.set('path', PathRecord(sourcepath, is_file))
 
-def make_symlink(symlink_basepath, sourcepath, *, nametemplate=None, metadata_store=None, collision_rule=None, link_creator=None, tag_lookup=None):
-    link_creator_func = {
-        'symlink': lambda src, dst, extra: os.symlink(src, dst, target_is_directory=extra.get('target_is_directory', False)),
-        'winlnk': lambda src, dst, extra: _create_win_lnk(extra['metadata']['path']['sourcepath'], dst)
-    }.get(link_creator or 'symlink')
+        if is_file:
+            try:
+                self.log(f'  * is_file', loglevel='debug')
+                self.log(f'  * checking metadata now', loglevel='debug')
+                self._check_filter('early', metadata_store)
+                self._handle_file_metadata(sourcepath, metadata_store, plugin_state)
+            except SkipFile:
+                self.log(f'  * skipping, filter didnt match', loglevel='verbose')
+                if logger.isEnabledFor(logging.DEBUG):
+                    self.log(metadata_store.data, loglevel='debug')
+                return skipped('filter')
+
+        members = {}
+        tags = find_tags(metadata_store['path'], tag_lookup=self.tag_lookup, is_file=is_file, members=members)
+        if not tags:
+            self.log(f'  * skipping, found no tags', loglevel='debug')
+            return skipped('no-tags')
+
+        metadata_store.add('path', 'tags', tags)
+        self.log(f'  * found tags: {tags}', loglevel='debug')
+
+        return self._make_links(symlink_basepath, sourcepath, is_file, tags, members, metadata_store, writer, dirs)
+
+    def _make_links(self, symlink_basepath, sourcepath, is_file, tags, members, metadata_store, writer=None,
+                    dirs=None):
+        # One link for each tag that gets past the late filters
+        events = []
+        nametemplate = self._nametemplate(is_file)
+        for tagset in tags.items():
+            self.log(f'doing {tagset}', loglevel='debug')
+            tag_record = TagRecord(*tagset)
+            if tagset[0] in members:
+                # The archive members it was found in
+                tag_record.add('members', members[tagset[0]])
+                tag_record.add('members_str', _members_string(members[tagset[0]]))
+            metadata_store.set('tag', tag_record)
 
-    metadata_store = metadata_store or Metadata()
+            try:
+                self._check_filter('late', metadata_store)
+            except SkipFile:
+                self.log(f'  * skipping, filter didnt match', loglevel='debug')
+                events.append({'category': 'skipped', 'sourcepath': sourcepath, 'reason': 'filter'})
+                continue
 
-    if sourcepath.startswith(symlink_basepath):
-        log(f'  * skipping, symlink is already in the destination directory', loglevel='debug')
-        return
+            symlink_full_path, symlink_folder = self._symlink_paths(nametemplate, metadata_store, symlink_basepath)
+            symlink_destination = _symlink_destination(sourcepath, symlink_folder)
 
-    is_file = os.path.isfile(sourcepath)
+            if logger.isEnabledFor(logging.DEBUG):
+                self.log(f'  * metadata_store: {metadata_store.data}', loglevel='debug')
+            self.log(f'  * should create:', loglevel='debug')
+            self.log(f'    * symlink: {symlink_full_path}', loglevel='debug')
+            self.log(f'    * destination: {symlink_destination}', loglevel='debug')
 
-    metadata_store.add_multiple('path', _path_variants(os.path.dirname(sourcepath)))
-    metadata_store.add('path', 'hierarcy_str', _path_hierarcy_string(metadata_store['path'].get('hierarcy'), is_file))
-    metadata_store.add('path', 'basename', os.path.basename(sourcepath))
+            link = Link(symlink_full_path, symlink_folder, symlink_destination, sourcepath, is_file)
+            if writer:
+                events += writer.submit(symlink_basepath, link) or []
+            else:
+                self._make_folder(symlink_folder, dirs)
+                events += self.write_link(symlink_basepath, link, dirs)
 
-    if is_file:
-        try:
-            log(f'  * is_file', loglevel='debug')
-            log(f'  * checking metadata now', loglevel='debug')
-            _check_filter('early', metadata_store)
-            _handle_file_metadata(sourcepath, metadata_store)
-        except SkipFile:
-            log(f'  * skipping, filter didnt match', loglevel='verbose')
-            log(metadata_store.data, loglevel='debug')
-            return
+        return events
 
-    tags = find_tags(metadata_store['path'], tag_lookup=tag_lookup, is_file=is_file)
-    if not tags:
-        log(f'  * skipping, found no tags', loglevel='debug')
-        return
+    def write_link(self, symlink_basepath, link, dirs=None):
+        # Handles collisions and makes the link. The folder it is in must exist.
+        events = []
+        dir_fd = dirs.get(link.folder) if dirs else None
 
-    metadata_store.add('path', 'tags', tags)
-    log(f'  * found tags: {tags}', loglevel='debug')
+        for attempt in range(2):
+            try:
+                collision = self._collision_handler(
+                    link.full_path, symlink_basepath, link.destination, dir_fd, sourcepath=link.sourcepath
+                )
+            except SkipFile as reason:
+                self.log(f'  * skipping: {reason}', loglevel='debug')
+                return events + [{'category': 'skipped', 'sourcepath': link.sourcepath, 'reason': str(reason)}]
 
-    for tagset in tags.items():
-        log(f'doing {tagset}', loglevel='debug')
-        metadata_store.clear('tag')
-        metadata_store.add_multiple('tag', _tag_variants(tagset))
-        nametemplate = _nametemplate(nametemplate, is_file)
-        symlink_full_path, symlink_folder = _symlink_paths(nametemplate, metadata_store, symlink_basepath)
-        symlink_destination = os.path.relpath(sourcepath, symlink_folder)
+            if collision:
+                collision['sourcepath'] = link.sourcepath
+                events.append(collision)
+                if not collision['overwritten']:
+                    # The link we have is kept, so there is nothing to make
+                    return events
 
-        log(f'  * metadata_store: {metadata_store.data}', loglevel='debug')
-        log(f'  * should create:', loglevel='debug')
-        log(f'    * symlink: {symlink_full_path}', loglevel='debug')
-        log(f'    * destination: {symlink_destination}', loglevel='debug')
+            try:
+                if not self.dry:
+                    dst = link.full_path if dir_fd is None else os.path.basename(link.full_path)
+                    self.link_creator(link.destination, dst, {
+                        'target_is_directory': not link.is_file,
+                        'sourcepath': link.sourcepath,
+                        'dir_fd': dir_fd
+                    })
+            except FileExistsError as e:
+                if attempt == 0:
+                    # Made by someone else (like another shard) after we looked, so it is a collision after all
+                    continue
+                error = e
+            except OSError as e:
+                error = e
+            else:
+                error = None
+            break
+
+        if error is None:
+            self.log(
+                f'Made {link.full_path} -> {link.destination}',
+                loglevel='info', category='made-symlink',
+                data={
+                    'symlink_full_path': link.full_path,
+                    'symlink_destination': link.destination
+                }
+            )
+            events.append({
+                'category': 'made-symlink',
+                'sourcepath': link.sourcepath,
+                'symlink_full_path': link.full_path,
+                'symlink_destination': link.destination
+            })
+        else:
+            self.log(f'  * OSError while creating symlink: {error}', loglevel='debug')
+            events.append({
+                'category': 'error',
+                'sourcepath': link.sourcepath,
+                'symlink_full_path': link.full_path,
+                'error': str(error)
+            })
+
+        return events
+
+    def cleanup(self, dst, threads=CLEANUP_THREADS):
+        dst_path = os.path.abspath(dst)
+        if not os.path.isdir(dst_path):
+            raise exceptions.FolderException(f"Didnt find directory: {dst_path}")
+
+        # Bottom-up, so we can remove the folders we make empty while we are at it,
+        # instead of needing another walk afterwards.
+        removed_folders = set()
+        cache = OrderedDict()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for root, dirs, files in os.walk(dst_path, topdown=False):
+                links = [(os.path.join(root, f), root) for f in files if os.path.islink(os.path.join(root, f))]
+                remaining = len(files) + len([d for d in dirs if os.path.join(root, d) not in removed_folders])
+
+                for full_path, symlink_destination, exists in _links_exists(links, executor, cache):
+                    self.log(f"Symlink: {full_path}", loglevel='debug')
+                    self.log(f"  points to: {symlink_destination}", loglevel='debug')
+                    self.log(f"  destination exists: {exists}", loglevel='debug')
+
+                    if not exists:
+                        self.log(
+                            f'Deleting dead symlink ({full_path}) pointed to {symlink_destination}',
+                            loglevel='info', category='deleted-symlink',
+                            data={
+                                'symlink_path': full_path,
+                                'symlink_destination': symlink_destination
+                            }
+                        )
+
+                        if not self.dry:
+                            os.unlink(full_path)
+                        remaining -= 1
+
+                # The folders below are done, only the one we are in is asked about again
+                removed_folders.difference_update(os.path.join(root, d) for d in dirs)
+                if remaining == 0 and root != dst_path:
+                    logger.info("Removing empty folder: {}".format(root))
+                    if not self.dry:
+                        os.rmdir(root)
+                    removed_folders.add(root)
+
+    def merge(self, dst, auto_cleanup=False):
+        # When all the shards of a run are done, the links more than one of them wanted are pointed the
+        # same way no matter what order the shards made them in.
+        dst_path = os.path.abspath(dst)
+        if not os.path.isdir(dst_path):
+            raise exceptions.FolderException(f"Didnt find directory: {dst_path}")
+
+        reports = shards.load(dst_path)
+        rule = reports[0]['collision_rule']
+        self.log(f"Merging {len(reports)} shards in '{dst_path}'", loglevel='verbose')
+
+        for link, destinations in sorted(shards.claims(reports).items()):
+            full_path = os.path.join(dst_path, link)
+            symlink_destination = max(destinations)
+            if len(destinations) > 1:
+                self.log(
+                    f'Link ({full_path}) was wanted by more than one file, pointing to {sorted(destinations)}',
+                    loglevel='error', category='collision',
+                    data={
+                        'symlink_full_path': full_path,
+                        'symlink_destinations': sorted(destinations)
+                    }
+                )
 
-        try:
-            _check_filter('late', metadata_store)
-            _collision_handler(collision_rule, symlink_full_path, symlink_basepath, symlink_destination)
-        except SkipFile as reason:
-            log(f'  * skipping: {reason}', loglevel='debug')
-            continue
+            # Without overwrites, the first one made is kept
+            if rule not in shards.OVERWRITING_RULES or not os.path.islink(full_path):
+                continue
+            if os.readlink(full_path) == symlink_destination:
+                continue
 
-        try:
-            if not _dry:
-                link_creator_func(symlink_destination, symlink_full_path, {
-                    'target_is_directory': not is_file,
-                    'metadata': metadata_store.data
-                })
-
-            log(
-                f'Made {symlink_full_path} -> {symlink_destination}',
+            self.log(
+                f'Made {full_path} -> {symlink_destination}',
                 loglevel='info', category='made-symlink',
                 data={
-                    'symlink_full_path': symlink_full_path,
+                    'symlink_full_path': full_path,
                     'symlink_destination': symlink_destination
                 }
             )
-        except OSError as e:
-            log(f'  * OSError while creating symlink: {e}', loglevel='debug')
-
-
-def cleanup(dst, dry=False):
-    configure(dry=dry)
-
-    dst_path = os.path.abspath(dst)
-    if not os.path.isdir(dst_path):
-        raise exceptions.FolderException(f"Didnt find directory: {dst_path}")
+            if not self.dry:
+                is_dir = os.path.isdir(os.path.join(os.path.dirname(full_path), symlink_destination))
+                os.unlink(full_path)
+                os.symlink(symlink_destination, full_path, target_is_directory=is_dir)
+
+        if not self.dry:
+            for report in reports:
+                os.unlink(report['path'])
+
+        if auto_cleanup:
+            self.cleanup(dst_path)
+
+    def rename(self, src, renames, dst=None, journal=None, resume=False, rollback=False):
+        src_path = os.path.abspath(src)
+        if not os.path.isdir(src_path):
+            raise exceptions.FolderException(f"Didnt find src directory: {src_path}")
+
+        dst_path = None
+        if dst:
+            if self.link_creator is None:
+                raise exceptions.Error("rename can't update links in a manifest, do a new run instead")
+            # Hardlinks, clones and .lnk files can't be told from other files by what they point to
+            if self.link_kind != 'symlink':
+                raise exceptions.Error(f"rename can only update symlinks, not {self.link_kind}s. Do a new run instead")
+            dst_path = os.path.abspath(dst)
+            if not os.path.isdir(dst_path):
+                raise exceptions.FolderException(f"Didnt find dst directory: {dst_path}")
+
+        journal = Journal(journal or os.path.join(src_path, RENAME_JOURNAL_NAME))
+
+        if rollback:
+            if not journal:
+                raise exceptions.Error(f"No rename journal to rollback in '{journal.path}'")
+            self.log(f"Rolling back {len(journal.planned)} renames from '{journal.path}'", loglevel="verbose")
+            if not self.dry:
+                journal.rollback(callback=self._log_rename)
+            return
 
-    for root, _, files in os.walk(dst_path):
-        for f in files:
-            full_path = os.path.join(root, f)
-            if not os.path.islink(full_path):
+        if resume:
+            if not journal:
+                raise exceptions.Error(f"No rename journal to resume in '{journal.path}'")
+            self.log(f"Resuming {len(journal.planned)} renames from '{journal.path}'", loglevel="verbose")
+            queue = journal.planned
+            if self.dry:
+                for num, (old, new) in enumerate(queue):
+                    if num not in journal.done:
+                        self._log_rename(old, new)
+                return
+        else:
+            _check_renames(renames)
+            self.log(f"Will look in folder '{src_path}' for tags to rename: {renames}", loglevel="verbose")
+
+            queue = []
+            self.log("Starting collecting list of files/folders to rename:", loglevel="verbose")
+            for root, dirs, files in os.walk(src_path):
+                if dst_path and (root == dst_path or root.startswith(dst_path + os.path.sep)):
+                    dirs[:] = []
+                    continue
+
+                for name in dirs + files:
+                    if renames.keys() & set(hashtags_in(name)):
+                        full_path = os.path.join(root, name)
+                        self.log(f"  Found: {full_path}", loglevel="verbose")
+                        queue.append((full_path, os.path.join(root, _renamed_basename(name, renames))))
+
+            # Start with the longest path, so we can be sure that we are not renaming a
+            # folder that contains another file or folder we also should rename.
+            # We must sort, or be dirty in the os.walk loop. This is much cleaner.
+            queue = sorted(queue, key=lambda e: len(e[0]), reverse=True)
+
+            # Nothing is renamed if one of them would end up on something that is already there
+            targets = set()
+            for old, new in queue:
+                if os.path.lexists(new) or new in targets:
+                    raise exceptions.CollisionException(f"Can't rename '{old}', '{new}' already exists")
+                targets.add(new)
+
+            if self.dry:
+                for old, new in queue:
+                    self._log_rename(old, new)
+                return
+
+            if not queue:
+                return
+
+            journal.plan(queue)
+
+        journal.forward(callback=self._log_rename)
+
+        if dst_path:
+            self._rename_update_dst(src_path, dst_path, queue)
+
+    def _rename_update_dst(self, src_path, dst_path, queue):
+        # Only the links pointing to what we renamed needs updating, and they can only live
+        # in the tag-folders of the tags those files and folders have.
+        renamed = [old for old, _ in queue]
+
+        # Renamed things inside a renamed folder isnt on the path they where renamed to anymore,
+        # but they are found when we look inside the folder.
+        affected = []
+        for _, new in queue:
+            if not os.path.lexists(new):
                 continue
-
-            symlink_destination = os.path.normpath(os.path.join(root, os.readlink(full_path)))
-            exists = os.path.exists(symlink_destination)
-            log(f"Symlink: {full_path}", loglevel='debug')
-            log(f"  points to: {symlink_destination}", loglevel='debug')
-            log(f"  destination exists: {exists}", loglevel='debug')
-
-            if not exists:
-                log(
-                    f'Deleting dead symlink ({full_path}) pointed to {symlink_destination}',
+            affected.append(new)
+            if os.path.isdir(new) and not os.path.islink(new):
+                for root, dirs, files in os.walk(new):
+                    affected += [os.path.join(root, name) for name in dirs + files]
+
+        tags = set()
+        for e in renamed + affected:
+            tags.update(hashtags_in(os.path.basename(e)))
+        folders = _rename_dst_folders(dst_path, tags, self.nametemplate)
+        self.log(f"Updating links in: {folders}", loglevel="verbose")
+
+        for folder in folders:
+            if os.path.isdir(folder):
+                self._remove_renamed_links(folder, renamed)
+
+        for folder in folders:
+            if folder != dst_path and os.path.isdir(folder):
+                _remove_empty_parents(folder, dst_path)
+
+        # The new links are made like a run with the same options would; with the same plugins,
+        # filters and ignore rules, and only for what that run would link. Only the renamed paths
+        # are checked, src is not walked again.
+        rules = {}
+        linked = [e for e in sorted(set(affected)) if self._walked(src_path, dst_path, e, rules)]
+        plugin_state = self._setup_plugins()
+        self._prepare(plugin_state, linked)
+        for e in linked:
+            self.make_symlink(dst_path, e, plugin_state=plugin_state)
+
+    def _remove_renamed_links(self, folder, renamed):
+        # Remove links in folder that points into one of the renamed paths.
+        for root, dirs, files in os.walk(folder):
+            for name in dirs + files:
+                full_path = os.path.join(root, name)
+                if not os.path.islink(full_path):
+                    continue
+
+                symlink_destination = os.path.normpath(os.path.join(root, os.readlink(full_path)))
+                if not any(
+                    symlink_destination == r or symlink_destination.startswith(r + os.path.sep) for r in renamed
+                ):
+                    continue
+
+                self.log(
+                    f'Deleting renamed symlink ({full_path}) pointed to {symlink_destination}',
                     loglevel='info', category='deleted-symlink',
                     data={
                         'symlink_path': full_path,
                         'symlink_destination': symlink_destination
                     }
                 )
-
-                if not _dry:
+                if not self.dry:
                     os.unlink(full_path)
 
-    # This will eventually trigger another os.walk on what we just looped over.
-    # But we might have just cleaned out a lot of old files, making folders empty after
-    # our part1 cleanup. Doing it again is quick, and much less error prune than baking
-    # in the logic in the loop above.
-    utils.remove_empty_folders(dst_path, remove_root=False)
 
+def run(sourcepath, symlink_basepath, metadata=None, filters=None, nametemplate=None, auto_cleanup=False, dry=False,
+        link_creator=None, tag_lookup=None, collision_rule=None, where=None, exclude=None, include=None,
+        link_threads=1, shard=None, shard_depth=1, profiles=None, json_output=False):
+    engine = Taggo(
+        metadata=metadata, filters=filters, nametemplate=nametemplate, collision_rule=collision_rule,
+        link_creator=link_creator, tag_lookup=tag_lookup, dry=dry, where=where, exclude=exclude, include=include,
+        link_threads=link_threads, shard=shard, shard_depth=shard_depth, profiles=profiles, json_output=json_output
+    )
+    engine.run(sourcepath, symlink_basepath, auto_cleanup=auto_cleanup)
 
-def rename(src, original, new, dry=False):
-    configure(dry=dry)
-    src_path = os.path.abspath(src)
-    if not os.path.isdir(src_path):
-        raise exceptions.FolderException(f"Didnt find src directory: {src_path}")
-    log(f"Will look in folder '{src_path}' for tags to rename from '{original}' to '{new}'", loglevel="verbose")
 
-    original_tag = f"#{original}"
-    if not utils.fullmatch(hashtag_re, original_tag):
-        raise exceptions.Error(f"Invalid hashtag: '{original_tag}'")
+def make_symlink(symlink_basepath, sourcepath, *, metadata=None, filters=None, nametemplate=None, metadata_store=None,
+                 collision_rule=None, link_creator=None, tag_lookup=None, dry=False, json_output=False):
+    engine = Taggo(
+        metadata=metadata, filters=filters, nametemplate=nametemplate, collision_rule=collision_rule,
+        link_creator=link_creator, tag_lookup=tag_lookup, dry=dry, json_output=json_output
+    )
+    engine.make_symlink(symlink_basepath, sourcepath, metadata_store=metadata_store)
 
-    new_tag = f"#{new}"
-    if not utils.fullmatch(hashtag_re, new_tag):
-        raise exceptions.Error(f"Invalid hashtag: '{new_tag}'")
 
-    if original_tag == new_tag:
-        raise exceptions.Error("There is no need to rename tag to the same...?")
+def arun(sourcepath, symlink_basepath, concurrency=ARUN_CONCURRENCY, executor=None, **kwargs):
+    # Async generator, use as: async for event in taggo.arun(src, dst)
+    return Taggo(**kwargs).arun(sourcepath, symlink_basepath, concurrency=concurrency, executor=executor)
 
-    queue = []
-    log("Starting collecting list of files/folders to rename:", loglevel="verbose")
-    for root, dirs, files in os.walk(src_path):
-        if dirs:
-            for d in dirs:
-                if original in hashtags_in(d):
-                    full_path = os.path.join(root, d)
-                    log(f"  Found directory: {full_path}", loglevel="verbose")
-                    queue.append(full_path)
-
-        if files:
-            for f in files:
-                if original in hashtags_in(f):
-                    full_path = os.path.join(root, f)
-                    log(f"  Found file: {full_path}", loglevel="verbose")
-                    queue.append(full_path)
-
-    # Start with the longest path, so we can be sure that we are not renaming a
-    # folder that contains another file or folder we also should rename.
-    # We must sort, or be dirty in the os.walk loop. This is much cleaner.
-    for e in sorted(queue, key=len, reverse=True):
-        dirname = os.path.dirname(e)
-        old_basename = os.path.basename(e)
-        new_basename = old_basename.replace(original_tag, new_tag)
-        log(f"Renaming: {dirname}{os.path.sep}{{{old_basename} -> {new_basename}}}")
-        if not _dry:
-            os.rename(e, os.path.join(dirname, new_basename))
-
-
-def info(src):
+
+def cleanup(dst, dry=False, threads=CLEANUP_THREADS, json_output=False):
+    Taggo(dry=dry, json_output=json_output).cleanup(dst, threads=threads)
+
+
+def merge(dst, dry=False, auto_cleanup=False, json_output=False):
+    Taggo(dry=dry, json_output=json_output).merge(dst, auto_cleanup=auto_cleanup)
+
+
+def rename(src, original, new, dry=False, dst=None, nametemplate=None, link_creator=None, journal=None,
+           json_output=False):
+    rename_many(
+        src, {original: new},
+        dry=dry, dst=dst, nametemplate=nametemplate, link_creator=link_creator, journal=journal,
+        json_output=json_output
+    )
+
+
+def rename_many(src, renames, dry=False, dst=None, nametemplate=None, link_creator=None, journal=None,
+                resume=False, rollback=False, json_output=False, metadata=None, filters=None, where=None,
+                tag_lookup=None, collision_rule=None, exclude=None, include=None):
+    # The links in dst are made again with these options, they should be the same as for the run that made them
+    engine = Taggo(
+        metadata=metadata, filters=filters, nametemplate=nametemplate, collision_rule=collision_rule,
+        link_creator=link_creator, tag_lookup=tag_lookup, dry=dry, where=where, exclude=exclude, include=include,
+        json_output=json_output
+    )
+    engine.rename(src, renames, dst=dst, journal=journal, resume=resume, rollback=rollback)
+
+
+def info(src, json_output=False):
     src_path = os.path.abspath(src)
-    log(f"Using src-path: {src_path}", loglevel="verbose")
+    log(f"Using src-path: {src_path}", loglevel="verbose", json_output=json_output)
 
     if not os.path.isdir(src_path):
         raise exceptions.FolderException(f"Didnt find src-path: {src_path}")
@@ -633,14 +1871,14 @@ def info(src):
     folder_tags = sorted(set(folder_tags))
     file_tags = sorted(set(file_tags))
 
-    log("Folder tags:")
+    log("Folder tags:", json_output=json_output)
     for folder_tag in folder_tags:
-        log(f"  {folder_tag}")
+        log(f"  {folder_tag}", json_output=json_output)
 
-    log("")
-    log("File tags:")
+    log("", json_output=json_output)
+    log("File tags:", json_output=json_output)
     for file_tag in file_tags:
-        log(f"  {file_tag}")
+        log(f"  {file_tag}", json_output=json_output)
 
 
 def _parse_cli_nametemplate(nametemplate, file=None, folder=None):
@@ -666,7 +1904,7 @@ def _parse_cli_filter(filter_data):
     return dict(filters)
 
 
-def _parse_cli_metadata(metadata_data):
+def _parse_cli_metadata(metadata_data, json_output=False):
     # Example
     #  in: [['a', 'opt1=1', 'opt2=2'], ['b']]
     #  out: {'a': {'opt1': '1', 'opt2': '2'}, 'b': {}}
@@ -683,7 +1921,8 @@ def _parse_cli_metadata(metadata_data):
                     f'Invalid option ({option}). Need an = sign',
                     loglevel='critical',
                     category='invalid-option-metadata',
-                    data={'option': option}
+                    data={'option': option},
+                    json_output=json_output
                 )
                 sys.exit(1)
             metadata[pluginname][option_name] = option_value
@@ -691,6 +1930,81 @@ def _parse_cli_metadata(metadata_data):
     return metadata
 
 
+def _parse_cli_profiles(filename):
+    # Example file, the keys are the same as the run options, and the ones not set are taken from them
+    #  [
+    #    {"dst": "by-tag"},
+    #    {"dst": "by-camera", "nametemplate": "{path.exif.Make}/{tag.as-folders}/{path.basename}"},
+    #    {"dst": "images", "where": ["filetype.group=image"], "collision-handler": "no-overwrite"}
+    #  ]
+
+    if not os.path.isfile(filename):
+        raise exceptions.NotFoundException(f"Unable to find profiles-file: {filename}")
+
+    with open(filename) as fp:
+        try:
+            entries = json.load(fp)
+        except ValueError as e:
+            raise exceptions.Error(f"Invalid profiles-file ({filename}): {e}")
+
+    profiles = []
+    for entry in entries:
+        entry = dict(entry)
+        profile = {'dst': entry.pop('dst', None)}
+
+        if {'nametemplate', 'nametemplate-file', 'nametemplate-folder'} & entry.keys():
+            profile['nametemplate'] = _parse_cli_nametemplate(
+                entry.pop('nametemplate', DEFAULT_NAMETEMPLATE),
+                file=entry.pop('nametemplate-file', None),
+                folder=entry.pop('nametemplate-folder', None)
+            )
+        if 'filter' in entry:
+            # Like --filter, a query or a list of [query, when, ..]
+            profile['filters'] = _parse_cli_filter([
+                list(f) if isinstance(f, list) else [f] for f in entry.pop('filter')
+            ])
+        if 'where' in entry:
+            profile['where'] = entry.pop('where')
+        if 'collision-handler' in entry:
+            rule = profile['collision_rule'] = entry.pop('collision-handler')
+            if rule not in COLLISION_RULES:
+                raise exceptions.Error(f"Invalid collision-handler in profile '{profile['dst']}': {rule}")
+        if 'link-creator' in entry:
+            profile['link_creator'] = entry.pop('link-creator')
+
+        if entry:
+            raise exceptions.Error(f"Unknown options in profile '{profile['dst']}': {', '.join(sorted(entry))}")
+        profiles.append(profile)
+
+    return profiles
+
+
+def _parse_cli_rename_mapping(filename):
+    # Example file
+    #  old-tag new-tag
+    #  typo-tag fixed-tag
+
+    renames = {}
+    if not os.path.isfile(filename):
+        raise exceptions.NotFoundException(f"Unable to find mapping-file: {filename}")
+
+    with open(filename) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+
+            try:
+                original, new = line.split()
+            except ValueError:
+                raise exceptions.Error(f"Invalid line in mapping-file ({line.strip()}). Need 'original new'")
+
+            if original in renames:
+                raise exceptions.Error(f"Tag '{original}' is renamed more than once in the mapping-file")
+            renames[original] = new
+
+    return renames
+
+
 def main(known_args=None, reraise=False):
     # We can set known_args to test the cli, or if you
     # got a special need where you want to run taggo that way.
@@ -723,21 +2037,13 @@ def main(known_args=None, reraise=False):
              "Json-output will also contain some additional info",
     )
 
-    subparsers = parser.add_subparsers(dest="cmd")
-    subparsers.required = True
-
-    # run
-    parser_run = subparsers.add_parser("run", help="", formatter_class=argparse.RawTextHelpFormatter)
-    parser_run.add_argument(
-        "--dry",
-        help="Dont actually do anything",
-        action="store_true"
-    )
+    # How links are made, for run, and for rename to make them the same way again
+    link_options = argparse.ArgumentParser(add_help=False)
 
     # What should we name the symlink?
     # You should include enough data here so we wont get a name-conflict.
     # In case of conflicts, the collision-handler below will decide what to do.
-    parser_run.add_argument(
+    link_options.add_argument(
         "--nametemplate",
         help="A template-based name of what you want to call the symlinks themself."
              "See docs for more info. (default: %(default)s)",
@@ -745,21 +2051,21 @@ def main(known_args=None, reraise=False):
         metavar='TEMPLATE'
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
         "--nametemplate-file",
         help="Template if we link to a file",
         default=None,
         metavar='TEMPLATE'
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
         "--nametemplate-folder",
         help="Template if we link to a folder",
         default=None,
         metavar='TEMPLATE'
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
         "--filter",
         help=textwrap.dedent("""\
         Filtering using jmespath. Make sure it matches (returns true) for the files you want to include.
@@ -779,7 +2085,49 @@ def main(known_args=None, reraise=False):
         metavar=('FILTER', 'WHEN')
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
+        "--where",
+        help=textwrap.dedent("""\
+        Quick filter in the form KEY__OPERATOR=VALUE, like "file-ext__iexact=jpg" or "stat.size__gt=1024".
+        Without __OPERATOR, exact is used. You can specify multiple, all must match.
+        They run as early as possible; path-keys before any metadata plugins, plugin-keys right after
+        their plugin, and tag-keys just before the links are made.
+
+        Operators: exact, iexact, neq, contains, icontains, startswith, istartswith, endswith,
+                   iendswith, gt, gte, lt, lte and regex.
+        contains and icontains takes a comma separated list of values.
+          """),
+        action="append",
+        default=[],
+        metavar='KEY__OPERATOR=VALUE'
+    )
+
+    link_options.add_argument(
+        "--exclude",
+        help=textwrap.dedent(f"""\
+        Don't look at files or folders matching this pattern. Excluded folders are not looked into at all.
+        You can specify multiple. Patterns can also be put in {IGNORE_FILE_NAME} files in src, they are
+        used for the folder they are in and everything below it.
+
+          * name*       Glob matched against the name of a file or folder.
+          * a/b/name*   Glob matched against the path, relative to src (or the {IGNORE_FILE_NAME} file).
+          * name/       Only matches folders.
+          * re:regex    Regex searched for in the relative path.
+          """),
+        action="append",
+        default=[],
+        metavar='PATTERN'
+    )
+
+    link_options.add_argument(
+        "--include",
+        help="Include what matches, even if it is excluded. Same patterns as --exclude.",
+        action="append",
+        default=[],
+        metavar='PATTERN'
+    )
+
+    link_options.add_argument(
         "--metadata",
         help=textwrap.dedent("""\
         Add extra metadata that will be available in filters and the name-templates.
@@ -791,9 +2139,23 @@ def main(known_args=None, reraise=False):
         Plugins, in order they run..
 
           * stat: File stat, like accesstime, size and so on..
-          * filetype: Checks the first bytes of a file to figure out what it is
+          * filetype: Figure out what a file is from its extension, or by checking the first bytes of it if
+                      the extension is unknown. Options: verify=1 to always check the content.
           * exif: Get some additional image-data available.
+          * geometry: Image format, width, height, orientation (landscape, portrait or square) and megapixels,
+                      read from the header of png, jpeg, gif, webp and bmp files.
+          * video: Duration (seconds), width, height, creation_time, location, make and model of mp4, mov
+                   and other ISO base media files. Only the headers of the boxes are read.
+          * location: Nearest city and country to where a photo was taken (exif GPS), from a list of
+                      places shipped with taggo. Gives lat, lon, city, country and distance (km).
+                      Options: places (a csv with name,country,lat,lon, or a GeoNames dump).
           * md5: Calculate the md5 checksum of a file.
+          * duplicates: Find files with the same content. Gives group (same for all duplicates), count,
+                        duplicate (true/false) and first (true for one of them). Options: chunk_size and
+                        min_size (default 1, so empty files are not duplicates).
+          * phash: Find images that looks the same (bursts, resized or re-encoded). Gives dhash, phash, group
+                   (same for all similar images, empty if there are none), count and similar (true/false).
+                   Options: distance (bits, default 6) and cache. Needs numpy and Pillow.
           """),
         action="append",
         nargs='+',
@@ -801,29 +2163,28 @@ def main(known_args=None, reraise=False):
         metavar=('PLUGIN', 'OPTIONS')
     )
 
-    parser_run.add_argument(
-        "--auto-cleanup",
-        help="Run the cleanup command after we are done.",
-        action="store_true"
-    )
-
-    parser_run.add_argument(
+    link_options.add_argument(
         "--tag-lookup",
         help=textwrap.dedent("""\
         We will always check the filename for tags (example #tag), but tags can also hide other places.
-        Currently, there are only one extra lookup, but more might come later.
 
-          * frontmatter: Look for tags in markdown (.md) files using frontmatter. Note that you will need
-                         to install "python-frontmatter" for this to work. Install it via pip manually, or use
+          * frontmatter: Look for tags in markdown (.md) files using frontmatter. Only the header is read, and
+                         what is found is cached (in ~/.cache/taggo) until the file changes. Note that you will
+                         need pyyaml for this to work. Install it via pip manually, or use
                          "pip install taggo[frontmatter]" when installing taggo.
+          * xattr: Tags in the "user.xdg.tags" extended attribute, comma separated. The file is not opened.
+          * sidecar: Keywords (dc:subject) in .xmp sidecar files, "photo.jpg.xmp" or "photo.xmp" for "photo.jpg".
+          * archive: Tags in the names of the files in zip and tar files. Only the list of files is read.
+          * archive-compressed: Same as archive, but also for compressed tar files (.tar.gz, ..). This
+                                means decompressing all of them.
           """),
         action="append",
         default=[],
-        choices=['frontmatter',],
+        choices=['frontmatter', 'xattr', 'sidecar', 'archive', 'archive-compressed'],
         metavar='LOOKUPTYPE'
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
         "--collision-handler",
         help=textwrap.dedent("""\
         There are a couple of different modes you can set for handling symlink-name collisions.
@@ -836,27 +2197,94 @@ def main(known_args=None, reraise=False):
           * overwrite-if-dst-same: Overwrite if destination-path of existing symlink is within our dst-path.
           * bail-if-different: Exit with exit-code 20 if destination path is different.
           """),
-        choices=["smart", "no-overwrite", "overwrite-if-symlink", "overwrite-if-dst-same", "bail-if-different"],
+        choices=COLLISION_RULES,
         default="smart"
     )
 
-    parser_run.add_argument(
+    link_options.add_argument(
         "--link-creator",
-        help=textwrap.dedent("""\
+        help=textwrap.dedent(f"""\
         We are by default trying to create a symlink, but that is not always feasable.
         Example, on windows, you will need additional privileges to create them, making the normal windows .lnk
         format a better altnernative.
 
           * symlink (default): Use the normal python os.symlink.
           * winlnk: Create windows lnk files (need pywin32, installed as dep if you did "pip install taggo[winlnk]")
+          * hardlink: Hardlinks, src and dst must be on the same filesystem. Folders are symlinked.
+          * reflink: Copy-on-write clones (btrfs, XFS, ..), or normal copies where that is not supported.
+            Folders are symlinked.
+          * manifest: Don't make any links, write them to dst/{MANIFEST_NAME}, one json-list per line.
         """),
-        choices=["symlink", "winlnk"],
+        choices=list(link_creators),
         default="symlink"
     )
 
+    subparsers = parser.add_subparsers(dest="cmd")
+    subparsers.required = True
+
+    # run
+    parser_run = subparsers.add_parser(
+        "run", help="", formatter_class=argparse.RawTextHelpFormatter, parents=[link_options]
+    )
+    parser_run.add_argument(
+        "--dry",
+        help="Dont actually do anything",
+        action="store_true"
+    )
+
+    parser_run.add_argument(
+        "--auto-cleanup",
+        help="Run the cleanup command after we are done.",
+        action="store_true"
+    )
+
+    parser_run.add_argument(
+        "--link-threads",
+        help=textwrap.dedent(f"""\
+        Write links using this many threads. Useful if dst is on a filesystem where every call is slow,
+        like SMB or NFS. Links in the same folder are written by one thread at a time, so collisions are
+        handled the same way. (default: 1, try {LINK_THREADS} on network filesystems)
+          """),
+        type=int,
+        default=1,
+        metavar='THREADS'
+    )
+
+    parser_run.add_argument(
+        "--profiles",
+        help=textwrap.dedent("""\
+        Make many views of the same files in one go. A json-file with a list of profiles, each with its own "dst"
+        (relative to dst), and optionally "nametemplate", "nametemplate-file", "nametemplate-folder", "filter",
+        "where", "collision-handler" and "link-creator". Options not in a profile are taken from the ones above.
+        The metadata of a file is only found once, for all the profiles. Enable the metadata plugins all of them
+        needs with --metadata.
+          """),
+        default=None,
+        metavar='FILE'
+    )
+
+    parser_run.add_argument(
+        "--shard",
+        help=textwrap.dedent("""\
+        Only do part K of N of src, so N runs (on different machines) can share the work, into the same dst.
+        Folders are put in a part by a hash of their path. Run "taggo merge dst" when all of them are done.
+          """),
+        default=None,
+        metavar='K/N'
+    )
+
+    parser_run.add_argument(
+        "--shard-depth",
+        help="How many folders down in src that are split between the shards. (default: %(default)s)",
+        type=int,
+        default=1,
+        metavar='DEPTH'
+    )
+
     parser_run.add_argument(
         "src",
-        help="Source folder/file"
+        help="Source folder/file. You can specify multiple, they are all linked into the same dst in one go",
+        nargs='+'
     )
     parser_run.add_argument(
         "dst",
@@ -870,29 +2298,86 @@ def main(known_args=None, reraise=False):
         help="Dont actually do anything",
         action="store_true"
     )
+    parser_cleanup.add_argument(
+        "--threads",
+        help="How many links to check at the same time (default: %(default)s)",
+        type=int,
+        default=CLEANUP_THREADS
+    )
     parser_cleanup.add_argument(
         "dst",
         help="Folder that contains your symlinks"
     )
 
+    # merge
+    parser_merge = subparsers.add_parser("merge", help="Merge the collision reports from the shards of a run")
+    parser_merge.add_argument(
+        "--dry",
+        help="Dont actually do anything",
+        action="store_true"
+    )
+    parser_merge.add_argument(
+        "--auto-cleanup",
+        help="Run the cleanup command after we are done.",
+        action="store_true"
+    )
+    parser_merge.add_argument(
+        "dst",
+        help="Folder the shards made their links in"
+    )
+
     # rename
-    parser_cleanup = subparsers.add_parser("rename", help="Rename an existing tag")
-    parser_cleanup.add_argument(
+    parser_rename = subparsers.add_parser(
+        "rename", help="Rename an existing tag", formatter_class=argparse.RawTextHelpFormatter,
+        parents=[link_options]
+    )
+    parser_rename.add_argument(
         "--dry",
         help="Dont actually do anything",
         action="store_true"
     )
-    parser_cleanup.add_argument(
+    parser_rename.add_argument(
+        "--dst",
+        help="Folder that contains your symlinks. Links pointing to what we rename will be updated, and made\n"
+             "again using the other options. Use the same ones as the run that made the links in dst.",
+        default=None
+    )
+    parser_rename.add_argument(
+        "--mapping-file",
+        help="File with many renames, one 'original new' pair per line. All of them are done in one go.",
+        default=None,
+        metavar='FILE'
+    )
+    parser_rename.add_argument(
+        "--journal",
+        help=f"Where to keep the rename journal while renaming (default: src/{RENAME_JOURNAL_NAME})",
+        default=None,
+        metavar='FILE'
+    )
+    rename_journal = parser_rename.add_mutually_exclusive_group()
+    rename_journal.add_argument(
+        "--resume",
+        help="Finish an interrupted rename using the journal",
+        action="store_true"
+    )
+    rename_journal.add_argument(
+        "--rollback",
+        help="Undo an interrupted rename using the journal",
+        action="store_true"
+    )
+    parser_rename.add_argument(
         "src",
         help="Source folder, the folder containing your tagged files (not the symlinks)"
     )
-    parser_cleanup.add_argument(
+    parser_rename.add_argument(
         "original",
-        help="Original tag you want to replace (no #)"
+        help="Original tag you want to replace (no #)",
+        nargs='?'
     )
-    parser_cleanup.add_argument(
+    parser_rename.add_argument(
         "new",
-        help="New tag, without the #"
+        help="New tag, without the #",
+        nargs='?'
     )
 
     # info
@@ -905,20 +2390,20 @@ def main(known_args=None, reraise=False):
     args = parser.parse_args(known_args)
 
     if args.verbose or os.environ.get("VERBOSE"):
-        configure(output='VERBOSE')
+        set_output('VERBOSE')
 
     if args.debug or os.environ.get("DEBUG"):
-        configure(output='DEBUG')
+        set_output('DEBUG')
 
     if args.quiet or os.environ.get("QUIET"):
-        configure(output='QUIET')
+        set_output('QUIET')
 
     try:
         if args.cmd == 'run':
             run(
                 args.src, args.dst,
                 filters=_parse_cli_filter(args.filter),
-                metadata=_parse_cli_metadata(args.metadata),
+                metadata=_parse_cli_metadata(args.metadata, json_output=args.json_output),
                 auto_cleanup=args.auto_cleanup,
                 dry=args.dry,
                 nametemplate=_parse_cli_nametemplate(
@@ -927,19 +2412,60 @@ def main(known_args=None, reraise=False):
                     folder=args.nametemplate_folder
                 ),
                 link_creator=args.link_creator,
-                tag_lookup=args.tag_lookup
+                tag_lookup=args.tag_lookup,
+                collision_rule=args.collision_handler,
+                where=args.where,
+                exclude=args.exclude,
+                include=args.include,
+                link_threads=args.link_threads,
+                shard=shards.parse(args.shard) if args.shard else None,
+                shard_depth=args.shard_depth,
+                profiles=_parse_cli_profiles(args.profiles) if args.profiles else None,
+                json_output=args.json_output
             )
         elif args.cmd == 'cleanup':
-            cleanup(args.dst, dry=args.dry)
+            cleanup(args.dst, dry=args.dry, threads=args.threads, json_output=args.json_output)
+        elif args.cmd == 'merge':
+            merge(args.dst, dry=args.dry, auto_cleanup=args.auto_cleanup, json_output=args.json_output)
         elif args.cmd == 'rename':
-            rename(args.src, args.original, args.new, dry=args.dry)
+            if args.resume or args.rollback:
+                renames = {}
+            elif args.mapping_file:
+                renames = _parse_cli_rename_mapping(args.mapping_file)
+            elif args.original and args.new:
+                renames = {args.original: args.new}
+            else:
+                parser_rename.error("original and new tag, or --mapping-file is needed")
+
+            rename_many(
+                args.src, renames,
+                dry=args.dry,
+                dst=args.dst,
+                metadata=_parse_cli_metadata(args.metadata, json_output=args.json_output),
+                filters=_parse_cli_filter(args.filter),
+                nametemplate=_parse_cli_nametemplate(
+                    args.nametemplate,
+                    file=args.nametemplate_file,
+                    folder=args.nametemplate_folder
+                ),
+                link_creator=args.link_creator,
+                tag_lookup=args.tag_lookup,
+                collision_rule=args.collision_handler,
+                where=args.where,
+                exclude=args.exclude,
+                include=args.include,
+                journal=args.journal,
+                resume=args.resume,
+                rollback=args.rollback,
+                json_output=args.json_output
+            )
         elif args.cmd == 'info':
-            info(args.src)
+            info(args.src, json_output=args.json_output)
     except exceptions.Error as e:
-        log(e, loglevel='error', category='exception')
+        log(str(e), loglevel='error', category='exception', json_output=args.json_output)
         if reraise:
             raise
-        sys.exit(2)
+        sys.exit(e.exit_code)
 
 
 if __name__ == "__main__":  # pragma: no cover
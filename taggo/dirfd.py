@@ -0,0 +1,123 @@
+import errno
+import os
+import threading
+
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# How many open folders are kept, shared by all the threads
+DIR_FD_CACHE_SIZE = 64
+# A thread always gets to keep a folder and its parent open
+MIN_THREAD_SIZE = 2
+
+DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_CLOEXEC', 0)
+
+# Windows (and some other platforms) can't do filesystem calls relative to a folder
+supported = all(
+    func in os.supports_dir_fd
+    for func in (os.open, os.stat, os.mkdir, os.symlink, os.readlink, os.unlink)
+)
+
+
+def fd_budget(size):
+    # Never more than a quarter of the fds the process may have open, the rest are for everything else
+    if resource is None:
+        return size
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return size
+    return max(MIN_THREAD_SIZE, min(size, soft // 4))
+
+
+class DirFds:
+    """
+    Keeps folders in dst open, so links can be made using the name of the link relative to its
+    folder (os.symlink(..., dir_fd=fd)) instead of the full path. The kernel then resolves a deep
+    path like dst/a/b/c once per folder instead of once for every call on every link.
+
+    Each thread gets its own LRU cache, so a folder is never closed while another thread uses it.
+    The size is shared by them, so more threads keep fewer folders open each.
+    """
+
+    def __init__(self, size=DIR_FD_CACHE_SIZE):
+        self.size = fd_budget(size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.caches = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cache(self):
+        cache = getattr(self.local, 'cache', None)
+        if cache is None:
+            cache = self.local.cache = OrderedDict()
+            with self.lock:
+                self.caches.append(cache)
+        return cache
+
+    def _thread_size(self):
+        return max(MIN_THREAD_SIZE, self.size // len(self.caches))
+
+    def get(self, folder, create=False):
+        # Returns an open fd for folder, making it (and its parents) if create is set
+        cache = self._cache()
+        fd = cache.get(folder)
+        if fd is not None:
+            cache.move_to_end(folder)
+            return fd
+
+        fd = self._open(folder, create, cache)
+        cache[folder] = fd
+        while len(cache) > self._thread_size():
+            _, oldest = cache.popitem(last=False)
+            os.close(oldest)
+        return fd
+
+    def _open(self, folder, create, cache):
+        parent, name = os.path.split(folder)
+        if not name:
+            return self._os_open(cache, folder)
+
+        # The parent is most likely open already, as links are made folder by folder
+        parent_fd = self.get(parent, create)
+        try:
+            return self._os_open(cache, name, dir_fd=parent_fd)
+        except FileNotFoundError:
+            if not create:
+                raise
+
+        try:
+            os.mkdir(name, dir_fd=parent_fd)
+        except FileExistsError:
+            # Made by another thread
+            pass
+        return self._os_open(cache, name, dir_fd=parent_fd)
+
+    def _os_open(self, cache, path, dir_fd=None):
+        # Out of fds (other parts of the process uses them too); the oldest folders of this thread are
+        # closed until it can be opened, but never the one it is opened relative to
+        while True:
+            try:
+                return os.open(path, DIR_FLAGS, dir_fd=dir_fd)
+            except OSError as e:
+                if e.errno != errno.EMFILE:
+                    raise
+                oldest = next((f for f, fd in cache.items() if fd != dir_fd), None)
+                if oldest is None:
+                    raise
+                os.close(cache.pop(oldest))
+
+    def close(self):
+        with self.lock:
+            for cache in self.caches:
+                while cache:
+                    _, fd = cache.popitem()
+                    os.close(fd)
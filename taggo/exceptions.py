@@ -1,5 +1,6 @@
 class Error(Exception):
-    pass
+    # Exit-code used when running from the cli
+    exit_code = 2
 
 
 class NotFoundException(Error):
@@ -7,3 +8,15 @@ class NotFoundException(Error):
 
 class FolderException(Error):
     pass
+
+
+class DstNotFolderException(FolderException):
+    exit_code = 5
+
+
+class NametemplateException(Error):
+    exit_code = 3
+
+
+class CollisionException(Error):
+    exit_code = 20
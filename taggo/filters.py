@@ -1,12 +1,20 @@
 import re
 
+# Filters used by --where. They are called as func(data, value) where data is from the file we are
+# looking at, and value is what the user asked for, already converted by utils.from_string_to_py.
+
 
 def exact(data, value):
-    return data == value
+    # value is a tuple of the forms the string can have, like ('0', 0)
+    return data in value
+
+
+def iexact(data, value):
+    return data.lower() == value
 
 
 def neq(data, value):
-    return data != value
+    return data not in value
 
 
 def contains(data, value):
@@ -14,10 +22,10 @@ def contains(data, value):
 
 
 def icontains(data, value):
+    # value is already lowercased
     if data is None:
         return False
 
-    value = [i.lower() for i in value]
     return data.lower() in value
 
 
@@ -26,7 +34,7 @@ def startswith(data, value):
 
 
 def istartswith(data, value):
-    return data.lower().startswith(value.lower())
+    return data.lower().startswith(value)
 
 
 def endswith(data, value):
@@ -34,24 +42,44 @@ def endswith(data, value):
 
 
 def iendswith(data, value):
-    return data.lower().endswith(value.lower())
+    return data.lower().endswith(value)
 
 
 def gt(data, value):
-    return value > int(data)
+    return int(data) > value
 
 
 def gte(data, value):
-    return value >= int(data)
+    return int(data) >= value
 
 
 def lt(data, value):
-    return value < int(data)
+    return int(data) < value
 
 
 def lte(data, value):
-    return value <= int(data)
+    return int(data) <= value
 
 
 def regex(data, value):
-    return re.match(value, data) is not None
+    # value is a compiled regex
+    return value.match(data) is not None
+
+
+# The operators that can be used as key__operator=value, exact is used when none is given
+OPERATORS = {
+    'exact': exact,
+    'iexact': iexact,
+    'neq': neq,
+    'contains': contains,
+    'icontains': icontains,
+    'startswith': startswith,
+    'istartswith': istartswith,
+    'endswith': endswith,
+    'iendswith': iendswith,
+    'gt': gt,
+    'gte': gte,
+    'lt': lt,
+    'lte': lte,
+    'regex': regex,
+}
@@ -0,0 +1,105 @@
+import os
+import re
+import fnmatch
+
+from . import exceptions
+
+
+class Rule:
+    """
+    One exclude (or include, if it starts with !) pattern.
+
+      * name*       Glob matched against the name of a file or folder.
+      * a/b/name*   Glob matched against the path, relative to where the rule is from.
+      * name/       Only matches folders.
+      * re:regex    Regex searched for in the relative path.
+    """
+    __slots__ = ('pattern', 'base', 'include', 'dir_only', 'on_path', 'regex')
+
+    def __init__(self, pattern, base=''):
+        self.pattern = pattern
+        self.base = base
+        self.include = pattern.startswith('!')
+        if self.include:
+            pattern = pattern[1:]
+
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        try:
+            if pattern.startswith('re:'):
+                self.on_path = True
+                self.regex = re.compile(pattern[3:]).search
+            else:
+                self.on_path = '/' in pattern
+                self.regex = re.compile(fnmatch.translate(pattern.lstrip('/'))).match
+        except re.error as e:
+            raise exceptions.Error(f"Invalid ignore pattern ({self.pattern}): {e}")
+
+    def matches(self, relative_path, name, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+
+        if not self.on_path:
+            return self.regex(name) is not None
+
+        if self.base:
+            if not relative_path.startswith(self.base + '/'):
+                return False
+            relative_path = relative_path[len(self.base) + 1:]
+        return self.regex(relative_path) is not None
+
+
+class Rules:
+    """
+    The rules used for one folder. Each folder gets the rules of its parent, plus the ones from
+    its own ignore-file. The last rule that matches decides, and --exclude/--include are checked
+    after the ones from ignore-files.
+    """
+    __slots__ = ('file_rules', 'rules')
+
+    def __init__(self, file_rules=(), excludes=(), includes=()):
+        self.file_rules = tuple(file_rules)
+        self.rules = self.file_rules + tuple(excludes) + tuple(includes)
+
+    @classmethod
+    def from_options(cls, excludes=None, includes=None):
+        return cls(
+            excludes=[Rule(p) for p in excludes or []],
+            includes=[Rule(p if p.startswith('!') else f'!{p}') for p in includes or []],
+        )
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def with_file(self, filename, base):
+        # Rules for a folder that has its own ignore-file
+        rules = []
+        with open(filename) as fp:
+            for line in fp:
+                line = line.rstrip('\n')
+                # Tags starts with #, so use \# if you need a pattern starting with it
+                if not line.strip() or line.startswith('#'):
+                    continue
+                if line.startswith('\\#'):
+                    line = line[1:]
+                rules.append(Rule(line, base))
+
+        cli_rules = self.rules[len(self.file_rules):]
+        new = Rules()
+        new.file_rules = self.file_rules + tuple(rules)
+        new.rules = new.file_rules + cli_rules
+        return new
+
+    def excluded(self, relative_path, name, is_dir):
+        for rule in reversed(self.rules):
+            if rule.matches(relative_path, name, is_dir):
+                return not rule.include
+        return False
+
+
+def relative(path, start):
+    # Relative path using / as separator, as used in the rules. Empty if path is start.
+    if path == start:
+        return ''
+    return os.path.relpath(path, start).replace(os.path.sep, '/')
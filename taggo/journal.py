@@ -0,0 +1,94 @@
+import os
+import json
+
+from . import exceptions
+
+
+class Journal:
+    """
+    Write-ahead journal for a list of renames.
+
+    Every rename is written (and synced to disk) before we start, and each one is marked as done
+    right after it happened. If we get interrupted, the journal knows exactly what is left, and
+    can roll the renames forward or back.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.planned = []
+        self.done = set()
+
+        if os.path.exists(path):
+            self._load()
+
+    def __bool__(self):
+        return bool(self.planned)
+
+    def _load(self):
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Interrupted while writing the last line, nothing we can use there
+                    continue
+
+                if entry['op'] == 'plan':
+                    self.planned.append((entry['old'], entry['new']))
+                elif entry['op'] == 'done':
+                    self.done.add(entry['num'])
+
+    def _write(self, fp, entry):
+        fp.write(json.dumps(entry) + '\n')
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def plan(self, renames):
+        if self:
+            raise exceptions.Error(f"There is an unfinished rename in journal '{self.path}', resume or rollback first")
+
+        self.planned = list(renames)
+        with open(self.path, 'w') as fp:
+            for old, new in self.planned:
+                fp.write(json.dumps({'op': 'plan', 'old': old, 'new': new}) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def forward(self, callback=None):
+        # Does, or continues doing, the renames in the order they where planned.
+        with open(self.path, 'a') as fp:
+            for num, (old, new) in enumerate(self.planned):
+                if num in self.done:
+                    continue
+
+                # We might have been interrupted between the rename and marking it as done
+                if os.path.lexists(old):
+                    if os.path.lexists(new):
+                        # Left as planned, so it can be resumed (or rolled back) when new is moved away
+                        raise exceptions.CollisionException(
+                            f"Can't rename '{old}', '{new}' already exists. Move it, and resume the rename"
+                        )
+                    if callback:
+                        callback(old, new)
+                    os.rename(old, new)
+
+                self._write(fp, {'op': 'done', 'num': num})
+                self.done.add(num)
+
+        self.finish()
+
+    def rollback(self, callback=None):
+        # Undo whatever was done, newest first. A rename might have happened without
+        # being marked as done, so we check all of them.
+        for old, new in reversed(self.planned):
+            if os.path.lexists(new) and not os.path.lexists(old):
+                if callback:
+                    callback(new, old)
+                os.rename(new, old)
+
+        self.done = set()
+        self.finish()
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
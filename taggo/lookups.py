@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import tarfile
+import zipfile
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from collections import OrderedDict
+
+from . import exceptions
+
+# We give up looking for the end of the frontmatter after this many bytes
+FRONTMATTER_MAX_SIZE = 64 * 1024
+
+FRONTMATTER_DELIMITER = b'---'
+
+# The "tags:" key, and the lines belonging to it (indented, or a list at the same level)
+frontmatter_tags_re = re.compile(r'^tags[ \t]*:.*\n(?:(?:[ \t]+|-).*\n)*', re.M)
+
+
+# Tags as set by file-managers and others following the freedesktop.org spec, comma separated
+XATTR_TAGS_NAME = 'user.xdg.tags'
+
+SIDECAR_EXT = '.xmp'
+
+# How many folders we remember the sidecars for
+SIDECAR_FOLDER_CACHE_SIZE = 16
+
+ZIP_EXTS = ('.zip', '.cbz')
+TAR_EXTS = ('.tar',)
+# Finding the members of these means decompressing all of them
+COMPRESSED_TAR_EXTS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+XMP_SUBJECT = '{http://purl.org/dc/elements/1.1/}subject'
+XMP_LIST_ITEM = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}li'
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'taggo', 'tag-lookup.json')
+
+
+def _frontmatter_header(filepath):
+    # Reads only up to the closing ---, not the whole document
+    with open(filepath, 'rb') as fp:
+        first = fp.readline(FRONTMATTER_MAX_SIZE)
+        if first.rstrip() != FRONTMATTER_DELIMITER:
+            return None
+
+        header = b''
+        while len(header) < FRONTMATTER_MAX_SIZE:
+            line = fp.readline(FRONTMATTER_MAX_SIZE - len(header))
+            if not line:
+                break
+            if line.rstrip() in (FRONTMATTER_DELIMITER, b'...'):
+                return header.decode('utf-8', errors='replace')
+            header += line
+
+    return None
+
+
+def frontmatter_tags(filepath):
+    header = _frontmatter_header(filepath)
+    if not header:
+        return []
+
+    # Only the tags are yaml-parsed, not the rest of the header
+    match = frontmatter_tags_re.search(header + '\n')
+    if not match:
+        return []
+
+    try:
+        import yaml
+    except ImportError:
+        raise exceptions.Error(
+            'The frontmatter tag-lookup needs pyyaml, install it with "pip install taggo[frontmatter]"'
+        )
+
+    try:
+        tags = (yaml.safe_load(match.group(0)) or {}).get('tags')
+    except yaml.YAMLError:
+        return []
+
+    if not tags:
+        return []
+    if not isinstance(tags, list):
+        # Like "tags: a, b", these are split when the tags are parsed
+        tags = [tags]
+    return [str(t) for t in tags if t is not None]
+
+
+def xattr_tags(filepath):
+    # One getxattr, the file is never opened
+    try:
+        value = os.getxattr(filepath, XATTR_TAGS_NAME)
+    except (AttributeError, OSError):
+        # Not supported by the os or filesystem, or not set
+        return []
+    return [t.strip() for t in value.decode('utf-8', errors='replace').split(',') if t.strip()]
+
+
+def xmp_tags(filepath):
+    # The keywords (dc:subject) in an xmp sidecar
+    try:
+        tree = ElementTree.parse(filepath)
+    except (OSError, ElementTree.ParseError):
+        return []
+
+    tags = []
+    for subject in tree.iter(XMP_SUBJECT):
+        tags += [li.text.strip() for li in subject.iter(XMP_LIST_ITEM) if li.text and li.text.strip()]
+    return tags
+
+
+def folder_sidecars(folder):
+    # All sidecars in folder, by the name they are for. Both "photo.jpg.xmp" and "photo.xmp" are
+    # used, the first one is for "photo.jpg", the last one for all files named "photo.*".
+    sidecars = {}
+    try:
+        entries = [e for e in os.scandir(folder) if e.name.lower().endswith(SIDECAR_EXT) and e.is_file()]
+    except OSError:
+        return sidecars
+
+    for entry in entries:
+        tags = xmp_tags(entry.path)
+        if tags:
+            sidecars[entry.name[:-len(SIDECAR_EXT)]] = tags
+    return sidecars
+
+
+def is_archive(filepath, compressed=False):
+    # From the name only, so files that are not archives are never opened or cached
+    lower = filepath.lower()
+    return lower.endswith(ZIP_EXTS + TAR_EXTS) or (compressed and lower.endswith(COMPRESSED_TAR_EXTS))
+
+
+def _archive_names(filepath, compressed=False):
+    lower = filepath.lower()
+    if lower.endswith(ZIP_EXTS):
+        # Only the central directory at the end of the file is read
+        with zipfile.ZipFile(filepath) as archive:
+            return archive.namelist()
+    if lower.endswith(TAR_EXTS):
+        # Only the headers, the data of each member is skipped with a seek
+        with tarfile.open(filepath, 'r:') as archive:
+            return [member.name for member in archive]
+    if compressed and lower.endswith(COMPRESSED_TAR_EXTS):
+        with tarfile.open(filepath, 'r:*') as archive:
+            return [member.name for member in archive]
+    return []
+
+
+def archive_tags(filepath, compressed=False):
+    # [tag, member] for the hashtags in the names of the members (and the folders they are in) of a
+    # zip or tar file. Tags are like "tag(param)", as from the other lookups.
+    from . import hashtag_re
+
+    try:
+        names = _archive_names(filepath, compressed)
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError):
+        return []
+
+    found = []
+    for name in names:
+        for part in name.rstrip('/').split('/'):
+            for tag, param in hashtag_re.findall(part):
+                found.append([f'{tag}({param})' if param else tag, name])
+    return found
+
+
+class Lookups:
+    """
+    The other places than the name we look for tags in (--tag-lookup).
+
+    Results for lookups that reads the file are cached by the files (inode, mtime, size), in a
+    cache that is kept between runs. Unchanged files are then never opened again.
+    """
+
+    def __init__(self, names=None, cache_path=None):
+        self.names = list(names or [])
+        self.cache_path = default_cache_path() if cache_path is None else cache_path
+        self.lock = threading.Lock()
+        # One save at a time, so an older copy of the cache never replaces a newer one
+        self.save_lock = threading.Lock()
+        self.cache = None
+        self.changed = False
+        self.sidecars = OrderedDict()
+
+    def __bool__(self):
+        return bool(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def _load_cache(self):
+        with self.lock:
+            if self.cache is not None:
+                return self.cache
+            cache = {}
+            if self.cache_path:
+                try:
+                    with open(self.cache_path) as fp:
+                        cache = json.load(fp)
+                except (OSError, ValueError):
+                    pass
+            self.cache = cache
+            return cache
+
+    def _cached(self, name, filepath, func):
+        cache = self._load_cache()
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return []
+        key = f'{name}:{filepath}'
+        valid = [st.st_ino, st.st_mtime_ns, st.st_size]
+
+        with self.lock:
+            entry = cache.get(key)
+        if entry and entry[:3] == valid:
+            return entry[3]
+
+        # Reading the file is done without the lock, so other threads can use the cache meanwhile
+        tags = func(filepath)
+        with self.lock:
+            cache[key] = valid + [tags]
+            self.changed = True
+        return tags
+
+    def find(self, path, is_file=True, archive_members=None):
+        # Returns a list of the tags found, as strings like "tag(param)".
+        # archive_members is what archive_members() returns, if it is already known.
+        tags = []
+        if is_file and 'frontmatter' in self.names and path['file-ext'] == 'md':
+            tags += self._cached('frontmatter', path['sourcepath'], frontmatter_tags)
+        if 'xattr' in self.names:
+            tags += xattr_tags(path['sourcepath'])
+        if is_file and 'sidecar' in self.names:
+            tags += self._sidecar_tags(path['sourcepath'])
+        if archive_members is None:
+            archive_members = self.archive_members(path, is_file)
+        tags += [tag for tag, _ in archive_members]
+        return tags
+
+    def archive_members(self, path, is_file=True):
+        # [tag, member] for the tags found in the names of archive members
+        if not is_file:
+            return []
+        compressed = 'archive-compressed' in self.names
+        if not (compressed or 'archive' in self.names) or not is_archive(path['sourcepath'], compressed):
+            return []
+        if compressed:
+            return self._cached('archive-compressed', path['sourcepath'], lambda f: archive_tags(f, True))
+        return self._cached('archive', path['sourcepath'], archive_tags)
+
+    def _sidecar_tags(self, filepath):
+        folder, name = os.path.split(filepath)
+        if name.lower().endswith(SIDECAR_EXT):
+            return []
+
+        # Files are done folder by folder, so every folder is only read once
+        with self.lock:
+            sidecars = self.sidecars.get(folder)
+            if sidecars is None:
+                sidecars = self.sidecars[folder] = folder_sidecars(folder)
+                if len(self.sidecars) > SIDECAR_FOLDER_CACHE_SIZE:
+                    self.sidecars.popitem(last=False)
+            else:
+                self.sidecars.move_to_end(folder)
+
+        tags = sidecars.get(name, [])
+        stem = os.path.splitext(name)[0]
+        if stem != name:
+            tags = tags + sidecars.get(stem, [])
+        return tags
+
+    def save(self):
+        if not self.cache_path:
+            return
+
+        with self.save_lock:
+            # A copy, since other threads can add to the cache while it is written
+            with self.lock:
+                if not self.changed:
+                    return
+                cache = dict(self.cache)
+                self.changed = False
+
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f'{self.cache_path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(cache, fp, separators=(',', ':'))
+            os.replace(tmp_path, self.cache_path)
@@ -3,8 +3,12 @@ import datetime
 
 
 def run(filepath):
+    # The stat_result is kept as is, it is a lot smaller than the dict from view()
+    return os.stat(filepath)
+
+
+def view(stat):
     stat_datastore = {}
-    stat = os.stat(filepath)
     for keyname in dir(stat):
         if not keyname.startswith('st_'):
             continue
@@ -22,3 +26,14 @@ def run(filepath):
         stat_datastore[keyname] = value
 
     return stat_datastore
+
+
+def lookup(stat, keys):
+    # Used by --where, gets eg. ['size'] or ['mtime', 'year'] without making the whole view
+    value = getattr(stat, f'st_{keys[0]}')
+    if keys[0] in ['atime', 'ctime', 'mtime'] and len(keys) > 1:
+        timestamp = datetime.datetime.fromtimestamp(value)
+        if keys[1] == 'iso':
+            return timestamp.isoformat()
+        return getattr(timestamp, keys[1])
+    return value
@@ -1,17 +1,61 @@
+import os
+
 import filetype
 
 filetype_matchers = [i for i in dir(filetype) if i.endswith('_matchers')]
 
+# The group (image, video, ..) of every type filetype knows about
+GROUPS = {
+    type(matcher): fm.split('_')[0]
+    for fm in filetype_matchers
+    for matcher in getattr(filetype, fm)
+}
+
+# Other extensions often used for the same type
+EXTENSION_ALIASES = {
+    'jpeg': 'jpg',
+    'jpe': 'jpg',
+    'tiff': 'tif',
+    'mpeg': 'mpg',
+    'htm': 'html',
+}
+
+
+def _extension_table():
+    # Extension -> type, for the extensions only one type uses. The others needs to be looked at.
+    found = {}
+    for matcher in filetype.types:
+        found.setdefault(matcher.extension, []).append(matcher)
+
+    table = {ext: matchers[0] for ext, matchers in found.items() if len(matchers) == 1}
+    for alias, ext in EXTENSION_ALIASES.items():
+        if ext in table:
+            table[alias] = table[ext]
+    return table
+
+
+EXTENSIONS = _extension_table()
+
 
 def get_filetype_data_group(filetype_obj):
-    for fm in filetype_matchers:
-        if filetype_obj in getattr(filetype, fm):
-            return fm.split('_')[0]
-    return ''
+    return GROUPS.get(type(filetype_obj), '')
+
 
+def setup(options=None):
+    # verify=1 looks at the content of all files, not trusting the extension
+    options = options or {}
+    return {'verify': str(options.get('verify', '')).lower() in ('1', 'true', 'yes')}
 
-def run(filepath):
-    filetype_obj = filetype.guess(filepath)
+
+def run(filepath, options=None):
+    # Files are mostly named after what they are, so the extension is used when we know it.
+    # Only files with an unknown extension are opened, unless we are asked to verify.
+    filetype_obj = None
+    if not (options and options['verify']):
+        filetype_obj = EXTENSIONS.get(os.path.splitext(filepath)[1][1:].lower())
+
+    if not filetype_obj:
+        filetype_obj = filetype.guess(filepath)
     if not filetype_obj:
         return {}
 
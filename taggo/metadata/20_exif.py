@@ -1,5 +1,7 @@
 import piexif
 
+from taggo import utils
+
 
 def run(filepath):
 
@@ -8,12 +10,8 @@ def run(filepath):
     except piexif.InvalidImageDataError:
         return {}
 
-    # How to present?
-    # exifdata['GPS'][piexif.GPSIFD.GPSLatitudeRef],  # N
-    # exifdata['GPS'][piexif.GPSIFD.GPSLatitude],     # ((59, 1), (50, 1), (1111, 100))
-    # exifdata['GPS'][piexif.GPSIFD.GPSLongitudeRef], # E
-    # exifdata['GPS'][piexif.GPSIFD.GPSLongitude],    # (10, 1), (50, 1), (3000, 100))
-    gpslatlon = None
+    # [lat, lon] in decimal degrees, negative for S and W
+    gpslatlon = utils.exif_latlon(exifdata['GPS'])
 
     return {
         'ImageLength': exifdata['0th'].get(piexif.ImageIFD.ImageLength, b''),
@@ -0,0 +1,163 @@
+import struct
+
+# Only the headers are read, never the image data. Everything we need is in the first few bytes,
+# except for jpeg, where we jump from segment to segment until the one with the size.
+HEADER_SIZE = 32
+
+# The exif part of a jpeg we look at for the orientation
+EXIF_READ_SIZE = 4096
+
+# Start of frame markers, they have the size of the image
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+# Markers without a length after them
+JPEG_STANDALONE_MARKERS = {0x01, 0xd0, 0xd1, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8}
+
+NO_GEOMETRY = {
+    'format': '',
+    'width': None,
+    'height': None,
+    'orientation': '',
+    'megapixels': None,
+}
+
+
+def _png(header, fp):
+    if header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def _gif(header, fp):
+    return struct.unpack('<HH', header[6:10])
+
+
+def _bmp(header, fp):
+    dib_size, = struct.unpack('<I', header[14:18])
+    if dib_size == 12:
+        return struct.unpack('<HH', header[18:22])
+    width, height = struct.unpack('<ii', header[18:26])
+    # Negative height means the rows are stored top-down
+    return abs(width), abs(height)
+
+
+def _webp(header, fp):
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and header[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L' and header[20] == 0x2f:
+        bits, = struct.unpack('<I', header[21:25])
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def _exif_orientation(data):
+    # The orientation tag (0x0112) in the first IFD of the exif (tiff) data
+    if data[:6] != b'Exif\x00\x00':
+        return None
+    tiff = data[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if not endian:
+        return None
+
+    try:
+        ifd_offset, = struct.unpack(endian + 'I', tiff[4:8])
+        entries, = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])
+        for num in range(entries):
+            entry = ifd_offset + 2 + num * 12
+            tag, _, _, value = struct.unpack(endian + 'HHIH', tiff[entry:entry + 10])
+            if tag == 0x0112:
+                return value
+    except struct.error:
+        pass
+    return None
+
+
+def _jpeg(header, fp):
+    fp.seek(2)
+    orientation = None
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        # Markers can be padded with any number of 0xff
+        while marker[1] == 0xff:
+            marker = marker[1:] + fp.read(1)
+            if len(marker) < 2:
+                return None
+
+        if marker[1] in JPEG_STANDALONE_MARKERS:
+            continue
+
+        length_data = fp.read(2)
+        if len(length_data) < 2:
+            return None
+        length, = struct.unpack('>H', length_data)
+
+        if marker[1] in JPEG_SOF_MARKERS:
+            data = fp.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            # Orientation 5-8 is rotated 90 degrees, so it is shown the other way around
+            if orientation in (5, 6, 7, 8):
+                width, height = height, width
+            return width, height
+
+        if marker[1] == 0xe1 and orientation is None:
+            data = fp.read(min(length - 2, EXIF_READ_SIZE))
+            orientation = _exif_orientation(data)
+            fp.seek(length - 2 - len(data), 1)
+        else:
+            fp.seek(length - 2, 1)
+
+
+# (format, magic bytes, offset of magic, parser)
+FORMATS = [
+    ('png', b'\x89PNG\r\n\x1a\n', 0, _png),
+    ('jpeg', b'\xff\xd8', 0, _jpeg),
+    ('gif', b'GIF87a', 0, _gif),
+    ('gif', b'GIF89a', 0, _gif),
+    ('webp', b'WEBP', 8, _webp),
+    ('bmp', b'BM', 0, _bmp),
+]
+
+
+def orientation(width, height):
+    if width > height:
+        return 'landscape'
+    if width < height:
+        return 'portrait'
+    return 'square'
+
+
+def run(filepath):
+    try:
+        with open(filepath, 'rb') as fp:
+            header = fp.read(HEADER_SIZE)
+            for name, magic, offset, parser in FORMATS:
+                if header[offset:offset + len(magic)] == magic:
+                    break
+            else:
+                return NO_GEOMETRY
+
+            size = parser(header, fp)
+    except (OSError, struct.error, IndexError):
+        return NO_GEOMETRY
+
+    if not size:
+        return NO_GEOMETRY
+
+    width, height = size
+    return {
+        'format': name,
+        'width': width,
+        'height': height,
+        'orientation': orientation(width, height),
+        'megapixels': round(width * height / 1000000, 2),
+    }
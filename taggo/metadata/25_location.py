@@ -0,0 +1,144 @@
+import os
+import csv
+import math
+import threading
+
+from collections import defaultdict
+
+import piexif
+
+from taggo import utils
+
+# Major cities and capitals. A bigger list can be used with the places option, either a csv like this
+# one (name,country,lat,lon), or a GeoNames dump (like cities15000.txt from https://download.geonames.org)
+PLACES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'places.csv')
+
+EARTH_RADIUS_KM = 6371.0
+
+# Coordinates are rounded to this many decimals (~1km) before they are looked up, and the result is
+# cached. Photos are mostly taken in the same places, so most of them never need a lookup.
+PRECISION = 2
+
+NO_LOCATION = {
+    'lat': None,
+    'lon': None,
+    'city': '',
+    'country': '',
+    'distance': None,
+}
+
+
+def _load_places(filename):
+    places = []
+    with open(filename, newline='', encoding='utf-8') as fp:
+        if filename.endswith('.csv'):
+            for row in csv.DictReader(fp):
+                places.append((row['name'], row['country'], float(row['lat']), float(row['lon'])))
+        else:
+            # GeoNames: name is the 2nd column, latitude, longitude the 5th and 6th and country the 9th
+            for line in fp:
+                row = line.rstrip('\n').split('\t')
+                places.append((row[1], row[8], float(row[4]), float(row[5])))
+    return places
+
+
+def _unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+class Places:
+    """
+    Nearest place lookup. The places are put in a grid of cubes over their position on a unit
+    sphere, so a lookup only looks at the places in the cubes around the coordinate, going further
+    out until no closer place can exist. The straight line (chord) between two points on the sphere
+    grows with the distance on the surface, so the nearest by one is also the nearest by the other.
+    """
+
+    def __init__(self, places):
+        self.places = places
+        # About one place per cube on the surface
+        self.cell_size = math.sqrt(4 * math.pi / max(len(places), 1))
+        self.grid = defaultdict(list)
+        for place in places:
+            vector = _unit_vector(place[2], place[3])
+            self.grid[self._cell(vector)].append((vector, place))
+
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def _cell(self, vector):
+        return tuple(int(math.floor(v / self.cell_size)) for v in vector)
+
+    def _nearest(self, lat, lon):
+        vector = _unit_vector(lat, lon)
+        vx, vy, vz = vector
+        cx, cy, cz = self._cell(vector)
+        max_ring = int(2 / self.cell_size) + 1
+
+        best, best_chord = None, None
+        for ring in range(max_ring + 1):
+            # Everything not looked at yet is more than (ring - 1) * cell_size away
+            if best_chord is not None and best_chord <= (ring - 1) * self.cell_size:
+                break
+
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    on_side = abs(x - cx) == ring or abs(y - cy) == ring
+                    for z in (range(cz - ring, cz + ring + 1) if on_side else (cz - ring, cz + ring)):
+                        for (px, py, pz), place in self.grid.get((x, y, z), ()):
+                            chord = math.sqrt((vx - px) ** 2 + (vy - py) ** 2 + (vz - pz) ** 2)
+                            if best_chord is None or chord < best_chord:
+                                best, best_chord = place, chord
+
+        if best is None:
+            return None
+        return best, 2 * EARTH_RADIUS_KM * math.asin(min(best_chord / 2, 1.0))
+
+    def lookup(self, lat, lon):
+        key = (round(lat, PRECISION), round(lon, PRECISION))
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        found = self._nearest(*key)
+        with self.lock:
+            self.cache[key] = found
+        return found
+
+
+# When exif is enabled, the position it found is used, and the file is not read again
+uses = ('exif',)
+
+
+def setup(options=None):
+    # The places are read, and the grid is made, once per run
+    options = options or {}
+    return Places(_load_places(options.get('places', PLACES)))
+
+
+def run(filepath, places=None, exif=None):
+    if exif is not None:
+        latlon = exif.get('GPSLatLon')
+    else:
+        try:
+            latlon = utils.exif_latlon(piexif.load(filepath)['GPS'])
+        except (piexif.InvalidImageDataError, ValueError, OSError):
+            return NO_LOCATION
+
+    if not latlon:
+        return NO_LOCATION
+
+    lat, lon = latlon
+    found = (places or setup()).lookup(lat, lon)
+    if not found:
+        return dict(NO_LOCATION, lat=lat, lon=lon)
+
+    (city, country, _, _), distance = found
+    return {
+        'lat': lat,
+        'lon': lon,
+        'city': city,
+        'country': country,
+        'distance': round(distance, 1),
+    }
@@ -0,0 +1,152 @@
+import re
+import struct
+import datetime
+
+# mp4, mov, m4v, 3gp and the other ISO base media files are made of boxes (size, type, data).
+# We only read the headers of the boxes on the way to the ones we need, and never the media.
+
+# Seconds between 1904-01-01, where the times in the boxes starts, and 1970-01-01
+EPOCH_1904 = 2082844800
+
+# Boxes we read all of, are never bigger than this
+MAX_BOX_READ = 64 * 1024
+
+# Apple stores the location as "+59.9139+010.7522+000.000/"
+iso6709_re = re.compile(r'([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)')
+
+USER_DATA_TEXT = {
+    b'\xa9mak': 'make',
+    b'\xa9mod': 'model',
+}
+
+NO_VIDEO = {
+    'duration': None,
+    'width': None,
+    'height': None,
+    'creation_time': None,
+    'location': None,
+    'make': '',
+    'model': '',
+}
+
+
+def _boxes(fp, start, end):
+    # Yields (type, data start, box end) for the boxes from start to end
+    offset = start
+    while end is None or offset + 8 <= end:
+        fp.seek(offset)
+        header = fp.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        data_start = offset + 8
+
+        if size == 1:
+            largesize = fp.read(8)
+            if len(largesize) < 8:
+                return
+            size, = struct.unpack('>Q', largesize)
+            data_start += 8
+        elif size == 0:
+            # The rest of the file
+            fp.seek(0, 2)
+            size = fp.tell() - offset
+
+        if size < data_start - offset:
+            return
+
+        yield box_type, data_start, offset + size
+        offset += size
+
+
+def _read(fp, start, end):
+    fp.seek(start)
+    return fp.read(min(end - start, MAX_BOX_READ))
+
+
+def _timestamp(seconds):
+    if not seconds:
+        return None
+    try:
+        timestamp = datetime.datetime.fromtimestamp(seconds - EPOCH_1904, datetime.timezone.utc)
+    except (OverflowError, OSError, ValueError):
+        return None
+    return {
+        'iso': timestamp.isoformat(),
+        'year': timestamp.year,
+        'month': timestamp.month,
+        'day': timestamp.day
+    }
+
+
+def _mvhd(data):
+    if data[0] == 1:
+        creation, _, timescale, duration = struct.unpack('>QQIQ', data[4:32])
+    else:
+        creation, _, timescale, duration = struct.unpack('>IIII', data[4:20])
+    return creation, (duration / timescale if timescale else None)
+
+
+def _tkhd(data):
+    # Width and height are 16.16 fixed point, after the matrix telling how the video is turned
+    offset = 4 + (32 if data[0] == 1 else 20) + 16
+    matrix = struct.unpack('>9i', data[offset:offset + 36])
+    width, height = struct.unpack('>II', data[offset + 36:offset + 44])
+    width, height = width >> 16, height >> 16
+
+    # Turned 90 or 270 degrees
+    if matrix[0] == 0 and abs(matrix[1]) == 0x10000:
+        width, height = height, width
+    return width, height
+
+
+def _udta(fp, start, end, result):
+    for box_type, data_start, box_end in _boxes(fp, start, end):
+        if box_type == b'\xa9xyz' or box_type in USER_DATA_TEXT:
+            data = _read(fp, data_start, box_end)
+            # 2 bytes length and 2 bytes language, then the text
+            length, = struct.unpack('>H', data[:2])
+            text = data[4:4 + length].decode('utf-8', errors='replace')
+
+            if box_type == b'\xa9xyz':
+                match = iso6709_re.match(text)
+                if match:
+                    result['location'] = [float(match.group(1)), float(match.group(2))]
+            else:
+                result[USER_DATA_TEXT[box_type]] = text
+
+
+def run(filepath):
+    result = dict(NO_VIDEO)
+    try:
+        with open(filepath, 'rb') as fp:
+            first = fp.read(8)
+            if first[4:8] not in (b'ftyp', b'moov', b'wide', b'free', b'mdat', b'skip'):
+                return NO_VIDEO
+
+            for box_type, start, end in _boxes(fp, 0, None):
+                if box_type != b'moov':
+                    continue
+
+                for child, child_start, child_end in _boxes(fp, start, end):
+                    if child == b'mvhd':
+                        creation, duration = _mvhd(_read(fp, child_start, child_end))
+                        result['creation_time'] = _timestamp(creation)
+                        result['duration'] = round(duration, 3) if duration is not None else None
+                    elif child == b'trak' and not result['width']:
+                        for track_box, track_start, track_end in _boxes(fp, child_start, child_end):
+                            if track_box == b'tkhd':
+                                width, height = _tkhd(_read(fp, track_start, track_end))
+                                # Audio tracks have no size
+                                if width and height:
+                                    result['width'], result['height'] = width, height
+                                break
+                    elif child == b'udta':
+                        _udta(fp, child_start, child_end, result)
+                break
+            else:
+                return NO_VIDEO
+    except (OSError, struct.error, IndexError):
+        return NO_VIDEO
+
+    return result
@@ -0,0 +1,111 @@
+import os
+import stat
+import hashlib
+
+from collections import defaultdict
+
+# How much of the start and end of a file we look at before reading all of it
+CHUNK_SIZE = 4096
+
+# Files smaller than this are never looked at. All empty files are the same..
+MIN_SIZE = 1
+
+NOT_DUPLICATE = {
+    'group': '',
+    'count': 1,
+    'duplicate': False,
+    'first': True,
+}
+
+
+def _hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+def _partial_hash(filepath, size, chunk_size):
+    h = _hash()
+    with open(filepath, 'rb') as fp:
+        h.update(fp.read(chunk_size))
+        if size > chunk_size * 2:
+            fp.seek(-chunk_size, os.SEEK_END)
+            h.update(fp.read(chunk_size))
+        elif size > chunk_size:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def _full_hash(filepath):
+    h = _hash()
+    with open(filepath, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _split(groups, key):
+    # Split every group with more than one file into new groups using key(path).
+    # Files that ends up alone are not duplicates, and are dropped.
+    new_groups = defaultdict(list)
+    for group_key, paths in groups.items():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            try:
+                new_groups[(group_key, key(path))].append(path)
+            except OSError:
+                pass
+    return new_groups
+
+
+def prepare(filepaths, options=None, dry=False):
+    # Finds the duplicates among all the files in the run, reading as little as possible.
+    #  1. Group by size, files with a unique size can't have a duplicate.
+    #  2. Group by a hash of the start and end of the files.
+    #  3. Group by a hash of the whole file, but only for the files still in a group, and that
+    #     wasn't completely read in step 2.
+    options = options or {}
+    chunk_size = int(options.get('chunk_size', CHUNK_SIZE))
+    min_size = int(options.get('min_size', MIN_SIZE))
+
+    sizes = defaultdict(list)
+    for filepath in filepaths:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+            sizes[st.st_size].append(filepath)
+
+    groups = _split(
+        sizes,
+        lambda path: _partial_hash(path, os.path.getsize(path), chunk_size)
+    )
+
+    full_groups = {}
+    for (size, partial), paths in groups.items():
+        if len(paths) < 2:
+            continue
+        if size <= chunk_size * 2:
+            # The partial hash was of the whole file
+            full_groups[partial] = paths
+        else:
+            for (_, full), same in _split({None: paths}, _full_hash).items():
+                if len(same) > 1:
+                    full_groups[full] = same
+
+    state = {}
+    for group, paths in full_groups.items():
+        first = min(paths)
+        for path in paths:
+            state[path] = {
+                'group': group,
+                'count': len(paths),
+                'duplicate': True,
+                'first': path == first,
+            }
+
+    return state
+
+
+def run(filepath, state=None):
+    return (state or {}).get(filepath, NOT_DUPLICATE)
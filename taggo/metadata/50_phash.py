@@ -0,0 +1,264 @@
+import io
+import os
+import json
+import math
+import struct
+import threading
+
+import numpy
+from PIL import Image
+
+from taggo import lookups
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+
+# Images with at most this many bits different in their phash are in the same group
+DISTANCE = 6
+
+# The size the image is scaled to before the DCT, and how much of the DCT is used
+DCT_SIZE = 32
+HASH_SIZE = 8
+
+# What reading an image that is broken, or not an image, can raise
+UNREADABLE = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
+
+NO_HASH = {
+    'dhash': '',
+    'phash': '',
+    'group': '',
+    'count': 1,
+    'similar': False,
+}
+
+
+def default_cache_path():
+    return os.path.join(os.path.dirname(lookups.default_cache_path()), 'phash.json')
+
+
+def _dct_matrix(size):
+    # DCT-II as a matrix, so the DCT of an image is two matrix multiplications
+    k = numpy.arange(size).reshape(-1, 1)
+    n = numpy.arange(size).reshape(1, -1)
+    matrix = numpy.cos(math.pi / size * (n + 0.5) * k) * math.sqrt(2 / size)
+    matrix[0] /= math.sqrt(2)
+    return matrix
+
+
+DCT = _dct_matrix(DCT_SIZE)
+
+
+def _resize(pixels, width, height):
+    # Box filter; the mean of the pixels that ends up in each new pixel
+    rows = numpy.linspace(0, pixels.shape[0], height + 1).astype(int)[:-1]
+    cols = numpy.linspace(0, pixels.shape[1], width + 1).astype(int)[:-1]
+    summed = numpy.add.reduceat(numpy.add.reduceat(pixels, rows, axis=0), cols, axis=1)
+    counts = numpy.outer(
+        numpy.diff(numpy.append(rows, pixels.shape[0])),
+        numpy.diff(numpy.append(cols, pixels.shape[1]))
+    )
+    return summed / counts
+
+
+def _bits_to_hex(bits):
+    return '%016x' % int(''.join('1' if b else '0' for b in bits.flatten()), 2)
+
+
+def _exif_thumbnail(image):
+    # Most cameras store a small jpeg in the exif, we don't need more than that
+    exif = image.info.get('exif')
+    if not exif:
+        return None
+    try:
+        import piexif
+        thumbnail = piexif.load(exif).get('thumbnail')
+    except (ImportError, ValueError, KeyError, IndexError, struct.error):
+        return None
+    if not thumbnail:
+        return None
+
+    return Image.open(io.BytesIO(thumbnail))
+
+
+def _grayscale(filepath):
+    image = Image.open(filepath)
+    if image.format == 'JPEG':
+        image = _exif_thumbnail(image) or image
+        # Let the jpeg decoder scale it down while decoding, instead of decoding all of it
+        image.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+    image = image.convert('L')
+
+    # Every pixel of the hash needs at least one pixel from the image
+    if min(image.size) < DCT_SIZE:
+        image = image.resize((max(image.size[0], DCT_SIZE), max(image.size[1], DCT_SIZE)))
+    return numpy.asarray(image, dtype=numpy.float64)
+
+
+def hashes(filepath):
+    pixels = _grayscale(filepath)
+
+    small = _resize(pixels, HASH_SIZE + 1, HASH_SIZE)
+    dhash = _bits_to_hex(small[:, 1:] > small[:, :-1])
+
+    dct = DCT @ _resize(pixels, DCT_SIZE, DCT_SIZE) @ DCT.T
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+    # The first one (the average) is left out of the median, it is much larger than the rest
+    phash = _bits_to_hex(low > numpy.median(low.flatten()[1:]))
+
+    return dhash, phash
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Finds the hashes within a distance of a hash, without comparing it to all of them. Every node
+    has its children by their distance to it, and by the triangle inequality only the children
+    within (distance - max, distance + max) can have a match.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        node = [value, [item], {}]
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            if distance not in current[2]:
+                current[2][distance] = node
+                return
+            current = current[2][distance]
+
+    def search(self, value, max_distance):
+        found = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node_value, items, children = nodes.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found += items
+            nodes += [
+                child for d, child in children.items()
+                if distance - max_distance <= d <= distance + max_distance
+            ]
+        return found
+
+
+class Cache:
+    # Hashes by path, used as long as the (inode, mtime, size) of the file is the same
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.changed = False
+        self.data = {}
+        if path:
+            try:
+                with open(path) as fp:
+                    self.data = json.load(fp)
+            except (OSError, ValueError):
+                pass
+
+    def hashes(self, filepath):
+        try:
+            st = os.stat(filepath)
+            valid = [st.st_ino, st.st_mtime_ns, st.st_size]
+        except OSError:
+            return None
+
+        entry = self.data.get(filepath)
+        if entry and entry[:3] == valid:
+            return tuple(entry[3:])
+
+        try:
+            result = hashes(filepath)
+        except UNREADABLE:
+            # Not an image we can read
+            result = None
+
+        with self.lock:
+            self.data[filepath] = valid + list(result or ['', ''])
+            self.changed = True
+        return result
+
+    def save(self):
+        if not self.changed or not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.data, fp, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+def prepare(filepaths, options=None, dry=False):
+    # Hashes all the images, and groups the ones that looks the same using a BK-tree
+    options = options or {}
+    max_distance = int(options.get('distance', DISTANCE))
+    cache = Cache(options.get('cache', default_cache_path()))
+
+    found = {}
+    for filepath in filepaths:
+        if filepath.lower().endswith(IMAGE_EXTS):
+            result = cache.hashes(filepath)
+            if result and result[1]:
+                found[filepath] = result
+    if not dry:
+        cache.save()
+
+    tree = BKTree()
+    for filepath, (_, phash) in found.items():
+        tree.add(int(phash, 16), filepath)
+
+    # Union-find, so images that are similar through another image ends up in the same group
+    parent = {filepath: filepath for filepath in found}
+
+    def root(filepath):
+        while parent[filepath] != filepath:
+            parent[filepath] = parent[parent[filepath]]
+            filepath = parent[filepath]
+        return filepath
+
+    for filepath, (_, phash) in found.items():
+        for other in tree.search(int(phash, 16), max_distance):
+            a, b = root(filepath), root(other)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+    groups = {}
+    for filepath in found:
+        groups.setdefault(root(filepath), []).append(filepath)
+
+    state = {}
+    for first, members in groups.items():
+        for filepath in members:
+            dhash, phash = found[filepath]
+            state[filepath] = {
+                'dhash': dhash,
+                'phash': phash,
+                'group': found[first][1] if len(members) > 1 else '',
+                'count': len(members),
+                'similar': len(members) > 1,
+            }
+    return state
+
+
+def run(filepath, state=None):
+    if state is not None:
+        return state.get(filepath, NO_HASH)
+
+    if not filepath.lower().endswith(IMAGE_EXTS):
+        return NO_HASH
+    try:
+        dhash, phash = hashes(filepath)
+    except UNREADABLE:
+        return NO_HASH
+    return dict(NO_HASH, dhash=dhash, phash=phash)
@@ -0,0 +1,189 @@
+import os
+import json
+import zlib
+import threading
+
+from . import exceptions
+
+# The collision report each shard writes to dst
+REPORT_NAME = ".taggo-shard-{shard}-of-{shards}"
+REPORT_PREFIX = ".taggo-shard-"
+
+# Collision rules where an existing link is replaced by the new one
+OVERWRITING_RULES = (None, 'smart', 'overwrite-if-symlink', 'overwrite-if-dst-same')
+
+
+def parse(value):
+    # "K/N" -> (K, N), K counting from 1
+    try:
+        shard, shards = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise exceptions.Error(f"Invalid shard '{value}', use K/N, like 1/4")
+
+    if not 1 <= shard <= shards:
+        raise exceptions.Error(f"Invalid shard '{value}', K must be from 1 to N")
+    return shard, shards
+
+
+class Shard:
+    """
+    One of N parts of src. Everything is put in a part by a stable hash (crc32) of its first depth
+    folders relative to src, so the same folders always ends up in the same part, on every machine.
+    """
+
+    def __init__(self, shard, shards, depth=1):
+        if not 1 <= shard <= shards:
+            raise exceptions.Error(f"Invalid shard {shard}/{shards}, K must be from 1 to N")
+        if depth < 1:
+            raise exceptions.Error(f"Invalid shard depth {depth}, it must be at least 1")
+        self.shard = shard
+        self.shards = shards
+        self.depth = depth
+
+    def __str__(self):
+        return f'{self.shard}/{self.shards}'
+
+    def __contains__(self, relative_path):
+        key = '/'.join(relative_path.split('/')[:self.depth])
+        return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % self.shards == self.shard - 1
+
+    def walk_filter(self, folder, dirnames, filenames):
+        # folder is relative to src, '' for src itself. Folders above depth are walked by every shard,
+        # and everything below depth is in the same part as the folder at depth.
+        depth = folder.count('/') + 1 if folder else 0
+        if depth >= self.depth:
+            return dirnames, filenames
+
+        prefix = folder + '/' if folder else ''
+        if depth + 1 == self.depth:
+            dirnames = [d for d in dirnames if prefix + d in self]
+        return dirnames, [f for f in filenames if prefix + f in self]
+
+
+class Report:
+    """
+    The collisions a shard saw, written to dst so they can be merged when all shards are done.
+    One json-object per line; a header, the collisions (the link relative to dst) and a last line
+    saying the shard finished.
+    """
+
+    def __init__(self, dst, shard, collision_rule=None, dry=False):
+        self.dst = dst
+        self.path = os.path.join(dst, REPORT_NAME.format(shard=shard.shard, shards=shard.shards))
+        self.lock = threading.Lock()
+        self.fp = None
+        if dry:
+            return
+
+        os.makedirs(dst, exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.fp = open(self.path, 'w')
+
+        # The clock of the filesystem dst is on, so it can be compared to the time of the links in it
+        started = os.fstat(self.fp.fileno()).st_mtime_ns
+        self._write({
+            'shard': shard.shard,
+            'shards': shard.shards,
+            'depth': shard.depth,
+            'collision_rule': collision_rule,
+            'started': started,
+        })
+
+    def _write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.fp.write(line + '\n')
+
+    def add(self, events):
+        if not self.fp:
+            return
+        for event in events:
+            if event['category'] != 'collision':
+                continue
+            self._write({
+                'link': os.path.relpath(event['symlink_full_path'], self.dst),
+                'existing': event['existing_symlink_destination'],
+                'existing_mtime': event.get('existing_mtime'),
+                'wanted': event['symlink_destination'],
+                'overwritten': event['overwritten'],
+            })
+
+    def done(self):
+        if self.fp:
+            self._write({'done': True})
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+def _read_report(path):
+    header, collisions, done = None, [], False
+    with open(path) as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Interrupted while writing the last line
+                continue
+
+            if header is None:
+                header = entry
+            elif entry.get('done'):
+                done = True
+            else:
+                collisions.append(entry)
+
+    if header is None:
+        raise exceptions.Error(f"Shard report '{path}' is empty")
+    return dict(header, path=path, collisions=collisions, done=done)
+
+
+def load(dst):
+    # Reads the reports of all the shards in dst, and checks that they are all there and done
+    paths = sorted(
+        os.path.join(dst, name) for name in os.listdir(dst)
+        if name.startswith(REPORT_PREFIX)
+    )
+    if not paths:
+        raise exceptions.NotFoundException(f"Found no shard reports in '{dst}'")
+
+    reports = [_read_report(path) for path in paths]
+
+    counts = {report['shards'] for report in reports}
+    if len(counts) > 1:
+        raise exceptions.Error(f"Reports from runs with different number of shards in '{dst}': {sorted(counts)}")
+    shards = counts.pop()
+
+    missing = set(range(1, shards + 1)) - {report['shard'] for report in reports}
+    if missing:
+        raise exceptions.Error(f"Missing reports from shard {', '.join(str(s) for s in sorted(missing))} of {shards}")
+
+    unfinished = [report['shard'] for report in reports if not report['done']]
+    if unfinished:
+        raise exceptions.Error(f"Shard {', '.join(str(s) for s in unfinished)} of {shards} did not finish")
+
+    if len({report['collision_rule'] for report in reports}) > 1:
+        raise exceptions.Error("The shards used different collision-handlers")
+
+    return reports
+
+
+def claims(reports):
+    # {link: destinations} for the links more than one file wanted. A link that was there when we
+    # found it only counts if it was made after the first shard started, else it is from an earlier run.
+    started = min(report['started'] for report in reports)
+
+    found = {}
+    for report in reports:
+        for collision in report['collisions']:
+            wanted = found.setdefault(collision['link'], set())
+            wanted.add(collision['wanted'])
+            existing_mtime = collision.get('existing_mtime')
+            if collision['existing'] is not None and existing_mtime is not None and existing_mtime >= started:
+                wanted.add(collision['existing'])
+    return found
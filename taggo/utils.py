@@ -4,7 +4,7 @@ import logging
 
 from collections import defaultdict
 
-from . import filters
+from . import (exceptions, filters)
 
 logger = logging.getLogger("taggo")
 
@@ -51,51 +51,121 @@ def get_rel_folders_string(relative_path, is_file):
         return '_'.join(relative_path[:-1])
 
 
+def gps_degrees(rationals, ref):
+    # ((59, 1), (50, 1), (1111, 100)), b'N' -> 59.83641..
+    try:
+        degrees, minutes, seconds = [num / den for num, den in rationals]
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+    value = degrees + minutes / 60 + seconds / 3600
+    if ref in (b'S', b'W', 'S', 'W'):
+        value = -value
+    return value
+
+
+def exif_latlon(gps):
+    # Latitude and longitude from the GPS part of piexif's exif-data, or None
+    # 1, 2, 3 and 4 are GPSLatitudeRef, GPSLatitude, GPSLongitudeRef and GPSLongitude
+    if 2 not in gps or 4 not in gps:
+        return None
+
+    lat = gps_degrees(gps[2], gps.get(1))
+    lon = gps_degrees(gps[4], gps.get(3))
+    if lat is None or lon is None:
+        return None
+    return [lat, lon]
+
+
 def from_string_to_py(value, filtername):
-    # All we got in filters are strings... We need to convert them to make them easier to handle
+    # All we got in filters are strings... We need to convert them to make them easier to handle,
+    # and we do everything we can up front, so the filter itself is as quick as possible.
+    if filtername in ['exact', 'neq']:
+        # The data can be a string or something else (stat.size is a number), so keep all the forms
+        forms = [value]
+        if value == 'None':
+            forms.append(None)
+        elif value in ['True', 'False']:
+            forms.append(value == 'True')
+        else:
+            for convert in (int, float):
+                try:
+                    forms.append(convert(value))
+                    break
+                except ValueError:
+                    pass
+        return tuple(forms)
+
     if value == 'None':
         return None
 
-    if filtername in ['contains', 'icontains']:
-        return value.split(',')
+    if value in ['True', 'False']:
+        return value == 'True'
+
+    if filtername == 'contains':
+        return frozenset(value.split(','))
+
+    if filtername == 'icontains':
+        return frozenset(i.lower() for i in value.split(','))
+
+    if filtername in ['iexact', 'istartswith', 'iendswith']:
+        return value.lower()
 
     if filtername in ['gt', 'gte', 'lt', 'lte']:
         return int(value)
 
+    if filtername == 'regex':
+        return re.compile(value)
+
     # Nothing special to do..
     return value
 
 
-def make_filters(filter_list):
+def make_filters(filter_list, plugins=()):
     # param: test, value: [a,b,c], filter: contains
     # param: test2, value: something, filter: exact
-    # param: filetype_group, value: image, filter: exact
+    # param: filetype.group, value: image, filter: exact
 
     ready_filters = defaultdict(list)
 
     for f in filter_list:
-        # 'filetype_group=image'
-        # 'filetype_group__in=image,video'
-        parts = f.rsplit('__', 1)
-        if len(parts) == 1:
-            search_param, search_value = parts[0].rsplit('=', 1)
-            search_filtername = 'exact'
-        else:
-            search_param, search_info = parts
-            search_filtername, search_value = search_info.rsplit('=', 1)
-
-        search_value = from_string_to_py(search_value, search_filtername)
-
-        func = getattr(filters, search_filtername)
+        # 'filetype.group=image'
+        # 'filetype.group__icontains=image,video'
+        try:
+            search_param, search_value = f.split('=', 1)
+        except ValueError:
+            raise exceptions.Error(f"Invalid filter ({f}). Need an = sign")
+
+        search_filtername = 'exact'
+        parts = search_param.rsplit('__', 1)
+        if len(parts) == 2:
+            search_param, search_filtername = parts
+
+        func = filters.OPERATORS.get(search_filtername)
+        if func is None:
+            raise exceptions.Error(f"Invalid filter ({f}). Unknown operator: {search_filtername}")
+
+        try:
+            search_value = from_string_to_py(search_value, search_filtername)
+        except (ValueError, re.error) as e:
+            raise exceptions.Error(f"Invalid filter ({f}). {e}")
 
         # We run filters by group, trying to run them in the correct order.
-        # Those filter that doesnt belong to a group should be quick to execute. We put them first.
-        group = search_param.split('_')[0]
-        if group not in ['filetype']:
-            group = 'pre'
+        # Those that only need the path are quick to execute, and run before any metadata plugins.
+        # Those that needs a plugin runs right after it, before any other plugins.
+        key = search_param.split('.')
+        if key[0] == 'path':
+            key = key[1:]
+
+        if key[0] in plugins:
+            group = f'after-{key[0]}'
+        elif key[0] == 'tag':
+            group = 'late'
+        else:
+            group = 'early'
 
         ready_filters[group].append({
-            'key': search_param,
+            'key': key,
             'value': search_value,
             'func': func,
         })
@@ -5,6 +5,7 @@ import os
 import re
 import glob
 import json
+import datetime
 import shutil
 import textwrap
 
@@ -28,6 +29,15 @@ There are a bunch of test-files under tests/test_files, here are some higlights.
 test_files = "tests/test_files/"
 
 
+def symlinks_in(path):
+    # The symlinks below path (relative to it), and where they point
+    return sorted(
+        (os.path.relpath(os.path.join(root, name), path), os.readlink(os.path.join(root, name)))
+        for root, dirs, files in os.walk(path) for name in dirs + files
+        if os.path.islink(os.path.join(root, name))
+    )
+
+
 def test_noargs(capsys):
     with pytest.raises(SystemExit) as ex:
         taggo.main([])
@@ -81,7 +91,8 @@ def test_misc1(tmpdir):
     ).endswith('tests/test_files/files_flat/ƂƃƄƅƆƇƈ #ѤѥѦѧѨ ƉƊƋƌƍƎƏƐƑ.txt')
 
 
-def test_frontmatter(tmpdir):
+def test_frontmatter(tmpdir, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", f"{tmpdir}/cache")
     taggo.main(["run", test_files, str(tmpdir), "--nametemplate", "{tag.as-folders}/{path.basename}", "--tag-lookup", "frontmatter"])
 
     for filepath in [
@@ -227,3 +238,956 @@ def test_rename(caplog, tmpdir):
     with pytest.raises(SystemExit) as ex:
         taggo.main(["rename", tmp, "tag", "tag"])
     assert ex.value.code == 2
+
+
+def test_rename_with_dst(monkeypatch, tmpdir):
+    src = f"{tmpdir}/src"
+    dst = f"{tmpdir}/dst"
+    shutil.copytree("tests/test_files", src, symlinks=True)
+    shutil.rmtree(f"{src}/cleanup_files")
+    nametemplate = "{tag[as-folders]}/{path[basename]}"
+    taggo.main(["run", "--nametemplate", nametemplate, src, dst])
+
+    assert os.path.islink(f"{dst}/tag1/a file #tag1 #tag2 #tag3.txt")
+    assert len(glob.glob(f"{dst}/tag9/*#tag6*")) == 1
+
+    taggo.main(["rename", "--dst", dst, "--nametemplate", nametemplate, src, "tag1", "newtag1"])
+    assert not os.path.lexists(f"{dst}/tag1/a file #tag1 #tag2 #tag3.txt")
+    assert os.path.isfile(f"{dst}/newtag1/a file #newtag1 #tag2 #tag3.txt")
+    assert os.path.isfile(f"{dst}/tag2/a file #newtag1 #tag2 #tag3.txt")
+    assert not os.path.lexists(f"{dst}/tag2/a file #tag1 #tag2 #tag3.txt")
+
+    # Renaming a folder, makes the links to the folders inside it point to the new place
+    taggo.main(["rename", "--dst", dst, "--nametemplate", nametemplate, src, "tag6", "newtag6"])
+    assert not glob.glob(f"{dst}/tag9/*#tag6*")
+    assert len(glob.glob(f"{dst}/tag9/*#newtag6*")) == 1
+
+    for root, dirs, files in os.walk(dst):
+        for name in dirs + files:
+            assert os.path.exists(os.path.join(root, name))
+
+    # The links are made again with the same options as the run, so only what the run linked is linked again
+    dst2 = f"{tmpdir}/dst2"
+    options = [
+        "--metadata", "stat", "--where", "file-ext__iexact=txt",
+        "--nametemplate", "{tag[name]}/{path[stat][size]} {path[basename]}"
+    ]
+    taggo.main(["run", *options, src, dst2])
+    assert os.path.islink(f"{dst2}/tag2/0 #newtag1 #tag2.txt")
+    assert not os.path.exists(f"{dst2}/human")
+
+    taggo.main(["rename", "--dst", dst2, *options, src, "tag2", "newtag2"])
+    assert os.path.isfile(f"{dst2}/newtag2/0 #newtag1 #newtag2.txt")
+    assert not os.path.lexists(f"{dst2}/tag2/0 #newtag1 #tag2.txt")
+
+    taggo.main(["rename", "--dst", dst2, *options, src, "human", "person"])
+    assert not os.path.exists(f"{dst2}/person")
+
+    # Only the renamed paths are checked against the ignore rules, src is not walked again to find them
+    src = f"{tmpdir}/src3"
+    for folder in ["a", "b", "c/d/e", "f/#red/g"]:
+        os.makedirs(f"{src}/{folder}")
+    for name in ["a/x #red.txt", "a/y #red.txt", "b/z #red.txt", "c/d/e/w #red.txt", "f/#red/g/v"]:
+        open(f"{src}/{name}", "w").close()
+    with open(f"{src}/b/.taggoignore", "w") as fp:
+        fp.write("z*\n")
+    options = ["--exclude", "a/y*", "--nametemplate", "{tag[name]}/{path[basename]}"]
+    taggo.main(["run", *options, src, f"{tmpdir}/dst3"])
+    assert sorted(os.listdir(f"{tmpdir}/dst3/red")) == ["w #red.txt", "x #red.txt"]
+
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path="."):
+        listed.append(os.fspath(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    taggo.main(["rename", "--dst", f"{tmpdir}/dst3", *options, src, "red", "blue"])
+    assert sorted(os.listdir(f"{tmpdir}/dst3/blue")) == ["w #blue.txt", "x #blue.txt"]
+    # What was in a renamed folder is looked for again, under its new name
+    src_listed = [path for path in listed if path.startswith(src) and "#blue" not in path]
+    assert sorted(src_listed) == sorted(set(src_listed))
+
+
+def test_rename_mapping_file(tmpdir):
+    src = f"{tmpdir}/src"
+    shutil.copytree("tests/test_files/files_flat", src)
+
+    mapping = f"{tmpdir}/mapping"
+    with open(mapping, "w") as fp:
+        fp.write("tag1 tag2\n\ntag2 tag3\ntag1-a-b-c abc\n")
+
+    taggo.main(["rename", "--mapping-file", mapping, src])
+    assert os.path.isfile(f"{src}/a file #tag2 #tag3 #tag3.txt")
+    assert os.path.isfile(f"{src}/#tag2 #tag1-a-b(b).txt")
+    assert os.path.isfile(f"{src}/a file #abc.txt")
+    assert not os.path.exists(f"{src}/{taggo.RENAME_JOURNAL_NAME}")
+
+
+def test_rename_journal(tmpdir):
+    src = f"{tmpdir}/src"
+    shutil.copytree("tests/test_files/folders_depth", src)
+    journal = taggo.Journal(f"{tmpdir}/journal")
+    journal.plan([
+        (f"{src}/#tag6/#tag7", f"{src}/#tag6/#newtag7"),
+        (f"{src}/#tag6", f"{src}/#newtag6"),
+    ])
+
+    # Interrupted after the first rename
+    os.rename(f"{src}/#tag6/#tag7", f"{src}/#tag6/#newtag7")
+    taggo.main(["rename", "--journal", f"{tmpdir}/journal", "--rollback", src])
+    assert os.path.isdir(f"{src}/#tag6/#tag7")
+    assert not os.path.exists(f"{tmpdir}/journal")
+
+    journal = taggo.Journal(f"{tmpdir}/journal")
+    journal.plan([
+        (f"{src}/#tag6/#tag7", f"{src}/#tag6/#newtag7"),
+        (f"{src}/#tag6", f"{src}/#newtag6"),
+    ])
+    # A dry resume only tells what it would do
+    taggo.main(["rename", "--journal", f"{tmpdir}/journal", "--resume", "--dry", src])
+    assert os.path.isdir(f"{src}/#tag6/#tag7")
+    assert os.path.isfile(f"{tmpdir}/journal")
+
+    taggo.main(["rename", "--journal", f"{tmpdir}/journal", "--resume", src])
+    assert os.path.isdir(f"{src}/#newtag6/#newtag7")
+    assert not os.path.exists(f"{tmpdir}/journal")
+
+    # Nothing is renamed onto something that is there already
+    os.makedirs(f"{src}/#tag6")
+    with pytest.raises(SystemExit) as ex:
+        taggo.main(["rename", src, "newtag6", "tag6"])
+    assert ex.value.code == 20
+    assert os.path.isdir(f"{src}/#newtag6/#newtag7")
+
+    # If it shows up after the rename was planned, the rename is left in the journal
+    journal = taggo.Journal(f"{tmpdir}/journal")
+    journal.plan([(f"{src}/#newtag6", f"{src}/#tag6")])
+    with pytest.raises(taggo.exceptions.CollisionException):
+        journal.forward()
+    assert taggo.Journal(f"{tmpdir}/journal").planned
+    os.rmdir(f"{src}/#tag6")
+    taggo.main(["rename", "--journal", f"{tmpdir}/journal", "--resume", src])
+    assert os.path.isdir(f"{src}/#tag6/#newtag7")
+
+
+def test_cleanup_empty_folders(tmpdir):
+    tmp = f"{tmpdir}/cleanup"
+    os.makedirs(f"{tmp}/tag/nested/deeper")
+    os.makedirs(f"{tmp}/keep")
+    os.symlink("../../../missing", f"{tmp}/tag/nested/deeper/dead")
+    os.symlink("../missing", f"{tmp}/tag/dead")
+    with open(f"{tmp}/keep/file", "w") as fp:
+        fp.write("")
+    os.symlink("../keep/file", f"{tmp}/tag/alive")
+
+    taggo.main(["cleanup", "--dry", tmp])
+    assert os.path.islink(f"{tmp}/tag/nested/deeper/dead")
+
+    taggo.main(["cleanup", "--threads", "2", tmp])
+    assert not os.path.exists(f"{tmp}/tag/nested")
+    assert not os.path.lexists(f"{tmp}/tag/dead")
+    assert os.path.islink(f"{tmp}/tag/alive")
+    assert os.path.isfile(f"{tmp}/keep/file")
+
+    # What exists is remembered per folder the links point into, for the folders used last
+    from collections import OrderedDict
+    from concurrent.futures import ThreadPoolExecutor
+
+    for folder in ["a", "b"]:
+        os.makedirs(f"{tmp}/{folder}")
+        open(f"{tmp}/{folder}/file", "w").close()
+    for num, target in enumerate(["a/file", "a/missing", "b/file", "gone/file", "a/file"]):
+        os.symlink(f"../{target}", f"{tmp}/tag/{num}")
+    links = [(f"{tmp}/tag/{num}", f"{tmp}/tag") for num in range(5)]
+    cache = OrderedDict()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = taggo._links_exists(links, executor, cache, size=2)
+    assert [exists for _, _, exists in results] == [True, False, True, False, True]
+    assert len(cache) == 2
+
+
+def test_engine_concurrent_runs(tmpdir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    engine = taggo.Taggo(nametemplate="{tag[as-folders]}/{path[basename]}", metadata={'md5': {}})
+    jobs = [
+        (f"{test_files}/files_flat", f"{tmpdir}/flat"),
+        (f"{test_files}/files_meta", f"{tmpdir}/meta"),
+    ]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda job: engine.run(*job), jobs))
+
+    assert os.path.islink(f"{tmpdir}/flat/tag1/#tag1.txt")
+    assert os.path.islink(f"{tmpdir}/meta/zip/#zip.zip")
+    assert not os.path.exists(f"{tmpdir}/flat/zip")
+
+
+def test_engine_raises(tmpdir):
+    # Both files ends up with the same name
+    engine = taggo.Taggo(nametemplate="{tag[as-folders]}/same", collision_rule="bail-if-different")
+    with pytest.raises(taggo.exceptions.CollisionException):
+        engine.run(f"{test_files}/files_flat", str(tmpdir))
+
+    tmppath = f"{tmpdir}/existing-file"
+    with open(tmppath, "w") as fp:
+        fp.write("")
+    with pytest.raises(taggo.exceptions.DstNotFolderException):
+        taggo.Taggo().run(test_files, tmppath)
+
+
+def test_json_output(caplog, tmpdir):
+    # The taggo logger doesnt propagate to the root logger caplog listens on
+    taggo.logger.addHandler(caplog.handler)
+    try:
+        # json_output belongs to the engine, so engines with and without it can log at the same time
+        taggo.Taggo(json_output=True).run(f"{test_files}/files_flat", f"{tmpdir}/json")
+        entries = [json.loads(r.getMessage()) for r in caplog.records]
+        assert entries and all('_category' in e for e in entries)
+
+        caplog.clear()
+        taggo.Taggo().run(f"{test_files}/files_flat", f"{tmpdir}/text")
+        assert caplog.records and not any(r.getMessage().startswith('{') for r in caplog.records)
+
+        caplog.clear()
+        with pytest.raises(SystemExit):
+            taggo.main(["--json-output", "run", "non-existing", f"{tmpdir}/json"])
+        assert json.loads(caplog.records[-1].getMessage())['_category'] == 'exception'
+    finally:
+        taggo.logger.removeHandler(caplog.handler)
+
+    # The module-level functions don't use its options, so it warns about it
+    with pytest.warns(DeprecationWarning):
+        engine = taggo.configure(dry=True, nametemplate="{tag}")
+    assert engine.dry and not engine.json_output
+
+
+def test_arun(tmpdir):
+    import asyncio
+
+    def run_async(coroutine):
+        # asyncio.run() needs python 3.7
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    async def collect():
+        return [
+            e async for e in taggo.arun(
+                test_files, str(tmpdir), concurrency=4, nametemplate='{tag.as-folders}/{path.basename}'
+            )
+        ]
+
+    events = run_async(collect())
+
+    made = [e for e in events if e['category'] == 'made-symlink']
+    assert os.path.isfile(f"{tmpdir}/tarball/#tarball.tar")
+    assert f"{tmpdir}/tarball/#tarball.tar" in [e['symlink_full_path'] for e in made]
+    assert any(e['category'] == 'skipped' and e['reason'] == 'no-tags' for e in events)
+
+    # The outputs are opened and closed in the executor too, closing writes the manifest
+    async def manifest():
+        return [e async for e in taggo.arun(f"{test_files}/files_flat", f"{tmpdir}/manifest", link_creator="manifest")]
+
+    events = run_async(manifest())
+    with open(f"{tmpdir}/manifest/{taggo.MANIFEST_NAME}") as fp:
+        assert len(fp.readlines()) == len([e for e in events if e['category'] == 'made-symlink'])
+
+
+def test_metadata_records(tmpdir):
+    taggo.run(
+        f"{test_files}/files_meta", str(tmpdir),
+        nametemplate='{path.stat.mtime.year}/{path[hierarcy_rev][0]}/{path.missing}{path.basename}',
+        metadata={'stat': {}},
+        filters={'early': ['path."file-ext" == `zip`'], 'late': ['path.stat.size > `0`']}
+    )
+    year = datetime.datetime.fromtimestamp(os.stat(f"{test_files}/files_meta/#zip.zip").st_mtime).year
+    assert os.listdir(f"{tmpdir}/{year}/files_meta") == ["#zip.zip"]
+
+    record = taggo.PathRecord("/a/b/c #tag.txt", True)
+    assert record["hierarcy_rev"] == ["b", "a"]
+    assert record["hierarcy_str"] == "a_b"
+    assert "stat" not in record.as_dict()
+
+
+def test_where(tmpdir):
+    taggo.main([
+        "run", test_files, str(tmpdir),
+        "--metadata", "stat",
+        "--where", "file-ext__icontains=JPG,jpeg",
+        "--where", "stat.size__gt=0",
+        "--where", "tag.name__regex=^(human|tag1.)$",
+        "--nametemplate", "{tag.as-folders}/{path.basename}"
+    ])
+
+    # image-ext3 #tag11.jpeg is empty
+    assert os.listdir(tmpdir) == ["human"]
+    assert len(os.listdir(f"{tmpdir}/human")) == 2
+
+    with pytest.raises(SystemExit) as ex:
+        taggo.main(["run", test_files, str(tmpdir), "--where", "basename__nonexisting=a"])
+    assert ex.value.code == 2
+
+    # Only the operators, not everything else in taggo.filters
+    with pytest.raises(taggo.exceptions.Error, match="Unknown operator"):
+        taggo.Taggo(where=["basename__re=a"])
+
+    with pytest.raises(taggo.exceptions.Error, match="metadata plugin stat"):
+        taggo.Taggo(where=["stat.size=0"])
+
+    # The value is compared as a number too
+    taggo.main([
+        "run", f"{test_files}/files_flat", f"{tmpdir}/empty", "--metadata", "stat", "--where", "stat.size=0",
+        "--where", "basename__neq=a file #tag1.txt", "--nametemplate", "{path.basename}"
+    ])
+    # "#tag1 #tag1-a-b(b).txt" is not empty
+    assert len(os.listdir(f"{tmpdir}/empty")) == len(os.listdir(f"{test_files}/files_flat")) - 2
+
+
+def test_exclude(tmpdir):
+    src = f"{tmpdir}/src"
+    shutil.copytree(test_files, src, symlinks=True)
+    os.makedirs(f"{src}/.cache #cachetag")
+    with open(f"{src}/.cache #cachetag/file #cachetag", "w") as fp:
+        fp.write("")
+    with open(f"{src}/folders_depth/{taggo.IGNORE_FILE_NAME}", "w") as fp:
+        fp.write("# Comment\na/\n\\#tag6/\n")
+
+    taggo.main([
+        "run", src, f"{tmpdir}/dst",
+        "--exclude", ".*",
+        "--exclude", "re:^files_(flat|meta)/.*#tag1",
+        "--include", "files_meta/image-ext #tag9.jpg",
+        "--nametemplate", "{tag.as-folders}/{path.basename}"
+    ])
+
+    tags = os.listdir(f"{tmpdir}/dst")
+    assert "cachetag" not in tags
+    assert "tag1" not in tags
+    assert "tag5" not in tags
+    assert "tag7" not in tags
+    assert "tag9" in tags
+    assert "tag11" not in tags
+    assert "human" in tags
+
+    rules = taggo.ignore.Rules.from_options(excludes=["*.jpg", "re:secret"], includes=["keep*"])
+    assert rules.excluded("a/b.jpg", "b.jpg", False)
+    assert not rules.excluded("a/keep.jpg", "keep.jpg", False)
+    assert rules.excluded("a/secret/c", "c", False)
+
+
+def test_duplicates(tmpdir, monkeypatch):
+    src = f"{tmpdir}/src"
+    os.makedirs(f"{src}/a")
+    os.makedirs(f"{src}/b")
+    big = b"x" * 10000
+    for path, content in [
+        ("a/photo #img.jpg", big),
+        ("b/copy #img.jpg", big),
+        # Same size, start and end, but different in the middle
+        ("b/almost #img.jpg", big[:5000] + b"y" + big[5001:]),
+        ("a/small #img.txt", b"small"),
+        ("b/small copy #img.txt", b"small"),
+        ("b/unique #img.txt", b"unique"),
+    ]:
+        with open(f"{src}/{path}", "wb") as fp:
+            fp.write(content)
+
+    taggo.main([
+        "run", src, f"{tmpdir}/dst",
+        "--metadata", "duplicates", "chunk_size=1024",
+        "--where", "duplicates.first=False",
+        "--nametemplate", "dups/{path.duplicates.group}/{path.basename}"
+    ])
+
+    groups = os.listdir(f"{tmpdir}/dst/dups")
+    assert len(groups) == 2
+    links = sorted(f for g in groups for f in os.listdir(f"{tmpdir}/dst/dups/{g}"))
+    assert links == ["copy #img.jpg", "small copy #img.txt"]
+
+    # The plugin is prepared with the files the run walks, once, and excluded files are not in them
+    walks = []
+    walk = os.walk
+
+    def counting_walk(top, *args, **kwargs):
+        walks.append(top)
+        return walk(top, *args, **kwargs)
+
+    monkeypatch.setattr(os, "walk", counting_walk)
+    taggo.main([
+        "run", src, f"{tmpdir}/excluded", "--metadata", "duplicates", "--exclude", "b/copy*",
+        "--where", "duplicates.first=False", "--nametemplate", "{path.basename}"
+    ])
+    assert os.listdir(f"{tmpdir}/excluded") == ["small copy #img.txt"]
+    assert len(walks) == 1
+
+
+def test_link_threads(tmpdir):
+    taggo.main(["run", test_files, f"{tmpdir}/threaded", "--link-threads", "4"])
+    taggo.main(["run", test_files, f"{tmpdir}/serial"])
+
+    assert symlinks_in(f"{tmpdir}/threaded") == symlinks_in(f"{tmpdir}/serial")
+
+    # Collisions are still handled
+    engine = taggo.Taggo(nametemplate="{tag[as-folders]}/same", collision_rule="bail-if-different", link_threads=4)
+    with pytest.raises(taggo.exceptions.CollisionException):
+        engine.run(f"{test_files}/files_flat", f"{tmpdir}/collisions")
+
+    # A folder that can't be made stops the run, and doesnt leave the other threads waiting for it
+    src = f"{tmpdir}/many"
+    os.makedirs(src)
+    for i in range(300):
+        open(f"{src}/{i} #tag1 #tag2.txt", "w").close()
+    os.makedirs(f"{tmpdir}/failing")
+    os.symlink("non-existing", f"{tmpdir}/failing/tag1")
+    with pytest.raises(OSError):
+        taggo.Taggo(link_threads=2).run(src, f"{tmpdir}/failing")
+
+
+def test_dir_fds(tmpdir):
+    taggo.Taggo(dir_fds=False).run(test_files, f"{tmpdir}/paths")
+    engine = taggo.Taggo(collision_rule="smart")
+    engine.run(test_files, f"{tmpdir}/fds")
+    # Existing links are found the same way
+    engine.run(test_files, f"{tmpdir}/fds")
+    assert symlinks_in(f"{tmpdir}/fds") == symlinks_in(f"{tmpdir}/paths")
+
+    # Folders are made, also when evicted from the cache
+    with taggo.dirfd.DirFds(size=2) as dirs:
+        for folder in ["a/b/c", "a/b/d", "e", "a/b/c/f"]:
+            dirs.get(f"{tmpdir}/made/{folder}", create=True)
+        assert len(dirs.caches[0]) == 2
+    assert os.path.isdir(f"{tmpdir}/made/a/b/c/f")
+    assert not dirs.caches[0]
+
+    # The threads share the open folders, and stay below the fd limit of the process
+    resource = pytest.importorskip("resource")
+    src = f"{tmpdir}/many-folders"
+    os.makedirs(src)
+    for i in range(200):
+        open(f"{src}/{i} #tag{i}.txt", "w").close()
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir("/proc/self/fd")) + 64, limits[1]))
+    try:
+        assert taggo.dirfd.DirFds().size == taggo.dirfd.fd_budget(64) < 64
+        taggo.Taggo(link_threads=16).run(src, f"{tmpdir}/many-fds")
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    assert len(os.listdir(f"{tmpdir}/many-fds")) == 200
+
+
+def test_symlink_destination():
+    for sourcepath, symlink_folder in [
+        ("/src/a/b/file #tag.txt", "/dst/tag"),
+        ("/src/a/b/file #tag.txt", "/src/a/b"),
+        ("/src/a/b/file #tag.txt", "/src/a/b/c/d"),
+        ("/src/a/b/file #tag.txt", "/src"),
+        ("/file #tag.txt", "/dst/tag"),
+        ("/src/#tag-folder", "/dst/tag/folder"),
+    ]:
+        expected = os.path.relpath(sourcepath, symlink_folder)
+        assert taggo._symlink_destination(sourcepath, symlink_folder) == expected
+        # Again, from the cache
+        assert taggo._symlink_destination(sourcepath, symlink_folder) == expected
+
+
+def test_link_creators(tmpdir):
+    src = f"{tmpdir}/src"
+    shutil.copytree(f"{test_files}/files_flat", src)
+    tagged = glob.glob(f"{src}/*#*")
+
+    for creator in ["hardlink", "reflink"]:
+        engine = taggo.Taggo(link_creator=creator, nametemplate="{tag[as-folders]}/{path[basename]}")
+        engine.run(src, f"{tmpdir}/{creator}")
+        links = [p for p in glob.glob(f"{tmpdir}/{creator}/**", recursive=True) if os.path.isfile(p)]
+        assert links
+        assert not any(os.path.islink(p) for p in links)
+        if creator == "hardlink":
+            assert all(os.stat(p).st_nlink > 1 for p in links)
+
+        # The same files are found again, and not made twice
+        events = [e for path in tagged for e in engine.make_symlink(f"{tmpdir}/{creator}", path)]
+        assert {e['category'] for e in events} == {'skipped'}
+
+    # When the source changes, the old copies are replaced, also with the smart collision-handler
+    changed = f"{src}/a file #tag1.txt"
+    for creator in ["hardlink", "reflink"]:
+        engine = taggo.Taggo(link_creator=creator, nametemplate="{path[basename]}", collision_rule="smart")
+        engine.run(changed, f"{tmpdir}/{creator}-changed")
+        with open(f"{changed}.new", "w") as fp:
+            fp.write(creator)
+        os.replace(f"{changed}.new", changed)
+
+        events = engine.make_symlink(f"{tmpdir}/{creator}-changed", changed)
+        assert [e['category'] for e in events] == ['collision', 'made-symlink']
+        assert events[0]['overwritten']
+        with open(f"{tmpdir}/{creator}-changed/a file #tag1.txt") as fp:
+            assert fp.read() == creator
+
+    # A rename can't find the old copies in dst again
+    for creator in ["hardlink", "reflink", "manifest"]:
+        with pytest.raises(taggo.exceptions.Error):
+            taggo.Taggo(link_creator=creator).rename(src, {"tag1": "newtag1"}, dst=f"{tmpdir}/{creator}")
+    assert os.path.isfile(f"{src}/a file #tag1.txt")
+
+    taggo.main(["run", "--link-creator", "manifest", src, f"{tmpdir}/manifest"])
+    assert os.listdir(f"{tmpdir}/manifest") == [taggo.MANIFEST_NAME]
+    with open(f"{tmpdir}/manifest/{taggo.MANIFEST_NAME}") as fp:
+        entries = [json.loads(line) for line in fp]
+    taggo.main(["run", src, f"{tmpdir}/symlinks"])
+    assert sorted(entries) == sorted(
+        [os.path.relpath(p, f"{tmpdir}/symlinks"), os.readlink(p)]
+        for p in glob.glob(f"{tmpdir}/symlinks/**", recursive=True) if os.path.islink(p)
+    )
+
+
+def test_find_tags():
+    assert taggo.hashtags_in("no tags here.txt") == []
+    assert taggo.hashtags_in("#test not#me #abc(test=123,la=la) #aaa(111) #aaa(222) lala") == [
+        'test', 'abc', 'aaa', 'aaa'
+    ]
+    assert taggo._find_tags("a #b #b #c(1,2) #d(1) #d(2)") == {'b': [''], 'c': ['1', '2'], 'd': ['2']}
+    # From the cache, not changed by what we did with the last one
+    tags = taggo._find_tags("a #b #b #c(1,2)")
+    tags['c'].append('3')
+    assert taggo._find_tags("a #b #b #c(1,2)") == {'b': [''], 'c': ['1', '2']}
+    assert taggo._find_tags("no tags") == {}
+    assert taggo._find_tags("tag-a(1)", taggo.tag_re) == {'tag-a': ['1']}
+
+
+def test_frontmatter_lookup(tmpdir):
+    src = f"{tmpdir}/src"
+    os.makedirs(src)
+    for name, content in [
+        ("list.md", "---\ntitle: a\ntags:\n- one\n- two(x)\nother: 1\n---\n\n#notatag\n"),
+        ("inline.md", "---\ntags: [one, three]\n---\n"),
+        ("string.md", "---\ndate: 2020-01-01\ntags: four, five\n...\n"),
+        ("nested.md", "---\nmeta:\n  tags: [no]\n---\n"),
+        ("unclosed.md", "---\ntags: [no]\n"),
+        ("none.md", "tags: [no]\n"),
+    ]:
+        with open(f"{src}/{name}", "w") as fp:
+            fp.write(content)
+
+    assert taggo.lookups.frontmatter_tags(f"{src}/list.md") == ['one', 'two(x)']
+    assert taggo.lookups.frontmatter_tags(f"{src}/inline.md") == ['one', 'three']
+    assert taggo.lookups.frontmatter_tags(f"{src}/string.md") == ['four, five']
+    for name in ["nested.md", "unclosed.md", "none.md"]:
+        assert taggo.lookups.frontmatter_tags(f"{src}/{name}") == []
+
+    cache = f"{tmpdir}/cache.json"
+    taggo.Taggo(tag_lookup=["frontmatter"], tag_cache=cache, dry=True).run(src, f"{tmpdir}/dry")
+    assert not os.path.exists(cache)
+
+    engine = taggo.Taggo(tag_lookup=["frontmatter"], tag_cache=cache, nametemplate="{tag[name]}/{path[basename]}")
+    engine.run(src, f"{tmpdir}/dst")
+    assert sorted(os.listdir(f"{tmpdir}/dst")) == ['five', 'four', 'one', 'three', 'two']
+    assert os.path.isfile(cache)
+
+    # Unchanged files are not read again
+    with open(cache) as fp:
+        data = json.load(fp)
+    data[f"frontmatter:{src}/inline.md"][3] = ["cached"]
+    with open(cache, "w") as fp:
+        json.dump(data, fp)
+    engine = taggo.Taggo(tag_lookup=["frontmatter"], tag_cache=cache, nametemplate="{tag[name]}/{path[basename]}")
+    engine.run(src, f"{tmpdir}/dst")
+    assert os.path.islink(f"{tmpdir}/dst/cached/inline.md")
+
+    # The cache can be saved while other threads are adding to it
+    from concurrent.futures import ThreadPoolExecutor
+    for i in range(500):
+        with open(f"{src}/{i}.md", "w") as fp:
+            fp.write(f"---\ntags: [t{i}]\n---\n")
+    lookup = taggo.lookups.Lookups(["frontmatter"], cache_path=f"{tmpdir}/threads.json")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(lookup._cached, 'frontmatter', f"{src}/{i}.md", taggo.lookups.frontmatter_tags)
+            for i in range(500)
+        ]
+        futures += [executor.submit(lookup.save) for _ in range(50)]
+        for future in futures:
+            future.result()
+    lookup.save()
+    with open(f"{tmpdir}/threads.json") as fp:
+        assert len(json.load(fp)) == 500
+
+
+def test_xattr_and_sidecar_lookup(tmpdir):
+    src = f"{tmpdir}/src"
+    os.makedirs(src)
+    for name in ["photo.jpg", "other.jpg", "plain.txt"]:
+        with open(f"{src}/{name}", "w") as fp:
+            fp.write("")
+
+    xmp = textwrap.dedent("""\
+        <x:xmpmeta xmlns:x="adobe:ns:meta/">
+         <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+          <rdf:Description xmlns:dc="http://purl.org/dc/elements/1.1/">
+           <dc:subject><rdf:Bag><rdf:li>{}</rdf:li></rdf:Bag></dc:subject>
+          </rdf:Description>
+         </rdf:RDF>
+        </x:xmpmeta>
+        """)
+    for name, tag in [("photo.jpg.xmp", "travel"), ("photo.xmp", "beach"), ("other.xmp", "work")]:
+        with open(f"{src}/{name}", "w") as fp:
+            fp.write(xmp.format(tag))
+
+    lookup = taggo.lookups.Lookups(["sidecar"], cache_path=False)
+    assert lookup._sidecar_tags(f"{src}/photo.jpg") == ["travel", "beach"]
+    assert lookup._sidecar_tags(f"{src}/plain.txt") == []
+
+    try:
+        os.setxattr(f"{src}/plain.txt", "user.xdg.tags", b"xattr1, xattr2")
+    except OSError:
+        pytest.skip("No xattr support")
+
+    taggo.main([
+        "run", src, f"{tmpdir}/dst", "--nametemplate", "{tag[name]}/{path[basename]}",
+        "--tag-lookup", "xattr", "--tag-lookup", "sidecar"
+    ])
+    assert sorted(os.listdir(f"{tmpdir}/dst")) == ["beach", "travel", "work", "xattr1", "xattr2"]
+    assert os.listdir(f"{tmpdir}/dst/xattr1") == ["plain.txt"]
+    assert sorted(os.listdir(f"{tmpdir}/dst/work")) == ["other.jpg"]
+
+
+def test_location(tmpdir, monkeypatch):
+    import piexif
+
+    src = f"{tmpdir}/src"
+    os.makedirs(src)
+    for name, gps in [
+        ("oslo #photo.jpg", {
+            piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((59, 1), (50, 1), (1111, 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((10, 1), (50, 1), (3000, 100)),
+        }),
+        ("rio #photo.jpg", {
+            piexif.GPSIFD.GPSLatitudeRef: b'S', piexif.GPSIFD.GPSLatitude: ((22, 1), (54, 1), (0, 1)),
+            piexif.GPSIFD.GPSLongitudeRef: b'W', piexif.GPSIFD.GPSLongitude: ((43, 1), (12, 1), (0, 1)),
+        }),
+        ("nowhere #photo.jpg", {}),
+    ]:
+        shutil.copy(f"{test_files}/files_meta/human_female_face_320x400 #human.jpg", f"{src}/{name}")
+        piexif.insert(piexif.dump({"GPS": gps}), f"{src}/{name}")
+
+    taggo.main([
+        "run", src, str(tmpdir / "dst"), "--metadata", "exif", "--metadata", "location",
+        "--where", "location.country__neq=",
+        "--nametemplate", "{path.location.country}/{path.location.city}/{path.basename}"
+    ])
+    assert os.path.islink(f"{tmpdir}/dst/NO/Oslo/oslo #photo.jpg")
+    assert os.path.islink(f"{tmpdir}/dst/BR/Rio de Janeiro/rio #photo.jpg")
+    assert sorted(os.listdir(f"{tmpdir}/dst")) == ["BR", "NO"]
+
+    exif = taggo.importlib.import_module("taggo.metadata.20_exif")
+    lat, lon = exif.run(f"{src}/rio #photo.jpg")['GPSLatLon']
+    assert round(lat, 2) == -22.9 and round(lon, 2) == -43.2
+
+    # With exif enabled, location uses its position instead of reading the file again
+    loads = []
+    load = piexif.load
+    monkeypatch.setattr(piexif, "load", lambda filepath: loads.append(filepath) or load(filepath))
+    engine = taggo.Taggo(metadata={"exif": {}, "location": {}}, nametemplate="{path.location.city}/{path.basename}")
+    engine.run(f"{src}/oslo #photo.jpg", f"{tmpdir}/from-exif")
+    assert os.path.islink(f"{tmpdir}/from-exif/Oslo/oslo #photo.jpg")
+    assert loads == [f"{src}/oslo #photo.jpg"]
+
+
+def test_geometry(tmpdir):
+    import struct
+    import piexif
+
+    geometry = taggo.importlib.import_module("taggo.metadata.22_geometry")
+    images = {
+        "a.png": b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 640, 480) + b'\x08\x02\x00\x00\x00',
+        "a.gif": b'GIF89a' + struct.pack('<HH', 10, 20) + b'\x00' * 10,
+        "a.bmp": b'BM' + b'\x00' * 12 + struct.pack('<Iii', 40, 300, -300) + b'\x00' * 8,
+        "lossy.webp": b'RIFF\x00\x00\x00\x00WEBPVP8 \x00\x00\x00\x00\x00\x00\x00\x9d\x01\x2a'
+                      + struct.pack('<HH', 800, 600) + b'\x00' * 4,
+        "lossless.webp": b'RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00\x2f'
+                         + struct.pack('<I', (99 << 14) | 199) + b'\x00' * 8,
+        "extended.webp": b'RIFF\x00\x00\x00\x00WEBPVP8X\x0a\x00\x00\x00\x00\x00\x00\x00'
+                         + (4000 - 1).to_bytes(3, 'little') + (3000 - 1).to_bytes(3, 'little') + b'\x00' * 4,
+        "not-an-image.txt": b'hello',
+    }
+    for name, data in images.items():
+        with open(f"{tmpdir}/{name}", "wb") as fp:
+            fp.write(data)
+
+    def size(path):
+        result = geometry.run(path)
+        return result['format'], result['width'], result['height'], result['orientation']
+
+    assert size(f"{tmpdir}/a.png") == ('png', 640, 480, 'landscape')
+    assert size(f"{tmpdir}/a.gif") == ('gif', 10, 20, 'portrait')
+    assert size(f"{tmpdir}/a.bmp") == ('bmp', 300, 300, 'square')
+    assert size(f"{tmpdir}/lossy.webp") == ('webp', 800, 600, 'landscape')
+    assert size(f"{tmpdir}/lossless.webp") == ('webp', 200, 100, 'landscape')
+    assert size(f"{tmpdir}/extended.webp") == ('webp', 4000, 3000, 'landscape')
+    assert geometry.run(f"{tmpdir}/extended.webp")['megapixels'] == 12.0
+    assert size(f"{tmpdir}/not-an-image.txt") == ('', None, None, '')
+    assert size(f"{test_files}/files_meta/human_male_face_300x329 #human.jpg") == ('jpeg', 300, 329, 'portrait')
+
+    # Rotated by exif
+    shutil.copy(f"{test_files}/files_meta/human_female_face_320x400 #human.jpg", f"{tmpdir}/rotated.jpg")
+    piexif.insert(piexif.dump({"0th": {piexif.ImageIFD.Orientation: 6}}), f"{tmpdir}/rotated.jpg")
+    assert size(f"{tmpdir}/rotated.jpg") == ('jpeg', 400, 320, 'landscape')
+
+    taggo.main([
+        "run", f"{test_files}/files_meta", f"{tmpdir}/dst", "--metadata", "geometry",
+        "--where", "geometry.orientation=portrait", "--nametemplate", "{path.geometry.width}x{path.geometry.height}"
+    ])
+    assert sorted(os.listdir(f"{tmpdir}/dst")) == ["300x329", "320x400"]
+
+
+def test_video(tmpdir):
+    import struct
+
+    video = taggo.importlib.import_module("taggo.metadata.30_video")
+
+    def box(box_type, data):
+        return struct.pack('>I4s', 8 + len(data), box_type) + data
+
+    def text(value):
+        return struct.pack('>HH', len(value), 0) + value
+
+    def tkhd(width, height, matrix):
+        return box(b'tkhd', b'\x00' * 4 + b'\x00' * 20 + b'\x00' * 16 + struct.pack('>9i', *matrix)
+                   + struct.pack('>II', width << 16, height << 16))
+
+    # 2020-05-17 12:00:00 UTC, 90000 / 1000 seconds
+    created = 1589716800 + video.EPOCH_1904
+    mvhd = box(b'mvhd', b'\x00' * 4 + struct.pack('>IIII', created, created, 1000, 90000) + b'\x00' * 80)
+    turned = [0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000]
+    moov = box(b'moov', mvhd + box(b'trak', tkhd(0, 0, [0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000]))
+               + box(b'trak', tkhd(1920, 1080, turned))
+               + box(b'udta', box(b'\xa9xyz', text(b'+59.9139+010.7522/')) + box(b'\xa9mak', text(b'Apple'))))
+
+    with open(f"{tmpdir}/clip #video.mp4", "wb") as fp:
+        fp.write(box(b'ftyp', b'isom\x00\x00\x02\x00') + box(b'mdat', b'\x00' * 100000) + moov)
+    with open(f"{tmpdir}/not-a-video.txt", "wb") as fp:
+        fp.write(b'hello, this is not a video')
+
+    result = video.run(f"{tmpdir}/clip #video.mp4")
+    assert result['duration'] == 90.0
+    assert (result['width'], result['height']) == (1080, 1920)
+    assert result['creation_time']['iso'].startswith('2020-05-17T12:00:00')
+    assert result['location'] == [59.9139, 10.7522]
+    assert result['make'] == 'Apple'
+    assert video.run(f"{tmpdir}/not-a-video.txt") == video.NO_VIDEO
+
+    taggo.main([
+        "run", str(tmpdir), f"{tmpdir}/dst", "--metadata", "video", "--where", "video.duration__gte=60",
+        "--nametemplate", "{path.video.creation_time.year}/{path.video.width}x{path.video.height}/{path.basename}"
+    ])
+    assert os.path.islink(f"{tmpdir}/dst/2020/1080x1920/clip #video.mp4")
+
+
+def test_filetype(tmpdir):
+    plugin = taggo.importlib.import_module("taggo.metadata.15_filetype")
+
+    shutil.copy(f"{test_files}/files_meta/#zip.zip", f"{tmpdir}/archive.JPEG")
+    shutil.copy(f"{test_files}/files_meta/#zip.zip", f"{tmpdir}/archive.unknown-ext")
+
+    # Known extensions are trusted, without opening the file
+    assert plugin.run(f"{tmpdir}/archive.JPEG", plugin.setup())['mime'] == 'image/jpeg'
+    assert plugin.run(f"{tmpdir}/does-not-exist.png", plugin.setup())['group'] == 'image'
+    # Unless asked to verify
+    verified = plugin.run(f"{tmpdir}/archive.JPEG", plugin.setup({'verify': '1'}))
+    assert (verified['mime'], verified['group']) == ('application/zip', 'archive')
+    assert plugin.run(f"{tmpdir}/archive.unknown-ext", plugin.setup())['extension'] == 'zip'
+    assert plugin.run(f"{test_files}/files_meta/1KiB #blob.txt", plugin.setup()) == {}
+
+
+def test_archive_lookup(tmpdir, monkeypatch):
+    import tarfile
+    import zipfile
+
+    monkeypatch.setenv("XDG_CACHE_HOME", f"{tmpdir}/cache")
+    src = f"{tmpdir}/src"
+    os.makedirs(src)
+    with zipfile.ZipFile(f"{src}/photos.zip", "w") as archive:
+        archive.writestr("trip/#beach/a.jpg", b"a")
+        archive.writestr("trip/#beach/b.jpg", b"b")
+        archive.writestr("c #sun(2019).jpg", b"c")
+        archive.writestr("untagged.txt", b"d")
+    for name, mode in [("notes.tar", "w"), ("notes.tar.gz", "w:gz")]:
+        with tarfile.open(f"{src}/{name}", mode) as archive:
+            archive.add(f"{test_files}/files_flat/#tag1.txt", arcname=f"{name} #tarred.txt")
+
+    assert taggo.lookups.archive_tags(f"{src}/photos.zip") == [
+        ["beach", "trip/#beach/a.jpg"], ["beach", "trip/#beach/b.jpg"], ["sun(2019)", "c #sun(2019).jpg"]
+    ]
+
+    taggo.main([
+        "run", src, f"{tmpdir}/dst", "--tag-lookup", "archive",
+        "--nametemplate", "{tag[name]}/{path[basename]}"
+    ])
+    assert sorted(os.listdir(f"{tmpdir}/dst")) == ["beach", "sun", "tarred"]
+    assert os.listdir(f"{tmpdir}/dst/tarred") == ["notes.tar"]
+
+    engine = taggo.Taggo(tag_lookup=["archive-compressed"], nametemplate="{tag[name]}/{path[basename]}")
+    events = engine.make_symlink(f"{tmpdir}/dst2", f"{src}/notes.tar.gz")
+    assert [e['symlink_full_path'] for e in events] == [f"{tmpdir}/dst2/tarred/notes.tar.gz"]
+
+    # Members are available to templates
+    metadata = taggo.Metadata()
+    metadata.set('path', taggo.PathRecord(f"{src}/photos.zip", True))
+    members = {}
+    taggo.find_tags(metadata['path'], tag_lookup=["archive"], members=members)
+    assert members == {"beach": ["trip/#beach/a.jpg", "trip/#beach/b.jpg"], "sun": ["c #sun(2019).jpg"]}
+
+    taggo.main([
+        "run", f"{src}/photos.zip", f"{tmpdir}/members", "--tag-lookup", "archive",
+        "--nametemplate", "{tag[name]}/{tag[members_str]}.zip"
+    ])
+    assert os.listdir(f"{tmpdir}/members/beach") == ["trip_#beach_a.jpg, trip_#beach_b.jpg.zip"]
+
+    # Only archives are looked at, and cached
+    with open(f"{tmpdir}/cache/taggo/tag-lookup.json") as fp:
+        assert all(key.startswith("archive:") and key.endswith((".zip", ".tar")) for key in json.load(fp))
+
+
+def test_phash(tmpdir, monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    phash = taggo.importlib.import_module("taggo.metadata.50_phash")
+
+    src = f"{tmpdir}/src"
+    os.makedirs(src)
+    face = Image.open(f"{test_files}/files_meta/human_female_face_320x400 #human.jpg")
+    face.save(f"{src}/burst1 #photo.jpg", quality=95)
+    face.resize((160, 200)).save(f"{src}/burst2 #photo.jpg", quality=50)
+    face.save(f"{src}/burst3 #photo.png")
+    x, y = numpy.meshgrid(numpy.arange(400), numpy.arange(300))
+    Image.fromarray((((x // 50 + y // 50) % 2) * 255).astype(numpy.uint8)).save(f"{src}/other #photo.jpg")
+
+    tree = phash.BKTree()
+    for value in [0b0000, 0b0001, 0b0111, 0b1111]:
+        tree.add(value, value)
+    assert sorted(tree.search(0b0000, 1)) == [0b0000, 0b0001]
+
+    state = phash.prepare(sorted(glob.glob(f"{src}/*")), {'cache': f"{tmpdir}/phash.json"})
+    assert os.path.isfile(f"{tmpdir}/phash.json")
+    groups = {os.path.basename(path): result['group'] for path, result in state.items()}
+    assert groups["burst1 #photo.jpg"] == groups["burst2 #photo.jpg"] == groups["burst3 #photo.png"] != ''
+    assert groups["other #photo.jpg"] == ''
+
+    taggo.main([
+        "run", src, f"{tmpdir}/dst", "--metadata", "phash", f"cache={tmpdir}/phash.json",
+        "--where", "phash.similar=True", "--nametemplate", "similar/{path.phash.group}/{path.basename}"
+    ])
+    assert len(os.listdir(f"{tmpdir}/dst/similar")) == 1
+
+    # A dry run doesnt write the cache
+    taggo.main(["run", "--dry", src, f"{tmpdir}/dry", "--metadata", "phash", f"cache={tmpdir}/dry.json"])
+    assert not os.path.exists(f"{tmpdir}/dry.json")
+
+    # Images that are too big to open are not hashed, with or without prepare
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    assert phash.run(f"{src}/burst1 #photo.jpg") == phash.NO_HASH
+
+
+def test_shards(tmpdir):
+    # Everything is in exactly one part
+    parts = [taggo.shards.Shard(k, 3, depth=2) for k in (1, 2, 3)]
+    for path in ["a", "a/b", "a/b/c.txt", "a/c", "d.txt"]:
+        assert sum(path in part for part in parts) == 1
+    assert ("a/b/c.txt" in parts[0]) == ("a/b" in parts[0])
+
+    taggo.main(["run", test_files, f"{tmpdir}/serial"])
+    for k in (1, 2, 3):
+        taggo.main(["run", test_files, f"{tmpdir}/sharded", "--shard", f"{k}/3"])
+    assert len(glob.glob(f"{tmpdir}/sharded/.taggo-shard-*")) == 3
+    taggo.main(["merge", f"{tmpdir}/sharded"])
+    assert glob.glob(f"{tmpdir}/sharded/.taggo-shard-*") == []
+    assert symlinks_in(f"{tmpdir}/sharded") == symlinks_in(f"{tmpdir}/serial")
+
+    # Links wanted by more than one shard ends up the same, no matter which shard was first
+    src = f"{tmpdir}/src"
+    for name in "abcdefgh":
+        os.makedirs(f"{src}/{name}")
+        open(f"{src}/{name}/file #same.txt", "w").close()
+    assert len({name in parts[0] for name in "abcdefgh"}) == 2
+
+    for order in ([1, 2], [2, 1]):
+        dst = f"{tmpdir}/order{order[0]}"
+        for k in order:
+            taggo.Taggo(nametemplate="{tag[as-folders]}/same", collision_rule="smart", shard=(k, 2)).run(src, dst)
+        taggo.merge(dst)
+    assert symlinks_in(f"{tmpdir}/order1") == symlinks_in(f"{tmpdir}/order2")
+    assert len(symlinks_in(f"{tmpdir}/order1")) == 1
+
+    # All the shards must be done before merging, and cleanup must wait for merge
+    taggo.Taggo(shard=(1, 2)).run(src, f"{tmpdir}/unfinished")
+    with pytest.raises(taggo.exceptions.Error):
+        taggo.merge(f"{tmpdir}/unfinished")
+    with pytest.raises(taggo.exceptions.Error):
+        taggo.Taggo(shard=(2, 2)).run(src, f"{tmpdir}/unfinished", auto_cleanup=True)
+    with pytest.raises(taggo.exceptions.Error):
+        taggo.shards.parse("3/2")
+
+
+def test_many_sources(tmpdir):
+    sources = [f"{test_files}/files_flat", f"{test_files}/folders", f"{test_files}/folders_depth"]
+    for src in sources:
+        taggo.main(["run", src, f"{tmpdir}/one-by-one"])
+    taggo.main(["run", *sources, f"{tmpdir}/together"])
+    assert symlinks_in(f"{tmpdir}/together") == symlinks_in(f"{tmpdir}/one-by-one")
+
+    # A src inside another is only walked once, and duplicates are found across all of them
+    src = f"{tmpdir}/src"
+    os.makedirs(f"{src}/a")
+    os.makedirs(f"{src}/b")
+    for name in ["a/x #t.txt", "b/y #t.txt"]:
+        with open(f"{src}/{name}", "w") as fp:
+            fp.write("same")
+    taggo.main([
+        "run", f"{src}/a", f"{src}/b", f"{src}/a", src, f"{tmpdir}/dups", "--metadata", "duplicates",
+        "--where", "duplicates.duplicate=True", "--nametemplate", "{path.duplicates.count}/{path.basename}"
+    ])
+    assert sorted(os.listdir(f"{tmpdir}/dups/2")) == ["x #t.txt", "y #t.txt"]
+
+
+def test_profiles(tmpdir, monkeypatch):
+    md5 = taggo.importlib.import_module("taggo.metadata.40_md5")
+    hashed = []
+    original_run = md5.run
+    monkeypatch.setattr(md5, "run", lambda filepath: hashed.append(filepath) or original_run(filepath))
+
+    views = {
+        "by-tag": [],
+        "by-ext": [
+            "--nametemplate", "{path.file-ext}/{tag.name}/{path.basename}", "--collision-handler", "no-overwrite"
+        ],
+        "jpg": ["--where", "file-ext__iexact=jpg", "--nametemplate", "{path.md5}/{path.basename}"],
+        "txt": ["--filter", "\"file-ext\" == 'txt'", "early"],
+    }
+    for name, options in views.items():
+        taggo.main(["run", test_files, f"{tmpdir}/separate/{name}", "--metadata", "md5", *options])
+    separate = len(hashed)
+
+    with open(f"{tmpdir}/profiles.json", "w") as fp:
+        json.dump([
+            {"dst": "by-tag"},
+            {"dst": "by-ext", "nametemplate": "{path.file-ext}/{tag.name}/{path.basename}",
+             "collision-handler": "no-overwrite"},
+            {"dst": "jpg", "where": ["file-ext__iexact=jpg"], "nametemplate": "{path.md5}/{path.basename}"},
+            {"dst": "txt", "filter": [["\"file-ext\" == 'txt'", "early"]]},
+        ], fp)
+    hashed.clear()
+    taggo.main(["run", test_files, f"{tmpdir}/together", "--metadata", "md5", "--profiles", f"{tmpdir}/profiles.json"])
+
+    for name in views:
+        assert symlinks_in(f"{tmpdir}/together/{name}") == symlinks_in(f"{tmpdir}/separate/{name}")
+    assert symlinks_in(f"{tmpdir}/together/jpg")
+    # Every file is only hashed once, for all the profiles
+    assert len(hashed) == len(set(hashed)) < separate
+
+    with pytest.raises(taggo.exceptions.Error):
+        taggo.Taggo(profiles=[{"dst": "a"}, {"dst": "a/"}])
+    with pytest.raises(taggo.exceptions.Error):
+        taggo.Taggo(profiles=[{"dst": "a", "nametemplat": "{path.basename}"}])